@@ -0,0 +1,31 @@
+"""Runs every benchmark in turn.
+
+Run with `python -m benchmarks`.
+"""
+
+from . import (irc_escape, irc_memory, irc_parse, irc_replay, irc_write, oauth_json, queue_latency,
+               stores, token_index, twitch_events)
+
+_BENCHMARKS = [
+    ('Parse throughput', irc_parse.main),
+    ('Tag escaping', irc_escape.main),
+    ('Message memory', irc_memory.main),
+    ('Event decoding', twitch_events.main),
+    ('Queue latency', queue_latency.main),
+    ('Read throughput and latency', irc_replay.main),
+    ('Writer throughput', irc_write.main),
+    ('OAuth JSON', oauth_json.main),
+    ('User and token stores', stores.main),
+    ('Token index', token_index.main),
+]
+
+
+def main() -> None:
+    for (name, benchmark) in _BENCHMARKS:
+        print(f"== {name} ==")
+        benchmark()
+        print()
+
+
+if __name__ == '__main__':
+    main()
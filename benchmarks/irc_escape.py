@@ -0,0 +1,48 @@
+"""Microbenchmark for irc.UnescapeTagValue and irc.EscapeTagValue.
+
+Run with `python -m benchmarks.irc_escape`.
+"""
+
+import time
+from typing import Callable, List
+
+from minibot_server import irc
+from minibot_server.testing import irc as irc_testing
+
+from .samples import TWITCH_LINES
+
+
+def _TagValues() -> List[bytes]:
+    """Returns the escaped tag values of every tagged sample line."""
+    values = []  # type: List[bytes]
+    for line in TWITCH_LINES:
+        if line.startswith(b'@'):
+            tag_block = line[1:line.index(b' ')]
+            values.extend(entry.partition(b'=')[2] for entry in tag_block.split(b';'))
+    return values
+
+
+def ValuesPerSecond(func: Callable[[bytes], bytes], values: List[bytes], rounds: int = 5) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for value in values:
+            func(value)
+        best = min(best, time.perf_counter() - start)
+    return len(values) / best
+
+
+def main() -> None:
+    escaped = _TagValues() * 2000
+    unescaped = [irc.UnescapeTagValue(value) for value in escaped]
+    for (name, reference, current, values) in (
+            ('UnescapeTagValue', irc_testing.ReferenceUnescapeTagValue, irc.UnescapeTagValue, escaped),
+            ('EscapeTagValue', irc_testing.ReferenceEscapeTagValue, irc.EscapeTagValue, unescaped)):
+        reference_rate = ValuesPerSecond(reference, values)
+        current_rate = ValuesPerSecond(current, values)
+        print(f"{name}: reference {reference_rate:12,.0f} values/sec, "
+              f"current {current_rate:12,.0f} values/sec ({current_rate / reference_rate:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Memory benchmark for buffered irc.Message objects.
+
+Compares the bytes allocated per parsed message against the original
+representation, a plain object holding a tags dict and an args list.
+
+Run with `python -m benchmarks.irc_memory`.
+"""
+
+import gc
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from minibot_server import irc
+from minibot_server.testing.irc import ReferenceParse
+
+from .samples import ChatLog
+
+
+class _OriginalMessage:
+    tags: Dict[bytes, bytes]
+    prefix: Optional[bytes]
+    command: bytes
+    args: List[bytes]
+
+    def __init__(self, line: bytes):
+        (self.prefix, self.command, self.args, self.tags) = ReferenceParse(line)
+
+
+def BytesPerMessage(parse: Callable[[bytes], object], lines: List[bytes]) -> float:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        messages = [parse(line) for line in lines]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # Exclude the list holding the messages.
+    return (after - before - messages.__sizeof__()) / len(lines)
+
+
+def _ParseAndReadTags(line: bytes) -> irc.Message:
+    msg = irc.Message.Parse(line)
+    for _ in msg.tags.items():
+        pass
+    return msg
+
+
+def main() -> None:
+    lines = [bytes(line) for line in ChatLog(20000)]
+    original = BytesPerMessage(_OriginalMessage, lines)
+    untouched = BytesPerMessage(irc.Message.Parse, lines)
+    all_read = BytesPerMessage(_ParseAndReadTags, lines)
+    print(f"original Message:            {original:8,.0f} bytes/message")
+    print(f"Message, tags untouched:     {untouched:8,.0f} bytes/message ({untouched / original:.0%})")
+    print(f"Message, all tags read:      {all_read:8,.0f} bytes/message ({all_read / original:.0%})")
+
+
+if __name__ == '__main__':
+    main()
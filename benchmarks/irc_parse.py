@@ -0,0 +1,43 @@
+"""Throughput benchmark for irc.Message.Parse.
+
+Run with `python -m benchmarks.irc_parse`.
+"""
+
+import time
+from typing import Callable, List
+
+from minibot_server import irc
+from minibot_server.testing.irc import ReferenceParse
+
+from .samples import ChatLog
+
+
+def LinesPerSecond(parse: Callable[[bytes], object], lines: List[bytes], rounds: int = 5) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def main() -> None:
+    lines = ChatLog(20000)
+    reference = LinesPerSecond(ReferenceParse, lines)
+    current = LinesPerSecond(irc.Message.Parse, lines)
+    print(f"reference parser: {reference:12,.0f} lines/sec")
+    print(f"Message.Parse:    {current:12,.0f} lines/sec ({current / reference:.2f}x)")
+
+    # Lines with many middle parameters, where re-slicing the remainder of the
+    # line for every token is quadratic.
+    wide_lines = [b':tmi.twitch.tv 353 bot = #somestreamer ' + b' '.join(
+        b'viewer%d' % i for i in range(200))] * 1000
+    reference = LinesPerSecond(ReferenceParse, wide_lines)
+    current = LinesPerSecond(irc.Message.Parse, wide_lines)
+    print(f"reference parser (200 args): {reference:12,.0f} lines/sec")
+    print(f"Message.Parse (200 args):    {current:12,.0f} lines/sec ({current / reference:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""End-to-end read benchmarks for IrcClientChannel, replaying Twitch traffic
+from a local ReplayIrcServer.
+
+Reports read throughput with the recording sent as fast as possible, and
+read latency percentiles over its first couple of seconds sent at the
+recorded pace.
+
+Run with `python -m benchmarks.irc_replay [recording]`, where recording is a
+file saved by TrafficRecording.Save(). Synthetic traffic built from the
+sample lines is used if none is given.
+"""
+
+import asyncio
+import sys
+import time
+from typing import List, Optional
+
+from minibot_server import irc
+from minibot_server.testing.irc import ReplayIrcServer, TrafficRecording
+
+from .samples import ChatLog
+
+_LATENCY_SECONDS = 2.0
+
+
+async def _ReadAll(recording: TrafficRecording, speed: Optional[float]) -> List[float]:
+    """Replays the recording into an IrcClientChannel, and returns the
+    latency of each line read.
+    """
+    server = ReplayIrcServer(recording, speed=speed)
+    port = await server.Start()
+    client = await irc.IrcClientChannel.Connect('127.0.0.1', port, ssl=False)
+    received_at = []  # type: List[float]
+    while True:
+        batch = await client.ReadBatch()
+        if batch is None:
+            break
+        received_at.extend([time.perf_counter()] * len(batch))
+    client.CloseWrite()
+    await client.WaitForExit()
+    await server.WaitReplayed()
+    server.Stop()
+    # Every line of the recording is expected to parse to one message.
+    assert len(received_at) == len(server.sent_at), (len(received_at), len(server.sent_at))
+    return [received - sent for (received, sent) in zip(received_at, server.sent_at)]
+
+
+def _Percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        recording = TrafficRecording.Load(sys.argv[1])
+    else:
+        recording = TrafficRecording.Synthetic(ChatLog(100000), rate=5000)
+
+    start = time.perf_counter()
+    asyncio.run(_ReadAll(recording, None))
+    elapsed = time.perf_counter() - start
+    print(f"Replay as fast as possible: {len(recording.entries) / elapsed:12,.0f} lines/sec")
+
+    # A couple of seconds at the recorded pace is enough for stable percentiles.
+    head = TrafficRecording()
+    head.entries = [entry for entry in recording.entries if entry[0] < _LATENCY_SECONDS]
+    latencies = sorted(asyncio.run(_ReadAll(head, 1.0)))
+    rate = len(head.entries) / _LATENCY_SECONDS
+    print(f"Read latency at {rate:,.0f} lines/sec:")
+    for (name, fraction) in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+        print(f"  {name}: {_Percentile(latencies, fraction) * 1e6:10,.0f} us")
+
+
+if __name__ == '__main__':
+    main()
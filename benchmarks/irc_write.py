@@ -0,0 +1,51 @@
+"""Throughput benchmark for IrcClientChannel writes.
+
+Sends chat messages to a local TCP stand-in server as fast as the channel's
+flow control allows, and reports messages/sec received by the server.
+
+Run with `python -m benchmarks.irc_write`.
+"""
+
+import asyncio
+import time
+
+from minibot_server import irc
+
+_NUM_MESSAGES = 100000
+
+
+async def MessagesPerSecond(num_messages: int) -> float:
+    received = asyncio.get_event_loop().create_future()  # type: asyncio.Future[float]
+
+    async def OnConnect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        num_lines = 0
+        while True:
+            data = await reader.read(1 << 16)
+            if not data:
+                break
+            num_lines += data.count(b'\r\n')
+        received.set_result(time.perf_counter())
+        assert num_lines == num_messages, num_lines
+        writer.close()
+
+    server = await asyncio.start_server(OnConnect, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    client = await irc.IrcClientChannel.Connect('127.0.0.1', port, ssl=False)
+    message = irc.Message(b'PRIVMSG', b'#somestreamer', b'Thanks for the follow, have a great stream!')
+    start = time.perf_counter()
+    for _ in range(num_messages):
+        await client.Write(message)
+    client.CloseWrite()
+    end = await received
+    await client.WaitForExit()
+    server.close()
+    return num_messages / (end - start)
+
+
+def main() -> None:
+    rate = asyncio.run(MessagesPerSecond(_NUM_MESSAGES))
+    print(f"IrcClientChannel.Write: {rate:12,.0f} messages/sec")
+
+
+if __name__ == '__main__':
+    main()
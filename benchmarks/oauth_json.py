@@ -0,0 +1,48 @@
+"""Parsing and serializing OAuth token responses, with serde and with
+json_models.
+
+Run with `python -m benchmarks.oauth_json`.
+"""
+
+import json
+import time
+from typing import Any, Callable
+
+from minibot_server import oauth
+
+_RESPONSE = json.dumps({
+    'access_token': 'rfx2uswqe8l4g1mkagrvg5tv0ks3',
+    'refresh_token': '5b93chm6hdve3mycz05zfzatkfdenfspp1h1ar2xxdalen01',
+    'expires_in': 14124,
+    'scopes': ['openid', 'user:edit'],
+}).encode()
+
+
+def CallsPerSecond(call: Callable[[], Any], count: int = 20000, rounds: int = 5) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(count):
+            call()
+        best = min(best, time.perf_counter() - start)
+    return count / best
+
+
+def main() -> None:
+    serde_parser = oauth.SerdeJsonResponseParser(oauth.CodeExchangeResponse)
+    fast_parser = oauth.JsonModelResponseParser(oauth.CodeExchangeRecord)
+    serde = CallsPerSecond(lambda: serde_parser.ParseResponseBody('application/json', _RESPONSE))
+    fast = CallsPerSecond(lambda: fast_parser.ParseResponseBody('application/json', _RESPONSE))
+    print(f"Parse, serde:       {serde:12,.0f} responses/sec")
+    print(f"Parse, json_models: {fast:12,.0f} responses/sec ({fast / serde:.1f}x)")
+
+    serde_value = serde_parser.ParseResponseBody('application/json', _RESPONSE)
+    fast_value = fast_parser.ParseResponseBody('application/json', _RESPONSE)
+    serde = CallsPerSecond(lambda: oauth.SerdeJsonRequest(serde_value))
+    fast = CallsPerSecond(lambda: oauth.JsonModelRequest(fast_value))
+    print(f"Serialize, serde:       {serde:12,.0f} bodies/sec")
+    print(f"Serialize, json_models: {fast:12,.0f} bodies/sec ({fast / serde:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
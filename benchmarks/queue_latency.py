@@ -0,0 +1,143 @@
+"""Latency benchmark for async_util.CloseableQueue.
+
+Compares a producer/consumer round trip through the queue against the
+original asyncio.Queue based CloseableQueue from irc.py.
+
+Run with `python -m benchmarks.queue_latency`.
+"""
+
+import asyncio
+import time
+import typing
+from typing import Any, List, Optional
+
+from minibot_server.async_util import CloseableQueue
+
+_T = typing.TypeVar("_T")
+
+
+class _LegacyCloseableQueue(typing.Generic[_T]):
+    _inner_queue: "asyncio.Queue[_T]"
+    _close_event: asyncio.Event
+    _empty_event: asyncio.Event
+
+    def __init__(self, maxsize: int = 0):
+        self._inner_queue = asyncio.Queue(maxsize)
+        self._close_event = asyncio.Event()
+        self._empty_event = asyncio.Event()
+
+    async def Get(self) -> Optional[_T]:
+        if not self._close_event.is_set():
+            async def closing() -> None:
+                await self._close_event.wait()
+                return None
+            for f in asyncio.as_completed((self._inner_queue.get(), closing())):
+                value = await f
+                if value is not None:
+                    # self._inner_queue.task_done()
+                    return value
+                else:
+                    if not self._close_event.is_set():
+                        raise RuntimeError(
+                            "Close event should be set on a none value")
+                    # We're closed
+                    break
+        if not self._inner_queue.empty():
+            value = self._inner_queue.get_nowait()
+            if self._inner_queue.empty():
+                self._empty_event.set()
+            if value is True:
+                raise ValueError()
+            return value
+        return None
+
+    async def GetMany(self, max_n: int) -> Optional[List[_T]]:
+        """Waits for a value, then returns it along with any others available,
+        up to max_n values in all. Returns None once closed and empty.
+        """
+        value = await self.Get()
+        if value is None:
+            return None
+        values = [value]
+        while len(values) < max_n and not self._inner_queue.empty():
+            values.append(self._inner_queue.get_nowait())
+        if self._close_event.is_set() and self._inner_queue.empty():
+            self._empty_event.set()
+        return values
+
+    async def Put(self, val: _T) -> None:
+        if self._close_event.is_set():
+            raise RuntimeError()
+        await self._inner_queue.put(val)
+
+    def PutNowait(self, val: _T) -> None:
+        """Puts a value without waiting, raising asyncio.QueueFull if there is
+        no room for it.
+        """
+        if self._close_event.is_set():
+            raise RuntimeError()
+        self._inner_queue.put_nowait(val)
+
+    def Close(self) -> None:
+        self._close_event.set()
+        if self._inner_queue.empty():
+            self._empty_event.set()
+
+    async def WaitUntilEmpty(self) -> None:
+        await self._empty_event.wait()
+
+
+_NUM_VALUES = 20000
+
+
+async def RoundTripMicros(queue: Any) -> List[float]:
+    """Returns the latency of each value from Put() to Get() returning it."""
+    latencies = []  # type: List[float]
+
+    async def Consumer() -> None:
+        while True:
+            sent = await queue.Get()
+            if sent is None:
+                break
+            latencies.append((time.perf_counter() - sent) * 1e6)
+
+    consumer = asyncio.ensure_future(Consumer())
+    for _ in range(_NUM_VALUES):
+        await queue.Put(time.perf_counter())
+        # Let the consumer take each value before sending the next.
+        await asyncio.sleep(0)
+    queue.Close()
+    await consumer
+    return latencies
+
+
+async def ThroughputPerSecond(queue: Any) -> float:
+    async def Consumer() -> None:
+        while await queue.Get() is not None:
+            pass
+
+    start = time.perf_counter()
+    consumer = asyncio.ensure_future(Consumer())
+    for value in range(_NUM_VALUES):
+        await queue.Put(value)
+    queue.Close()
+    await consumer
+    return _NUM_VALUES / (time.perf_counter() - start)
+
+
+async def Run() -> None:
+    for (name, queue_type) in (('original', _LegacyCloseableQueue), ('CloseableQueue', CloseableQueue)):
+        latencies = sorted(await RoundTripMicros(queue_type(10)))
+        median = latencies[len(latencies) // 2]
+        p99 = latencies[int(len(latencies) * 0.99)]
+        throughput = await ThroughputPerSecond(queue_type(10))
+        print(f"{name:>14}: round trip p50 {median:6.1f}us, p99 {p99:6.1f}us, "
+              f"{throughput:10,.0f} values/sec through a 10 value queue")
+
+
+def main() -> None:
+    asyncio.run(Run())
+
+
+if __name__ == '__main__':
+    main()
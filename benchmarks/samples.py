@@ -0,0 +1,35 @@
+"""Sample Twitch IRC traffic shared by the benchmarks."""
+
+from typing import List
+
+# Lines as received from irc.chat.twitch.tv with the membership, tags and
+# commands capabilities enabled, less their trailing CRLF.
+TWITCH_LINES = [
+    b'@badge-info=subscriber/8;badges=subscriber/6,premium/1;client-nonce=4c7e5b2b1f6d3a0e9b8c7d6e5f4a3b2c;'
+    b'color=#1E90FF;display-name=SomeViewer;emotes=25:0-4,12-16/1902:6-10;first-msg=0;flags=;'
+    b'id=b34ccfc7-4977-403a-8a94-33c6bac34fb8;mod=0;returning-chatter=0;room-id=71092938;subscriber=1;'
+    b'tmi-sent-ts=1595016186000;turbo=0;user-id=152453921;user-type= '
+    b':someviewer!someviewer@someviewer.tmi.twitch.tv PRIVMSG #somestreamer :Kappa Keepo Kappa',
+    b'@badge-info=;badges=moderator/1;color=;display-name=ModBot;emotes=;first-msg=0;flags=;'
+    b'id=7b9e1c4a-2f0d-4d3e-9a6b-8c5d4e3f2a1b;mod=1;returning-chatter=0;room-id=71092938;subscriber=0;'
+    b'tmi-sent-ts=1595016186512;turbo=0;user-id=237719657;user-type=mod '
+    b':modbot!modbot@modbot.tmi.twitch.tv PRIVMSG #somestreamer :Please keep chat friendly; thanks!',
+    b'@badge-info=subscriber/24;badges=subscriber/24,bits/1000;color=#FF4500;display-name=LongTimeFan;'
+    b'emotes=;flags=;id=5d3c2b1a-0f9e-4d8c-b7a6-958473625140;login=longtimefan;mod=0;msg-id=resub;'
+    b'msg-param-cumulative-months=24;msg-param-months=0;msg-param-should-share-streak=1;'
+    b'msg-param-streak-months=24;msg-param-sub-plan-name=Channel\\sSubscription\\s(somestreamer);'
+    b'msg-param-sub-plan=1000;msg-param-was-gifted=false;room-id=71092938;subscriber=1;'
+    b'system-msg=LongTimeFan\\ssubscribed\\sat\\sTier\\s1.\\sThey\'ve\\ssubscribed\\sfor\\s24\\smonths!;'
+    b'tmi-sent-ts=1595016187001;user-id=49106753;user-type= '
+    b':tmi.twitch.tv USERNOTICE #somestreamer :Two years already, wow',
+    b':newviewer!newviewer@newviewer.tmi.twitch.tv JOIN #somestreamer',
+    b':oldviewer!oldviewer@oldviewer.tmi.twitch.tv PART #somestreamer',
+    b'@ban-duration=600;room-id=71092938;target-user-id=98765432;tmi-sent-ts=1595016188234 '
+    b':tmi.twitch.tv CLEARCHAT #somestreamer :spammer',
+    b'PING :tmi.twitch.tv',
+]
+
+
+def ChatLog(count: int) -> List[bytes]:
+    """Returns count lines cycling through TWITCH_LINES."""
+    return [TWITCH_LINES[i % len(TWITCH_LINES)] for i in range(count)]
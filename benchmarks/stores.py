@@ -0,0 +1,103 @@
+"""Lookup and write throughput of the in-memory and SQLite backed stores.
+
+Run with `python -m benchmarks.stores`.
+"""
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from minibot_server import oauth, tokens, users
+from minibot_server.testing import oauth as oauth_testing
+from minibot_server.http_client import HttpClient
+
+_TOKENS = 20000
+_USERS = 5000
+_LOOKUPS = 50000
+
+
+async def TokenStoreRates(path: str) -> None:
+    memory = tokens.TokenStore()
+    start = time.perf_counter()
+    for i in range(_TOKENS):
+        memory.CreateToken(users.UserId(i % 1000), oauth.Timestamp(0))
+    print(f"TokenStore writes:         {_TOKENS / (time.perf_counter() - start):12,.0f}/sec")
+
+    hasher = tokens.TokenHasher()
+    store = tokens.SqliteTokenStore(path, hasher)
+    start = time.perf_counter()
+    created = [store.CreateToken(users.UserId(i % 1000), oauth.Timestamp(0)) for i in range(_TOKENS)]
+    await store.Flush()
+    elapsed = time.perf_counter() - start
+    stats = store.WriteStats()
+    print(f"SqliteTokenStore writes:   {_TOKENS / elapsed:12,.0f}/sec "
+          f"(committed in {stats.batches} batches)")
+
+    # As if each write came from its own request, with the event loop
+    # running in between.
+    start = time.perf_counter()
+    for i in range(_TOKENS):
+        store.CreateToken(users.UserId(i % 1000), oauth.Timestamp(0))
+        await asyncio.sleep(0)
+    await store.Flush()
+    elapsed = time.perf_counter() - start
+    batches = store.WriteStats().batches - stats.batches
+    print(f"  interleaved:             {_TOKENS / elapsed:12,.0f}/sec "
+          f"(committed in {batches} batches)")
+    await store.Close()
+
+    # Reopened, so that every lookup reads the database.
+    store = tokens.SqliteTokenStore(path, hasher)
+    lookups = [random.choice(created)[0] for _ in range(_LOOKUPS)]
+    start = time.perf_counter()
+    for secret in lookups:
+        store.FindToken(secret, oauth.Timestamp(0))
+    print(f"SqliteTokenStore lookups:  {_LOOKUPS / (time.perf_counter() - start):12,.0f}/sec")
+    start = time.perf_counter()
+    for i in range(_LOOKUPS // 10):
+        store.FindUserTokens(users.UserId(i % 1000))
+    print(f"  by user:                 {_LOOKUPS // 10 / (time.perf_counter() - start):12,.0f}/sec")
+
+    # Large enough for every token, and warmed up with one pass.
+    cached = tokens.CachedTokenStore(store, capacity=2 * _TOKENS)
+    for secret in lookups:
+        cached.FindToken(secret, oauth.Timestamp(0))
+    start = time.perf_counter()
+    for secret in lookups:
+        cached.FindToken(secret, oauth.Timestamp(0))
+    print(f"CachedTokenStore lookups:  {_LOOKUPS / (time.perf_counter() - start):12,.0f}/sec")
+    await store.Close()
+
+
+async def UserStoreRates(path: str) -> None:
+    provider = oauth_testing.FakeOAuthProvider(HttpClient())
+    twitch_users = [users.TwitchUser(str(i), provider.IssueToken(oauth.Timestamp(0)))
+                    for i in range(_USERS)]
+    store = users.SqliteUserStore(path)
+    start = time.perf_counter()
+    for twitch_user in twitch_users:
+        store.CreateUser(oauth.Timestamp(0), twitch_user)
+    await store.Flush()
+    print(f"SqliteUserStore writes:    {_USERS / (time.perf_counter() - start):12,.0f}/sec")
+    await store.Close()
+
+    store = users.SqliteUserStore(path)
+    twitch_ids = [str(random.randrange(_USERS)) for _ in range(_LOOKUPS)]
+    start = time.perf_counter()
+    for twitch_id in twitch_ids:
+        store.GetUserByTwitchId(twitch_id)
+    print(f"SqliteUserStore lookups:   {_LOOKUPS / (time.perf_counter() - start):12,.0f}/sec "
+          "(each user loaded once)")
+    await store.Close()
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        asyncio.run(TokenStoreRates(os.path.join(tempdir, 'tokens.db')))
+        asyncio.run(UserStoreRates(os.path.join(tempdir, 'users.db')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Token lookups keyed by secret, as TokenStore used to be, against
+TokenStore's lookups keyed by the hash of the secret, and the cost of
+sweeping expired tokens.
+
+Keying by hash is several times slower than a plain dict lookup, and
+nearly all of the difference is the keyed BLAKE2s hash of the secret, a
+microsecond or so per lookup. That is the price of the store never
+holding the secrets themselves, and it is paid once per lookup: callers
+that have the id use FindTokenById(), and CachedTokenStore hands the id it
+computed on to the store behind it. No cache can sit in front of the hash
+without holding secrets again.
+
+Run with `python -m benchmarks.token_index`.
+"""
+
+import random
+import secrets
+import time
+from typing import Callable, Dict, List
+
+from minibot_server import oauth, tokens, users
+
+_TOKENS = 100000
+_LOOKUPS = 200000
+
+
+def LookupsPerSecond(find: Callable[[tokens.TokenSecret], object],
+                     lookups: List[tokens.TokenSecret], rounds: int = 5) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for secret in lookups:
+            find(secret)
+        best = min(best, time.perf_counter() - start)
+    return len(lookups) / best
+
+
+def SweepTime(live: int, expired: int) -> float:
+    """Returns the seconds taken to sweep the expired tokens from a store that
+    also has live tokens.
+    """
+    store = tokens.TokenStore()
+    for i in range(live + expired):
+        store.CreateToken(users.UserId(i % 1000), oauth.Timestamp(0),
+                          ttl=10 if i < expired else random.randrange(100, 1000))
+    start = time.perf_counter()
+    while store.Sweep(oauth.Timestamp(50), 100):
+        pass
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    store = tokens.TokenStore()
+    created = [store.CreateToken(users.UserId(i % 1000), oauth.Timestamp(0))
+               for i in range(_TOKENS)]
+    by_secret = {secret: token for (secret, token) in created}  # type: Dict[tokens.TokenSecret, tokens.Token]
+
+    # Half real tokens, half guesses.
+    lookups = [random.choice(created)[0] for _ in range(_LOOKUPS // 2)]
+    lookups += [tokens.TokenSecret(secrets.token_urlsafe(30)) for _ in range(_LOOKUPS // 2)]
+    random.shuffle(lookups)
+
+    baseline = LookupsPerSecond(by_secret.get, lookups)
+    print(f"Keyed by secret:           {baseline:12,.0f}/sec")
+    now = oauth.Timestamp(0)
+    rate = LookupsPerSecond(lambda secret: store.FindToken(secret, now), lookups)
+    print(f"Keyed by hash:             {rate:12,.0f}/sec ({rate / baseline:.2f}x)")
+    hash_rate = LookupsPerSecond(store.IdFor, lookups)
+    print(f"  hashing alone:           {hash_rate:12,.0f}/sec")
+    print(f"  cost per lookup:         {(1 / rate - 1 / baseline) * 1e6:12.2f}us")
+
+    for live in (10000, 1000000):
+        elapsed = SweepTime(live, 1000)
+        print(f"Sweeping 1000 of {live + 1000:,} tokens: {elapsed * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
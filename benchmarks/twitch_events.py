@@ -0,0 +1,68 @@
+"""Throughput benchmark for twitch_events.DecodeEvent.
+
+Run with `python -m benchmarks.twitch_events`.
+"""
+
+import time
+from typing import List
+
+from minibot_server import irc, twitch_events
+
+from .samples import ChatLog
+
+
+def EventsPerSecond(lines: List[bytes], rounds: int = 5) -> float:
+    """Returns the lines per second parsed and decoded into events."""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for line in lines:
+            twitch_events.DecodeEvent(irc.Message.Parse(line))
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def FilteredEventsPerSecond(lines: List[bytes], registry: twitch_events.SubscriptionRegistry,
+                            rounds: int = 5) -> float:
+    """Returns the lines per second run through the registry's line filter,
+    and parsed and decoded if accepted.
+    """
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for line in lines:
+            if registry.AcceptLine(line):
+                twitch_events.DecodeEvent(irc.Message.Parse(line))
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def DecodesPerSecond(messages: List[irc.Message], rounds: int = 5) -> float:
+    """Returns the already parsed messages per second decoded into events."""
+    best = float('inf')
+    for _ in range(rounds):
+        # Fresh messages each round, since tags are decoded lazily and kept.
+        fresh = [irc.Message.Parse(msg.ToWireFormat()) for msg in messages]
+        start = time.perf_counter()
+        for msg in fresh:
+            twitch_events.DecodeEvent(msg)
+        best = min(best, time.perf_counter() - start)
+    return len(messages) / best
+
+
+def main() -> None:
+    lines = ChatLog(20000)
+    unfiltered = EventsPerSecond(lines)
+    print(f"Parse + DecodeEvent: {unfiltered:12,.0f} lines/sec")
+    registry = twitch_events.SubscriptionRegistry()
+    registry.Listen(1, 'somestreamer', ['user_subscribe', 'user_subscribe_notify', 'gift_subscribe',
+                                         'mystery_gift'])
+    filtered = FilteredEventsPerSecond(lines, registry)
+    print(f"Filtered to subs:    {filtered:12,.0f} lines/sec ({filtered / unfiltered:.2f}x)")
+    print(f"  {registry.lines_filtered:,} lines filtered, {registry.lines_accepted:,} decoded")
+    messages = [irc.Message.Parse(line) for line in lines]
+    print(f"DecodeEvent only:    {DecodesPerSecond(messages):12,.0f} messages/sec")
+
+
+if __name__ == '__main__':
+    main()
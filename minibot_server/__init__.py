@@ -1,35 +1,42 @@
-from .oauth import (AccountCreationManager, OAuthCallbackManager, OAuthClientInfo, TWITCH_PROVIDER, OAuthProvider, OAuthProviderImpl)
+from .oauth import (OAuthCallbackManager, OAuthClientInfo, TWITCH_PROVIDER, OAuthProvider, OAuthProviderImpl)
 
 from tornado import web, ioloop, httpclient, escape
 import asyncio
 
 from .config import (ReadConfig, MinibotConfig)
 from . import app
+from .http_client import HttpClient
+from .oauth_state import StateSigner
 
-from typing import Awaitable
+from typing import Awaitable, Optional
 
-def MakeRealOAuthProvider(config: MinibotConfig) -> OAuthProvider:
+def MakeRealOAuthProvider(config: MinibotConfig, http_client: HttpClient) -> OAuthProvider:
     config = ReadConfig()
     client_info = OAuthClientInfo(
         client_id = config.config_doc.twitch_client_id,
         client_secret = config.secret_doc.twitch_client_secret,
         redirect_url = config.config_doc.twitch_redirect_url,
     )
-    return OAuthProviderImpl(client_info, TWITCH_PROVIDER)
+    return OAuthProviderImpl(client_info, TWITCH_PROVIDER, http_client)
+
+def MakeStateSigner(config: MinibotConfig) -> Optional[StateSigner]:
+    key = config.secret_doc.oauth_state_key
+    return None if key is None else StateSigner(key.encode('utf-8'))
 
 async def TestAccountCreateExchange() -> None:
     config = ReadConfig()
-    provider = MakeRealOAuthProvider(config)
-    http_app = app.CreateApp(provider)
+    # Shared by everything that makes HTTP requests.
+    http_client = HttpClient()
+    provider = MakeRealOAuthProvider(config, http_client)
+    http_app = app.CreateApp(provider, signer=MakeStateSigner(config))
     http_app.listen(8080)
-    client = httpclient.AsyncHTTPClient()
     async def inner() -> None:
-        first_response = await client.fetch("http://localhost:8080/account/create", method = "POST", body = "")
+        first_response = await http_client.Fetch(httpclient.HTTPRequest("http://localhost:8080/account/create", method = "POST", body = ""))
         response_body = escape.json_decode(first_response.body)
         state_token = response_body['state_token']
         url = response_body['auth_url']
         print("Go to Authorization URL: {}".format(url))
-        second_response = await client.fetch("http://localhost:8080/account/complete?state_token={}".format(state_token), method = "POST", body = "")
+        second_response = await http_client.Fetch(httpclient.HTTPRequest("http://localhost:8080/account/complete?state_token={}".format(state_token), method = "POST", body = ""))
         response_body = escape.json_decode(second_response.body)
         print("Response body: {}".format(response_body))
 
@@ -1,12 +1,11 @@
 """The primary Tornado application"""
 
 from tornado import web
-import asyncio
-import secrets
 import logging
 import time
+from typing import Optional
 
-from . import oauth
+from . import oauth, oauth_state
 
 LOG = logging.Logger(__name__)
 
@@ -16,37 +15,41 @@ class OAuthRedirectHandler(web.RequestHandler):
     def initialize(self, callback_manager: oauth.OAuthCallbackManager) -> None:
         self._callback_manager = callback_manager
 
-    def get(self) -> None:
+    async def get(self) -> None:
         state = self.get_argument('state')
         code = self.get_argument('code')
-        asyncio.create_task(self._callback_manager.complete(state, code))
+        try:
+            await self._callback_manager.complete(state, code)
+        except oauth.UnknownStateError:
+            # Forged, expired, or replayed.
+            raise web.HTTPError(400)
 
 class StartAccountCreateHandler(web.RequestHandler):
     _callback_manager: oauth.OAuthCallbackManager
-    _creation_manager: oauth.AccountCreationManager
 
-    def initialize(self, callback_manager: oauth.OAuthCallbackManager, creation_manager: oauth.AccountCreationManager) -> None:
+    def initialize(self, callback_manager: oauth.OAuthCallbackManager) -> None:
         self._callback_manager = callback_manager
-        self._creation_manager = creation_manager
 
-    async def post(self) -> None:
-        token = secrets.token_urlsafe(30)
-        (url, callback) = await self._callback_manager.start_auth()
-        await self._creation_manager.add_creation(token, callback)
+    def post(self) -> None:
+        (token, url) = self._callback_manager.start_flow()
         self.write({
             'state_token': token,
             'auth_url': url,
         })
 
 class CompleteAccountCreateHandler(web.RequestHandler):
-    _creation_manager: oauth.AccountCreationManager
+    _callback_manager: oauth.OAuthCallbackManager
 
-    def initialize(self, creation_manager: oauth.AccountCreationManager) -> None:
-        self._creation_manager = creation_manager
+    def initialize(self, callback_manager: oauth.OAuthCallbackManager) -> None:
+        self._callback_manager = callback_manager
 
     async def post(self) -> None:
         state_token = self.get_argument('state_token')
-        result = await self._creation_manager.wait_result(state_token)
+        try:
+            result = await self._callback_manager.wait_result(state_token)
+        except oauth.UnknownStateError:
+            # Forged, expired, or already completed.
+            raise web.HTTPError(404)
         LOG.error(result)
         token = result.TryGet(oauth.Timestamp(int(time.time())))
         assert token is not None
@@ -61,12 +64,17 @@ class HelloWorldHandler(web.RequestHandler):
             self.write("Hello, World!")
         self.finish()
 
-def CreateApp(provider: oauth.OAuthProvider) -> web.Application:
-    """Creates the minibot server application."""
-    callbacks = oauth.OAuthCallbackManager(provider)
-    creations = oauth.AccountCreationManager()
+def CreateApp(provider: oauth.OAuthProvider, *,
+              signer: Optional[oauth_state.StateSigner] = None,
+              results: Optional[oauth_state.ResultHandoff] = None) -> web.Application:
+    """Creates the minibot server application.
+
+    Replicas given the same signer key and results store can each serve any
+    step of account creation.
+    """
+    callbacks = oauth.OAuthCallbackManager(provider, signer=signer, results=results)
     return web.Application([
         (r'/callback', OAuthRedirectHandler, dict(callback_manager=callbacks)),
-        (r'/account/create', StartAccountCreateHandler, dict(callback_manager=callbacks, creation_manager=creations)),
-        (r'/account/complete', CompleteAccountCreateHandler, dict(creation_manager=creations)),
+        (r'/account/create', StartAccountCreateHandler, dict(callback_manager=callbacks)),
+        (r'/account/complete', CompleteAccountCreateHandler, dict(callback_manager=callbacks)),
     ])
\ No newline at end of file
@@ -1,9 +1,14 @@
 import asyncio
+import collections
+import heapq
+import itertools
 
-from typing import Generic, TypeVar, Optional, Awaitable, Generator, cast, Callable, Dict, Tuple
+from typing import Generic, TypeVar, Optional, Awaitable, Generator, cast, Callable, Dict, Tuple, Deque, List
 
 import secrets
 
+import attr
+
 T = TypeVar("T")
 
 class Error(BaseException):
@@ -40,17 +45,320 @@ class OneShot(Generic[T]):
             raise asyncio.CancelledError()
         return cast(T, self.value)
 
+@attr.s(auto_attribs=True)
+class PendingStats:
+    size: int = 0
+    added: int = 0
+    # Entries taken out with Pop().
+    removed: int = 0
+    # Entries dropped because their time ran out.
+    expired: int = 0
+    # Entries dropped early to make room for new ones.
+    evicted: int = 0
+
+
+class PendingStore(Generic[T]):
+    """Values kept by key until they are popped, or until their time to live
+    runs out.
+
+    Meant for the state of flows that wait on something outside our control,
+    such as a user finishing an OAuth flow, which may never happen. The store
+    holds at most capacity entries. When full, adding an entry evicts the one
+    closest to expiring. Expired, evicted and replaced values are passed to
+    on_drop, which can cancel anything still waiting on them.
+
+    Deadlines are kept in a heap, with a single timer for the earliest one.
+    Entries popped or replaced before their deadline leave stale heap entries
+    behind, which are skipped when they reach the top.
+    """
+    _ttl: float
+    _capacity: int
+    _on_drop: Optional[Callable[[T], None]]
+    # Key to (sequence number, value).
+    _entries: Dict[str, Tuple[int, T]]
+    _deadlines: List[Tuple[float, int, str]]
+    _counter: "itertools.count[int]"
+    _timer: Optional[asyncio.TimerHandle]
+    _timer_deadline: Optional[float]
+    _stats: PendingStats
+
+    def __init__(self, *, ttl: float, capacity: int, on_drop: Optional[Callable[[T], None]] = None):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self._ttl = ttl
+        self._capacity = capacity
+        self._on_drop = on_drop
+        self._entries = {}
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+        self._stats = PendingStats()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def Put(self, key: str, value: T, ttl: Optional[float] = None) -> None:
+        """Adds an entry that expires after ttl seconds, or the store's time
+        to live if not given. Replaces any entry with the same key.
+        """
+        loop = asyncio.get_event_loop()
+        self._Expire(loop.time())
+        replaced = self._entries.pop(key, None)
+        if replaced is not None and replaced[1] is not value and self._on_drop is not None:
+            self._on_drop(replaced[1])
+        while len(self._entries) >= self._capacity:
+            if self._Drop(heapq.heappop(self._deadlines)):
+                self._stats.evicted += 1
+        sequence_number = next(self._counter)
+        deadline = loop.time() + (self._ttl if ttl is None else ttl)
+        self._entries[key] = (sequence_number, value)
+        heapq.heappush(self._deadlines, (deadline, sequence_number, key))
+        self._stats.added += 1
+        self._ScheduleTimer()
+
+    def Get(self, key: str) -> Optional[T]:
+        entry = self._entries.get(key)
+        return None if entry is None else entry[1]
+
+    def Pop(self, key: str) -> Optional[T]:
+        """Removes and returns the entry for key, or None if there is none."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._stats.removed += 1
+        if len(self._deadlines) > 2 * len(self._entries) + 64:
+            # Don't let stale heap entries pile up when most entries are
+            # popped well before they expire.
+            self._deadlines = [entry for entry in self._deadlines if self._IsLive(entry)]
+            heapq.heapify(self._deadlines)
+        return entry[1]
+
+    def Clear(self) -> None:
+        """Drops every entry, passing each to on_drop."""
+        while self._deadlines:
+            self._Drop(heapq.heappop(self._deadlines))
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_deadline = None
+
+    def Stats(self) -> PendingStats:
+        return attr.evolve(self._stats, size=len(self._entries))
+
+    def _IsLive(self, heap_entry: Tuple[float, int, str]) -> bool:
+        (_, sequence_number, key) = heap_entry
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] == sequence_number
+
+    def _Drop(self, heap_entry: Tuple[float, int, str]) -> bool:
+        """Drops the entry a popped heap entry is for, if it is still live."""
+        if not self._IsLive(heap_entry):
+            return False
+        (_, value) = self._entries.pop(heap_entry[2])
+        if self._on_drop is not None:
+            self._on_drop(value)
+        return True
+
+    def _Expire(self, now: float) -> None:
+        deadlines = self._deadlines
+        while deadlines and (deadlines[0][0] <= now or not self._IsLive(deadlines[0])):
+            if self._Drop(heapq.heappop(deadlines)):
+                self._stats.expired += 1
+
+    def _ScheduleTimer(self) -> None:
+        deadline = self._deadlines[0][0] if self._deadlines else None
+        if deadline == self._timer_deadline:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_deadline = deadline
+        if deadline is not None:
+            self._timer = asyncio.get_event_loop().call_at(deadline, self._OnTimer)
+
+    def _OnTimer(self) -> None:
+        self._timer = None
+        self._timer_deadline = None
+        self._Expire(asyncio.get_event_loop().time())
+        self._ScheduleTimer()
+
+
 class CallbackSet(Generic[T]):
-    callbacks: Dict[str, OneShot[T]]
+    """One-shot callbacks identified by random nonces, which are cancelled if
+    not sent within ttl seconds.
+    """
+    callbacks: PendingStore[OneShot[T]]
+
+    def __init__(self, *, ttl: float = 600.0, capacity: int = 10000):
+        self.callbacks = PendingStore(ttl=ttl, capacity=capacity, on_drop=OneShot.Cancel)
 
     def MakeCallback(self) -> Tuple[str, Awaitable[T]]:
         oneshot = OneShot() # type: OneShot[T]
         nonce = secrets.token_urlsafe(30)
 
-        self.callbacks[nonce] = oneshot
+        self.callbacks.Put(nonce, oneshot)
 
         return (nonce, oneshot.Wait())
 
     def SendCallback(self, nonce: str, value: T) -> None:
-        self.callbacks[nonce].Send(value)
-        del self.callbacks[nonce]
+        oneshot = self.callbacks.Pop(nonce)
+        if oneshot is None:
+            raise KeyError(nonce)
+        oneshot.Send(value)
+
+
+class QueueClosedError(RuntimeError):
+    """Raised when putting a value into a closed CloseableQueue."""
+    pass
+
+class CloseableQueue(Generic[T]):
+    """A FIFO queue for passing values between coroutines that can be closed.
+
+    Once closed, no more values can be put into the queue. Getters receive the
+    values that were already put, then None.
+
+    Values are kept in a deque, and only coroutines that actually have to wait
+    allocate a future to wait on. Blocked putters wait in line with their
+    values, which are moved into the queue in order as room frees up, so
+    PutNowait() never jumps ahead of them.
+    """
+    _values: Deque[T]
+    _maxsize: int
+    _closed: bool
+    _getters: Deque["asyncio.Future[None]"]
+    _putters: Deque[Tuple[T, "asyncio.Future[None]"]]
+    _empty_event: asyncio.Event
+
+    def __init__(self, maxsize: int = 0):
+        self._values = collections.deque()
+        self._maxsize = maxsize
+        self._closed = False
+        self._getters = collections.deque()
+        self._putters = collections.deque()
+        self._empty_event = asyncio.Event()
+
+    def _IsFull(self) -> bool:
+        return 0 < self._maxsize <= len(self._values)
+
+    def _WakeGetter(self) -> None:
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                return
+
+    def _AfterGet(self) -> None:
+        """Moves blocked putters' values into room freed by a get."""
+        while self._putters and not self._IsFull():
+            (value, putter) = self._putters.popleft()
+            if putter.done():
+                # Cancelled; its caller saw the put fail.
+                continue
+            self._values.append(value)
+            putter.set_result(None)
+            self._WakeGetter()
+        if self._closed and not self._values:
+            self._empty_event.set()
+
+    async def _WaitForValue(self) -> bool:
+        """Waits until there is a value to get. Returns False if the queue is
+        closed and has no more values.
+        """
+        while not self._values:
+            if self._closed:
+                return False
+            getter = asyncio.get_event_loop().create_future()  # type: asyncio.Future[None]
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                if getter.done() and not getter.cancelled():
+                    # We were woken for a value we won't take, so pass it on.
+                    self._WakeGetter()
+                else:
+                    try:
+                        self._getters.remove(getter)
+                    except ValueError:
+                        pass
+                raise
+        return True
+
+    async def Get(self) -> Optional[T]:
+        """Returns the next value, waiting for one if needed. Returns None once
+        the queue is closed and empty.
+        """
+        if not self._values and not await self._WaitForValue():
+            return None
+        value = self._values.popleft()
+        self._AfterGet()
+        return value
+
+    async def GetMany(self, max_n: int) -> Optional[List[T]]:
+        """Waits for a value, then returns it along with any others available,
+        up to max_n values in all. Returns None once closed and empty.
+        """
+        if not self._values and not await self._WaitForValue():
+            return None
+        values = self._values
+        if len(values) <= max_n:
+            result = list(values)
+            values.clear()
+        else:
+            result = [values.popleft() for _ in range(max_n)]
+        self._AfterGet()
+        return result
+
+    async def Put(self, val: T) -> None:
+        """Puts a value, waiting in line for room if the queue is full."""
+        if self._closed:
+            raise QueueClosedError()
+        if not self._putters and not self._IsFull():
+            self._PutValue(val)
+            return
+        putter = asyncio.get_event_loop().create_future()  # type: asyncio.Future[None]
+        self._putters.append((val, putter))
+        try:
+            await putter
+        except asyncio.CancelledError:
+            if not putter.done() or putter.cancelled():
+                for (index, (_, waiting)) in enumerate(self._putters):
+                    if waiting is putter:
+                        del self._putters[index]
+                        break
+            raise
+
+    def PutNowait(self, val: T) -> None:
+        """Puts a value without waiting, raising asyncio.QueueFull if there is
+        no room for it.
+        """
+        if self._closed:
+            raise QueueClosedError()
+        if self._putters or self._IsFull():
+            raise asyncio.QueueFull()
+        self._PutValue(val)
+
+    def _PutValue(self, val: T) -> None:
+        self._values.append(val)
+        self._WakeGetter()
+
+    def Close(self) -> None:
+        """Closes the queue.
+
+        Values already put, including those of putters still waiting for
+        room, are still returned to getters.
+        """
+        self._closed = True
+        if not self._values and not self._putters:
+            self._empty_event.set()
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+
+    async def WaitUntilEmpty(self) -> None:
+        """Waits until the queue is closed and every value has been taken."""
+        await self._empty_event.wait()
@@ -1,7 +1,7 @@
 import os
 import yaml
 
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Optional, Tuple
 from dataclasses import dataclass
 
 def ReadTextFile(*path_args: str) -> str:
@@ -24,11 +24,15 @@ def ParseConfigDoc(doc: str) -> ConfigDoc:
 @dataclass
 class SecretDoc:
     twitch_client_secret: str
+    # Signs OAuth state tokens. Replicas that share it can complete each
+    # other's flows.
+    oauth_state_key: Optional[str] = None
 
 def ParseSecretDoc(doc: str) -> SecretDoc:
     data = yaml.safe_load(doc)
     return SecretDoc(
-        twitch_client_secret = data["twitch_client_secret"]
+        twitch_client_secret = data["twitch_client_secret"],
+        oauth_state_key = data.get("oauth_state_key"),
     )
 
 @dataclass
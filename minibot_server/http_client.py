@@ -0,0 +1,128 @@
+"""A shared HTTP client with per-host concurrency limits and metrics."""
+
+import asyncio
+import copy
+import logging
+import time
+from typing import Dict, Optional
+from urllib import parse
+
+import attr
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPResponse
+from tornado.simple_httpclient import HTTPTimeoutError, SimpleAsyncHTTPClient
+
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+    _HAVE_CURL = True
+except ImportError:
+    # pycurl is not installed.
+    _HAVE_CURL = False
+
+LOG = logging.Logger(__name__)
+
+
+@attr.s(auto_attribs=True)
+class HttpClientConfig:
+    # Requests in flight at once, over all hosts.
+    max_clients: int = 100
+    # Requests in flight at once to any one host. Others wait their turn.
+    max_per_host: int = 10
+    # Defaults for requests that don't set their own. Time spent waiting for
+    # a turn at the host counts against the request timeout.
+    connect_timeout: float = 10.0
+    request_timeout: float = 20.0
+    # Whether to use the curl based client, which keeps connections alive
+    # between requests to the same host. By default it is used if pycurl is
+    # installed.
+    use_curl: Optional[bool] = None
+
+
+@attr.s(auto_attribs=True)
+class HostStats:
+    requests: int = 0
+    in_flight: int = 0
+    # Requests waiting for their turn at the host.
+    waiting: int = 0
+    # Seconds spent waiting for a turn by the requests started so far.
+    total_queue_wait: float = 0.0
+    max_queue_wait: float = 0.0
+
+
+class HttpClient:
+    """An HTTP client meant to be shared by everything that talks to the same
+    hosts, so that requests to each host are limited and measured together.
+
+    With the curl based client, connections to a host are kept alive and
+    reused. Tornado's simple client opens a new connection per request.
+    """
+    _config: HttpClientConfig
+    _client: AsyncHTTPClient
+    _host_slots: Dict[str, asyncio.Semaphore]
+    _stats: Dict[str, HostStats]
+
+    def __init__(self, config: Optional[HttpClientConfig] = None):
+        self._config = HttpClientConfig() if config is None else config
+        use_curl = self._config.use_curl
+        if use_curl is None:
+            use_curl = _HAVE_CURL
+            if not use_curl:
+                LOG.warning("pycurl is not installed, so HTTP connections won't be reused. "
+                            "Install minibot_server[curl] to reuse them.")
+        if use_curl:
+            if not _HAVE_CURL:
+                raise ValueError("use_curl requires pycurl")
+            self._client = CurlAsyncHTTPClient(force_instance=True, max_clients=self._config.max_clients)
+        else:
+            self._client = SimpleAsyncHTTPClient(force_instance=True, max_clients=self._config.max_clients)
+        self._host_slots = {}
+        self._stats = {}
+
+    def UsesCurl(self) -> bool:
+        return _HAVE_CURL and isinstance(self._client, CurlAsyncHTTPClient)
+
+    async def Fetch(self, request: HTTPRequest, *, raise_error: bool = True) -> HTTPResponse:
+        """Sends a request once there is room for it at its host, and returns
+        the response. The request itself is left as it is.
+        """
+        # Copied, so that filling in timeouts doesn't change the caller's
+        # request.
+        request = copy.copy(request)
+        if request.connect_timeout is None:
+            request.connect_timeout = self._config.connect_timeout
+        timeout = request.request_timeout
+        if timeout is None:
+            timeout = self._config.request_timeout
+        host = parse.urlsplit(request.url).netloc
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(self._config.max_per_host)
+            self._stats[host] = HostStats()
+        stats = self._stats[host]
+
+        start = time.monotonic()
+        stats.waiting += 1
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise HTTPTimeoutError("Timeout waiting for a turn at the host")
+        finally:
+            stats.waiting -= 1
+        wait = time.monotonic() - start
+        stats.requests += 1
+        stats.in_flight += 1
+        stats.total_queue_wait += wait
+        stats.max_queue_wait = max(stats.max_queue_wait, wait)
+        try:
+            # Still positive, or waiting for the slot would have timed out.
+            request.request_timeout = timeout - wait
+            return await self._client.fetch(request, raise_error=raise_error)
+        finally:
+            stats.in_flight -= 1
+            slots.release()
+
+    def Stats(self) -> Dict[str, HostStats]:
+        """Returns a copy of the request and queue wait stats of each host."""
+        return {host: attr.evolve(stats) for (host, stats) in self._stats.items()}
+
+    def Close(self) -> None:
+        self._client.close()
@@ -1,136 +1,331 @@
 import asyncio
-import re
-from typing import Tuple, Optional, Union, Dict, List, Awaitable
+import collections
+from typing import Tuple, Optional, Union, Dict, List, Awaitable, Iterator, Mapping, Set, Deque, Callable
 import typing
 
+from .async_util import CloseableQueue, QueueClosedError
 
-class BytesMuncher:
-    _bytestr: bytes
+if typing.TYPE_CHECKING:
+    from .ratelimit import WriteScheduler
 
-    def __init__(self, bytestr: bytes):
-        self._bytestr = bytestr
+_SetAttr = object.__setattr__
 
-    def SplitToSpace(self) -> bytes:
-        m = re.match(rb'([^ ]+)($|[ ]+)', self._bytestr)
-        if m:
-            self._bytestr = self._bytestr[m.end():]
-            return m.group(1)
-        else:
-            raise ValueError()
-
-    def HasFirstChar(self, firstchar: bytes) -> bool:
-        if not self._bytestr:
-            return False
-        return self._bytestr[0] == ord(firstchar)
 
-    def IsEmpty(self) -> bool:
-        return not self._bytestr
+def _SplitToken(data: bytes, start: int, skip: int = 0) -> Tuple[bytes, int]:
+    """Splits off the space-delimited token beginning at start.
 
-    def Rest(self) -> bytes:
-        return self._bytestr
+    Returns the token, less its first skip bytes, and the index of the first
+    byte of the following token, skipping any run of separating spaces.
+    Raises ValueError if there is no token at start.
+    """
+    end = data.find(b' ', start)
+    if end == -1:
+        end = next_start = len(data)
+    else:
+        next_start = end + 1
+        while data[next_start:next_start + 1] == b' ':
+            next_start += 1
+    if end == start:
+        raise ValueError()
+    return data[start + skip:end], next_start
+
+
+_TAG_UNESCAPES = {
+    ord(b':'): b';',
+    ord(b's'): b' ',
+    ord(b'\\'): b'\\',
+    ord(b'r'): b'\r',
+    ord(b'n'): b'\n',
+}
+
+_TAG_SPECIALS = b'\\; \r\n'
+
+# Escaping the backslash first keeps it from re-escaping the other escapes.
+_TAG_ESCAPES = (
+    (b'\\', b'\\\\'),
+    (b';', b'\\:'),
+    (b' ', b'\\s'),
+    (b'\r', b'\\r'),
+    (b'\n', b'\\n'),
+)
 
 
 def UnescapeTagValue(tag_value: bytes) -> bytes:
-    result = bytearray()
-    curr_index = 0
-    while curr_index < len(tag_value):
-        curr_byte = tag_value[curr_index]
-        curr_index += 1
-        if curr_byte != ord(b'\\'):
-            result.append(curr_byte)
-        elif curr_index != len(tag_value):
-            next_byte = tag_value[curr_index]
-            curr_index += 1
-            if next_byte == ord(b':'):
-                result.append(ord(b';'))
-            elif next_byte == ord(b's'):
-                result.append(ord(b' '))
-            elif next_byte == ord(b'\\'):
-                result.append(ord(b'\\'))
-            elif next_byte == ord(b'r'):
-                result.append(ord(b'\r'))
-            elif next_byte == ord(b'n'):
-                result.append(ord(b'\n'))
-            else:
-                result.append(next_byte)
-    return bytes(result)
+    if b'\\' not in tag_value:
+        return tag_value
+    # Every piece after the first follows a backslash, so starts with the
+    # escaped character. An empty piece is either the first half of an
+    # escaped backslash, or a lone backslash at the end of the value.
+    pieces = tag_value.split(b'\\')
+    result = [pieces[0]]
+    num_pieces = len(pieces)
+    index = 1
+    while index < num_pieces:
+        piece = pieces[index]
+        index += 1
+        if piece:
+            result.append(_TAG_UNESCAPES.get(piece[0], piece[:1]))
+            result.append(piece[1:])
+        elif index < num_pieces:
+            result.append(b'\\')
+            result.append(pieces[index])
+            index += 1
+    return b''.join(result)
 
 
 def EscapeTagValue(tag_value: bytes) -> bytes:
-    result = bytearray()
-    for b in tag_value:
-        if b == ord(b';'):
-            result.extend(rb'\:')
-        elif b == ord(b' '):
-            result.extend(rb'\s')
-        elif b == ord(b'\\'):
-            result.extend(rb'\\')
-        elif b == ord(b'\r'):
-            result.extend(rb'\r')
-        elif b == ord(b'\n'):
-            result.extend(rb'\n')
-        else:
-            result.append(b)
-    return bytes(result)
+    # Deleting the special bytes checks for all of them in a single pass.
+    if len(tag_value.translate(None, _TAG_SPECIALS)) == len(tag_value):
+        return tag_value
+    for (special, escaped) in _TAG_ESCAPES:
+        if special in tag_value:
+            tag_value = tag_value.replace(special, escaped)
+    return tag_value
+
+
+# Commands and tag keys seen on nearly every line from Twitch. Parsed messages
+# share these objects rather than each holding its own copy.
+_KNOWN_COMMANDS = {command: command for command in (
+    b'PRIVMSG', b'USERNOTICE', b'NOTICE', b'CLEARCHAT', b'CLEARMSG',
+    b'ROOMSTATE', b'USERSTATE', b'GLOBALUSERSTATE', b'HOSTTARGET',
+    b'RECONNECT', b'WHISPER', b'JOIN', b'PART', b'PING', b'PONG', b'CAP',
+    b'001', b'002', b'003', b'004', b'353', b'366', b'372', b'375', b'376',
+)}
+
+_KNOWN_TAG_KEYS = {key: key for key in (
+    b'badge-info', b'badges', b'ban-duration', b'bits', b'client-nonce',
+    b'color', b'display-name', b'emote-only', b'emote-sets', b'emotes',
+    b'first-msg', b'flags', b'followers-only', b'id', b'login', b'message-id',
+    b'mod', b'msg-id', b'msg-param-cumulative-months', b'msg-param-displayName',
+    b'msg-param-login', b'msg-param-months', b'msg-param-recipient-display-name',
+    b'msg-param-recipient-id', b'msg-param-recipient-user-name',
+    b'msg-param-should-share-streak', b'msg-param-streak-months',
+    b'msg-param-sub-plan', b'msg-param-sub-plan-name', b'msg-param-viewerCount',
+    b'msg-param-was-gifted', b'r9k', b'reply-parent-display-name',
+    b'reply-parent-msg-body', b'reply-parent-msg-id', b'reply-parent-user-id',
+    b'reply-parent-user-login', b'returning-chatter', b'room-id', b'slow',
+    b'subs-only', b'subscriber', b'system-msg', b'target-msg-id',
+    b'target-user-id', b'thread-id', b'tmi-sent-ts', b'turbo', b'user-id',
+    b'user-type', b'vip',
+)}
+
+
+_SEMICOLON = ord(';')
+_EQUALS = ord('=')
+
+
+def FindRawTag(raw: bytes, key: bytes) -> Optional[bytes]:
+    """Returns the still escaped value of key in a raw tag block (without the
+    leading '@'), or None if it isn't there. Like splitting the block, the
+    last entry for a key wins.
+    """
+    key_len = len(key)
+    raw_len = len(raw)
+    search_end = raw_len
+    while True:
+        start = raw.rfind(b';' + key, 0, search_end) + 1
+        if start == 0 and not raw.startswith(key):
+            return None
+        end = start + key_len
+        if end == raw_len or raw[end] == _SEMICOLON:
+            return b''
+        if raw[end] == _EQUALS:
+            value_end = raw.find(b';', end)
+            return raw[end + 1:] if value_end < 0 else raw[end + 1:value_end]
+        if start == 0:
+            return None
+        search_end = start - 1 + key_len
+
+
+class MessageTags(typing.Mapping[bytes, bytes]):
+    """The tags of a message, as an immutable mapping from tag key to
+    unescaped value.
+
+    Tags parsed off the wire are kept in their raw form. Single tags are
+    looked up directly in the raw block, which is only split into entries
+    when iterated or when an escaped value is read, and each value is only
+    unescaped when it is first read. ToWireFormat() returns the raw block
+    untouched.
+    """
+    __slots__ = ('_raw', '_values', '_escaped_keys')
+
+    @classmethod
+    def FromWireFormat(cls, raw: bytes) -> "MessageTags":
+        tags = cls.__new__(cls)
+        tags._raw = raw
+        tags._values = None
+        tags._escaped_keys = None
+        return tags
+
+    # The raw tag block, if parsed from the wire.
+    _raw: Optional[bytes]
+    # The tag values, or None if the raw block has not been split yet.
+    _values: Optional[Dict[bytes, bytes]]
+    # Keys in _values whose value has not been unescaped yet.
+    _escaped_keys: Optional[Set[bytes]]
+
+    def __init__(self, values: Optional[Mapping[bytes, bytes]] = None):
+        self._raw = None
+        self._values = {} if values is None else dict(values)
+        self._escaped_keys = None
+
+    def _Values(self) -> Dict[bytes, bytes]:
+        values = self._values
+        if values is None:
+            raw = self._raw
+            assert raw is not None
+            values = {}
+            for tag_entry in raw.split(b';'):
+                (key, _, value) = tag_entry.partition(b'=')
+                values[_KNOWN_TAG_KEYS.get(key, key)] = value
+            if b'\\' in raw:
+                self._escaped_keys = {key for (key, value) in values.items() if b'\\' in value}
+            self._values = values
+        return values
+
+    def __getitem__(self, key: bytes) -> bytes:
+        values = self._values
+        if values is None:
+            # Reading a few tags is cheaper than splitting the whole block.
+            assert self._raw is not None
+            raw_value = FindRawTag(self._raw, key)
+            if raw_value is None:
+                raise KeyError(key)
+            if b'\\' not in raw_value:
+                return raw_value
+            # Split the block so the unescaped value is kept.
+            values = self._Values()
+        value = values[key]
+        escaped_keys = self._escaped_keys
+        if escaped_keys and key in escaped_keys:
+            value = values[key] = UnescapeTagValue(value)
+            escaped_keys.remove(key)
+        return value
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._Values())
+
+    def __len__(self) -> int:
+        return len(self._Values())
+
+    def __contains__(self, key: object) -> bool:
+        if self._values is None and isinstance(key, bytes):
+            assert self._raw is not None
+            return FindRawTag(self._raw, key) is not None
+        return key in self._Values()
+
+    def __repr__(self) -> str:
+        return f"MessageTags({dict(self.items())!r})"
+
+    def ToWireFormat(self) -> Optional[bytes]:
+        """Returns the escaped tag block, without the leading '@'.
+
+        Returns None if there are no tags to send.
+        """
+        if self._raw is not None:
+            return self._raw
+        values = self._Values()
+        if not values:
+            return None
+        tag_pieces = []  # type: List[bytes]
+        for (k, v) in values.items():
+            if v:
+                tag_pieces.append(k + b'=' + EscapeTagValue(v))
+            else:
+                tag_pieces.append(k)
+        return b';'.join(tag_pieces)
+
+
+_NO_TAGS = MessageTags()
 
 
 class Message:
+    """An immutable IRC message."""
+    __slots__ = ('tags', 'prefix', 'command', 'args')
+
     @staticmethod
     def Parse(msg_data: bytes) -> "Message":
         tags_part = None  # type: Union[bytes, None]
         prefix = None  # type: Union[bytes, None]
         args = []  # type: List[bytes]
-        muncher = BytesMuncher(msg_data)
-        if muncher.HasFirstChar(b'@'):
-            tags_part = muncher.SplitToSpace()[1:]
-        if muncher.HasFirstChar(b':'):
-            prefix = muncher.SplitToSpace()[1:]
-        command = muncher.SplitToSpace().upper()
-        while not muncher.IsEmpty() and not muncher.HasFirstChar(b':'):
-            arg = muncher.SplitToSpace()
-            if arg is None:
-                raise ValueError()
-            args.append(arg)
-        if not muncher.IsEmpty():
-            args.append(muncher.Rest()[1:])
-
-        tags = {}  # type: Dict[bytes, bytes]
+        # Tokens are located by offset, so each byte of the line is only
+        # copied once, into the token that contains it. The exception is the
+        # middle parameters, which are sliced out together and then split:
+        # split() in C is much faster than finding each one in Python.
+        pos = 0
+        data_len = len(msg_data)
+        if msg_data.startswith(b'@'):
+            tags_part, pos = _SplitToken(msg_data, pos, skip=1)
+        if msg_data.startswith(b':', pos):
+            prefix, pos = _SplitToken(msg_data, pos, skip=1)
+        command, pos = _SplitToken(msg_data, pos)
+        known_command = _KNOWN_COMMANDS.get(command)
+        if known_command is None:
+            command = command.upper()
+            command = _KNOWN_COMMANDS.get(command, command)
+        else:
+            command = known_command
+        if pos < data_len:
+            # The trailing parameter is the first one that starts with a
+            # colon, which is always preceded by a space unless it comes
+            # right after the command.
+            if msg_data.startswith(b':', pos):
+                trailing_start = pos
+            else:
+                trailing_start = msg_data.find(b' :', pos)
+                middle_end = data_len if trailing_start == -1 else trailing_start
+                args = [arg for arg in msg_data[pos:middle_end].split(b' ') if arg]
+                if trailing_start != -1:
+                    trailing_start += 1
+            if trailing_start != -1:
+                args.append(msg_data[trailing_start + 1:])
+
+        tags = None  # type: Optional[MessageTags]
         if tags_part is not None:
-            for tag_entry in tags_part.split(b';'):
-                entry_parts = tag_entry.split(b'=', 1)
-                if len(entry_parts) == 1:
-                    tags[entry_parts[0]] = b''
-                else:
-                    (key, value) = entry_parts
-                    tags[key] = UnescapeTagValue(value)
+            tags = MessageTags.FromWireFormat(tags_part)
 
         return Message(command, *args, tags=tags, prefix=prefix)
 
-    tags: Dict[bytes, bytes]
+    tags: MessageTags
     prefix: Optional[bytes]
     command: bytes
-    args: List[bytes]
-
-    def __init__(self, command: bytes, *args: bytes, tags: Dict[bytes, bytes] = {}, prefix: Optional[bytes] = None):
-        self.tags = tags
-        self.prefix = prefix
-        self.command = command
-        self.args = list(args)
+    args: Tuple[bytes, ...]
+
+    def __init__(self, command: bytes, *args: bytes, tags: Optional[Mapping[bytes, bytes]] = None, prefix: Optional[bytes] = None):
+        if tags is None:
+            tags = _NO_TAGS
+        elif not isinstance(tags, MessageTags):
+            tags = MessageTags(tags)
+        _SetAttr(self, 'tags', tags)
+        _SetAttr(self, 'prefix', prefix)
+        _SetAttr(self, 'command', command)
+        _SetAttr(self, 'args', args)
+
+    def __setattr__(self, name: str, value: object) -> None:
+        raise AttributeError(f"Message is immutable, can't set {name}")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"Message is immutable, can't delete {name}")
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Message):
+            return NotImplemented
+        return (self.command == other.command and self.args == other.args
+                and self.prefix == other.prefix and self.tags == other.tags)
+
+    def __hash__(self) -> int:
+        # Leaves out the tags, which would have to be decoded to be hashed.
+        # Equal messages still hash the same.
+        return hash((self.command, self.args, self.prefix))
 
     def __str__(self) -> str:
         return f"Message({self.command}, {self.args}, tags={self.tags}, prefix={self.prefix})"
 
     def ToWireFormat(self) -> bytes:
-        tag_pieces = []  # type: List[bytes]
-        for (k, v) in self.tags.items():
-            if v:
-                tag_pieces.append(k + b'=' + EscapeTagValue(v))
-            else:
-                tag_pieces.append(k)
-
         line_pieces = []  # type: List[bytes]
-        if tag_pieces:
-            line_pieces.append(b'@' + b';'.join(tag_pieces))
+        tag_block = self.tags.ToWireFormat()
+        if tag_block is not None:
+            line_pieces.append(b'@' + tag_block)
 
         if self.prefix is not None:
             line_pieces.append(b':' + self.prefix)
@@ -146,56 +341,54 @@ class Message:
         return b' '.join(line_pieces)
 
 
-_T = typing.TypeVar("_T")
-
-
-class CloseableQueue(typing.Generic[_T]):
-    _inner_queue: asyncio.Queue[_T]
-    _close_event: asyncio.Event
-    _empty_event: asyncio.Event
+class MessageBatchQueue(CloseableQueue[List[Message]]):
+    """A closeable queue of message batches, that can be read from either a
+    message or a batch at a time.
+    """
+    # Messages from a batch that have not been returned by ReadMessage() yet.
+    _unread: Deque[Message]
 
     def __init__(self, maxsize: int = 0):
-        self._inner_queue = asyncio.Queue(maxsize)
-        self._close_event = asyncio.Event()
-        self._empty_event = asyncio.Event()
-
-    async def Get(self) -> Optional[_T]:
-        if not self._close_event.is_set():
-            async def closing() -> None:
-                await self._close_event.wait()
+        super().__init__(maxsize)
+        self._unread = collections.deque()
+
+    async def ReadMessage(self) -> Optional[Message]:
+        """Returns the next message, or None once the queue is closed and
+        empty.
+        """
+        if not self._unread:
+            batch = await self.Get()
+            if batch is None:
                 return None
-            for f in asyncio.as_completed((self._inner_queue.get(), closing())):
-                value = await f
-                if value is not None:
-                    # self._inner_queue.task_done()
-                    return value
-                else:
-                    if not self._close_event.is_set():
-                        raise RuntimeError(
-                            "Close event should be set on a none value")
-                    # We're closed
-                    break
-        if not self._inner_queue.empty():
-            value = self._inner_queue.get_nowait()
-            if self._inner_queue.empty():
-                self._empty_event.set()
-            if value is True:
-                raise ValueError()
-            return value
-        return None
+            self._unread.extend(batch)
+        return self._unread.popleft()
 
-    async def Put(self, val: _T) -> None:
-        if self._close_event.is_set():
-            raise RuntimeError()
-        await self._inner_queue.put(val)
+    async def ReadBatch(self) -> Optional[List[Message]]:
+        """Returns the next batch, or None once the queue is closed and empty.
+
+        Any messages left over from a batch partially consumed by
+        ReadMessage() are returned first.
+        """
+        if self._unread:
+            batch = list(self._unread)
+            self._unread.clear()
+            return batch
+        return await self.Get()
 
-    def Close(self) -> None:
-        self._close_event.set()
-        if self._inner_queue.empty():
-            self._empty_event.set()
 
-    async def WaitUntilEmpty(self) -> None:
-        await self._empty_event.wait()
+# The most data to take from the socket in a single read.
+_READ_SIZE = 1 << 16
+
+# The most queued messages to send with a single write.
+_MAX_WRITE_BATCH = 256
+
+# The longest partial line to buffer while waiting for its line ending. This
+# matches the default StreamReader limit.
+_MAX_LINE_LENGTH = 1 << 16
+
+
+# Returns whether a raw line, without its CRLF, should be parsed and read.
+LineFilter = Callable[[bytes], bool]
 
 
 class IrcClientChannel:
@@ -205,70 +398,155 @@ class IrcClientChannel:
     protocol parsing.
     """
     @classmethod
-    async def Connect(cls, host: str, port: int) -> "IrcClientChannel":
-        reader, writer = await asyncio.open_connection(host, port, ssl=True)
+    async def Connect(cls, host: str, port: int, *, ssl: bool = True,
+                      scheduler: Optional["WriteScheduler"] = None,
+                      line_filter: Optional[LineFilter] = None) -> "IrcClientChannel":
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
 
-        client = cls(reader, writer)
+        client = cls(reader, writer, scheduler=scheduler, line_filter=line_filter)
         await client._Start()
         return client
 
     _read_task: asyncio.Task[None]
     _write_task: asyncio.Task[None]
-    _read_queue: CloseableQueue[Message]
+    _schedule_task: Optional[asyncio.Task[None]]
+    _read_queue: MessageBatchQueue
     _write_queue: CloseableQueue[Message]
     _reader: asyncio.StreamReader
     _writer: asyncio.StreamWriter
-
-    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    _write_done: Optional["asyncio.Future[None]"]
+    _scheduler: Optional["WriteScheduler"]
+    _line_filter: Optional[LineFilter]
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, *,
+                 scheduler: Optional["WriteScheduler"] = None,
+                 line_filter: Optional[LineFilter] = None):
+        """If a scheduler is given, written messages are held back by it to
+        stay within Twitch's rate limits.
+
+        If a line filter is given, only the lines it returns True for are
+        parsed and read. The rest are dropped before parsing.
+        """
         self._reader = reader
         self._writer = writer
-        self._read_queue = CloseableQueue(10)
+        self._scheduler = scheduler
+        self._line_filter = line_filter
+        self._schedule_task = None
+        self._read_queue = MessageBatchQueue(10)
         self._write_queue = CloseableQueue(10)
+        self._write_done = None
 
     async def _Start(self) -> None:
         self._read_task = asyncio.create_task(self._process_reader())
         self._write_task = asyncio.create_task(self._process_writer())
+        if self._scheduler is not None:
+            self._schedule_task = asyncio.create_task(self._process_scheduler(self._scheduler))
 
     def Write(self, msg: Message) -> Awaitable[None]:
         """Writes a message to the server.
 
-        The returned future can be used for flow control.
+        The returned future can be used for flow control. It is already done
+        if there was room for the message in the write queue, or if the
+        message was handed to the scheduler.
         """
-        return asyncio.create_task(self._write_queue.Put(msg))
+        if self._scheduler is not None:
+            self._scheduler.Push(msg)
+        else:
+            try:
+                self._write_queue.PutNowait(msg)
+            except asyncio.QueueFull:
+                # Put() waits in line behind any other blocked writes, so
+                # messages stay in order.
+                return asyncio.ensure_future(self._write_queue.Put(msg))
+        if self._write_done is None:
+            self._write_done = asyncio.get_event_loop().create_future()
+            self._write_done.set_result(None)
+        return self._write_done
 
     async def Read(self) -> Optional[Message]:
         """Reads a message from the server, or returns None if
         there are no more messages to read.
         """
-        return await self._read_queue.Get()
+        return await self._read_queue.ReadMessage()
+
+    async def ReadBatch(self) -> Optional[List[Message]]:
+        """Reads all of the messages that arrived together from the server, or
+        returns None if there are no more messages to read.
+
+        Any messages left over from a batch partially consumed by Read() are
+        returned first. The returned list is never empty.
+        """
+        return await self._read_queue.ReadBatch()
 
     def CloseWrite(self) -> None:
         """Closes the write half of the connection.
         """
+        if self._scheduler is not None:
+            self._scheduler.Close()
+        else:
+            self._write_queue.Close()
+
+    def Abort(self) -> None:
+        """Closes the connection immediately, without waiting for queued
+        messages to be sent.
+        """
+        if self._scheduler is not None:
+            self._scheduler.Close(drop_queued=True)
         self._write_queue.Close()
+        self._writer.close()
 
     async def _process_reader(self) -> None:
-        # Read a single IRC message and remove the trailing newline
+        # Parse every complete line from each read as a single batch, keeping
+        # any partial line at the end for the next read.
+        partial_line = b''
+        line_filter = self._line_filter
         try:
             while True:
-                data = await self._reader.readuntil(b'\r\n')
-                data = data[:-2]
-                await self._read_queue.Put(Message.Parse(data))
-        except asyncio.IncompleteReadError:
-            # We could close for a ton of reasons. Just ignore any incomplete
-            # data
-            pass
-        self._read_queue.Close()
+                data = await self._reader.read(_READ_SIZE)
+                if not data:
+                    # We could close for a ton of reasons. Just ignore any
+                    # incomplete data
+                    break
+                if partial_line:
+                    data = partial_line + data
+                lines = data.split(b'\r\n')
+                partial_line = lines.pop()
+                if len(partial_line) > _MAX_LINE_LENGTH:
+                    raise ValueError("IRC line too long")
+                if line_filter is None:
+                    batch = [Message.Parse(line) for line in lines if line]
+                else:
+                    batch = [Message.Parse(line) for line in lines if line and line_filter(line)]
+                if batch:
+                    await self._read_queue.Put(batch)
+        finally:
+            self._read_queue.Close()
+            self._write_queue.Close()
+            if self._scheduler is not None:
+                self._scheduler.Close(drop_queued=True)
+
+    async def _process_scheduler(self, scheduler: "WriteScheduler") -> None:
+        while True:
+            message = await scheduler.Next()
+            if message is None:
+                break
+            try:
+                await self._write_queue.Put(message)
+            except QueueClosedError:
+                # The connection has closed.
+                break
         self._write_queue.Close()
 
     async def _process_writer(self) -> None:
+        # Send everything that is queued with one write and one drain.
         while True:
-            message = await self._write_queue.Get()  # type: Optional[Message]
-            if message is None:
+            messages = await self._write_queue.GetMany(_MAX_WRITE_BATCH)
+            if messages is None:
                 break
-            wire_message = message.ToWireFormat()
+            wire_messages = [message.ToWireFormat() for message in messages]
+            wire_messages.append(b'')
+            self._writer.write(b'\r\n'.join(wire_messages))
             await self._writer.drain()
-            self._writer.write(wire_message + b'\r\n')
 
         if self._writer.can_write_eof():
             await self._writer.drain()
@@ -278,8 +556,19 @@ class IrcClientChannel:
             await self._writer.wait_closed()
 
     async def WaitForExit(self) -> None:
-        await self._read_task
-        await self._write_task
+        """Waits until the connection has finished and everything read from
+        it has been taken, then raises the error that ended it, if any.
+        """
+        tasks = [self._read_task, self._write_task]  # type: List[asyncio.Task[None]]
+        if self._schedule_task is not None:
+            tasks.append(self._schedule_task)
+        # Wait for every task and retrieve every error, so that none is left
+        # unretrieved when the first is raised.
+        await asyncio.wait(tasks)
+        errors = [task.exception() for task in tasks if not task.cancelled()]
+        for error in errors:
+            if error is not None:
+                raise error
         await self._read_queue.WaitUntilEmpty()
 
 
@@ -0,0 +1,200 @@
+"""A pool of IRC connections that spreads joined channels between them."""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from .async_util import QueueClosedError
+from .irc import IrcClientChannel, Message, MessageBatchQueue
+
+LOG = logging.Logger(__name__)
+
+# Connects to the server and logs in, returning a channel ready to JOIN.
+ConnectFunc = Callable[[], Awaitable[IrcClientChannel]]
+
+
+class Error(BaseException):
+    pass
+
+class PoolFullError(Error):
+    pass
+
+class NotJoinedError(Error):
+    pass
+
+
+class _PooledConnection:
+    channel: IrcClientChannel
+    joined: Set[bytes]
+    pump_task: "Optional[asyncio.Task[None]]"
+
+    def __init__(self, channel: IrcClientChannel):
+        self.channel = channel
+        self.joined = set()
+        self.pump_task = None
+
+
+class IrcConnectionPool:
+    """Spreads IRC channels over as many connections as needed to keep each
+    connection under a cap on joined channels.
+
+    Messages from every connection are merged into a single stream read with
+    Read() or ReadBatch(). PINGs are answered by the pool on the connection
+    they arrived on, and are not passed on. When a connection is lost, its
+    channels are joined again on the remaining connections, opening new ones
+    as needed. Channels that can't be joined again, because no connection
+    could be opened, are dropped from the pool until they are joined again.
+    """
+    _connect: ConnectFunc
+    _max_channels_per_connection: int
+    _max_connections: Optional[int]
+    _connections: List[_PooledConnection]
+    _by_channel: Dict[bytes, _PooledConnection]
+    # Held while channels are being placed on connections.
+    _lock: asyncio.Lock
+    _read_queue: MessageBatchQueue
+    _closing: bool
+
+    def __init__(self, connect: ConnectFunc, *, max_channels_per_connection: int = 50,
+                 max_connections: Optional[int] = None):
+        self._connect = connect
+        self._max_channels_per_connection = max_channels_per_connection
+        self._max_connections = max_connections
+        self._connections = []
+        self._by_channel = {}
+        self._lock = asyncio.Lock()
+        self._read_queue = MessageBatchQueue(10)
+        self._closing = False
+
+    def ConnectionCount(self) -> int:
+        return len(self._connections)
+
+    def ChannelsByConnection(self) -> List[Set[bytes]]:
+        """Returns the channels joined on each open connection."""
+        return [set(connection.joined) for connection in self._connections]
+
+    async def _PickConnection(self) -> _PooledConnection:
+        """Returns the least loaded connection with room for another channel,
+        opening a new one if there is none.
+        """
+        open_connections = [
+            connection for connection in self._connections
+            if len(connection.joined) < self._max_channels_per_connection]
+        if open_connections:
+            return min(open_connections, key=lambda connection: len(connection.joined))
+        if self._max_connections is not None and len(self._connections) >= self._max_connections:
+            raise PoolFullError()
+        connection = _PooledConnection(await self._connect())
+        self._connections.append(connection)
+        connection.pump_task = asyncio.ensure_future(self._Pump(connection))
+        return connection
+
+    async def _JoinLocked(self, channel: bytes) -> None:
+        connection = await self._PickConnection()
+        connection.joined.add(channel)
+        self._by_channel[channel] = connection
+        try:
+            await connection.channel.Write(Message(b'JOIN', channel))
+        except QueueClosedError:
+            # The connection was lost before its pump noticed. The channel
+            # is joined again elsewhere once it does.
+            pass
+
+    async def Join(self, channel: bytes) -> None:
+        """Joins the channel on one of the pooled connections."""
+        async with self._lock:
+            if channel not in self._by_channel:
+                await self._JoinLocked(channel)
+
+    async def Part(self, channel: bytes) -> None:
+        async with self._lock:
+            connection = self._by_channel.pop(channel, None)
+            if connection is None:
+                return
+            connection.joined.discard(channel)
+            await connection.channel.Write(Message(b'PART', channel))
+
+    def Write(self, msg: Message) -> Awaitable[None]:
+        """Writes a message on the connection that joined the channel it is
+        addressed to. Messages that are not addressed to a channel go out on
+        the first connection.
+        """
+        if msg.args and msg.args[0].startswith(b'#'):
+            try:
+                connection = self._by_channel[msg.args[0]]
+            except KeyError:
+                raise NotJoinedError(msg.args[0])
+        elif self._connections:
+            connection = self._connections[0]
+        else:
+            raise NotJoinedError()
+        return connection.channel.Write(msg)
+
+    async def Read(self) -> Optional[Message]:
+        """Reads a message from any of the connections, or returns None once
+        the pool is closed and there are no more messages to read.
+        """
+        return await self._read_queue.ReadMessage()
+
+    async def ReadBatch(self) -> Optional[List[Message]]:
+        """Reads a batch of messages that arrived together on one connection,
+        or returns None once the pool is closed and there are no more
+        messages to read.
+        """
+        return await self._read_queue.ReadBatch()
+
+    async def _Pump(self, connection: _PooledConnection) -> None:
+        try:
+            while True:
+                batch = await connection.channel.ReadBatch()
+                if batch is None:
+                    break
+                messages = []  # type: List[Message]
+                for msg in batch:
+                    if msg.command == b'PING':
+                        try:
+                            connection.channel.Write(Message(b'PONG', *msg.args))
+                        except QueueClosedError:
+                            pass
+                    else:
+                        messages.append(msg)
+                if messages:
+                    try:
+                        await self._read_queue.Put(messages)
+                    except QueueClosedError:
+                        break
+        finally:
+            try:
+                await connection.channel.WaitForExit()
+            except (OSError, QueueClosedError) as e:
+                # The connection is gone either way.
+                LOG.warning("Pooled IRC connection lost: %r", e)
+            if not self._closing:
+                await self._Rebalance(connection)
+
+    async def _Rebalance(self, lost: _PooledConnection) -> None:
+        """Joins the channels of a lost connection on the others."""
+        async with self._lock:
+            self._connections.remove(lost)
+            for channel in sorted(lost.joined):
+                if self._by_channel.get(channel) is not lost:
+                    continue
+                del self._by_channel[channel]
+                try:
+                    await self._JoinLocked(channel)
+                except (OSError, PoolFullError) as e:
+                    LOG.warning("Could not join %r again: %r", channel, e)
+
+    async def Close(self) -> None:
+        """Closes every connection, and ends the merged stream once they have
+        finished.
+        """
+        self._closing = True
+        async with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.channel.CloseWrite()
+        for connection in connections:
+            if connection.pump_task is not None:
+                await connection.pump_task
+        self._read_queue.Close()
@@ -0,0 +1,263 @@
+"""An IRC channel that survives dropped connections by reconnecting."""
+
+import asyncio
+import collections
+import logging
+import random
+from typing import Awaitable, Callable, Deque, List, Optional, Sequence, Set
+
+from .async_util import QueueClosedError
+from .irc import IrcClientChannel, Message, MessageBatchQueue
+
+LOG = logging.Logger(__name__)
+
+# Opens a new connection to the server.
+ConnectFunc = Callable[[], Awaitable[IrcClientChannel]]
+# Returns the messages that log in on a new connection.
+LoginFunc = Callable[[], Awaitable[Sequence[Message]]]
+
+
+def TwitchLoginMessages(nick: bytes, oauth_token: bytes) -> List[Message]:
+    """Returns the messages that log in to Twitch IRC as nick."""
+    return [
+        Message(b'CAP', b'REQ', b'twitch.tv/membership twitch.tv/tags twitch.tv/commands'),
+        Message(b'PASS', b'oauth:' + oauth_token),
+        Message(b'NICK', nick),
+        Message(b'CAP', b'END'),
+    ]
+
+
+class Backoff:
+    """Exponential backoff with full jitter.
+
+    Each delay is drawn uniformly between zero and an exponentially growing
+    cap, so that clients dropped at the same time spread out their retries.
+    """
+    _initial: float
+    _maximum: float
+    _multiplier: float
+    _rng: random.Random
+    _attempts: int
+
+    def __init__(self, initial: float = 1.0, maximum: float = 120.0, multiplier: float = 2.0,
+                 rng: Optional[random.Random] = None):
+        self._initial = initial
+        self._maximum = maximum
+        self._multiplier = multiplier
+        self._rng = random.Random() if rng is None else rng
+        self._attempts = 0
+
+    def NextDelay(self) -> float:
+        cap = min(self._maximum, self._initial * self._multiplier ** self._attempts)
+        self._attempts += 1
+        return self._rng.uniform(0, cap)
+
+    def Reset(self) -> None:
+        self._attempts = 0
+
+
+class ReconnectingIrcChannel:
+    """An IRC channel that reconnects whenever its connection is lost.
+
+    A connection is considered lost when the server closes it, sends a
+    RECONNECT, or goes quiet and then fails to answer a PING. Each new
+    connection is logged in again and rejoins every channel joined so far.
+    Messages written while disconnected are buffered, up to a limit, and sent
+    once logged in again. Messages from all connections are read as one
+    stream, with server PINGs answered and left out.
+    """
+    _connect: ConnectFunc
+    _login: LoginFunc
+    _backoff: Backoff
+    _idle_timeout: float
+    _ping_timeout: float
+    _max_buffered: int
+    _joined: Set[bytes]
+    _buffered: Deque[Message]
+    _channel: Optional[IrcClientChannel]
+    _read_queue: MessageBatchQueue
+    _closing: bool
+    _run_task: "Optional[asyncio.Task[None]]"
+    # The number of buffered messages dropped because the buffer was full.
+    dropped_messages: int
+    # The number of connections made after the first.
+    reconnects: int
+
+    def __init__(self, connect: ConnectFunc, login: LoginFunc, *,
+                 backoff: Optional[Backoff] = None,
+                 idle_timeout: float = 360.0,
+                 ping_timeout: float = 15.0,
+                 max_buffered: int = 1000):
+        """idle_timeout is how long the server may stay silent before we PING
+        it, and ping_timeout how long it then has to answer. Twitch PINGs
+        about every five minutes.
+        """
+        self._connect = connect
+        self._login = login
+        self._backoff = Backoff() if backoff is None else backoff
+        self._idle_timeout = idle_timeout
+        self._ping_timeout = ping_timeout
+        self._max_buffered = max_buffered
+        self._joined = set()
+        self._buffered = collections.deque()
+        self._channel = None
+        self._read_queue = MessageBatchQueue(10)
+        self._closing = False
+        self._run_task = None
+        self.dropped_messages = 0
+        self.reconnects = 0
+
+    def Start(self) -> None:
+        self._run_task = asyncio.ensure_future(self._Run())
+
+    def IsConnected(self) -> bool:
+        """Returns whether there is a logged in connection to write to."""
+        return self._channel is not None
+
+    def JoinedChannels(self) -> Set[bytes]:
+        return set(self._joined)
+
+    def Write(self, msg: Message) -> Awaitable[None]:
+        """Writes a message to the server, buffering it if disconnected.
+
+        JOINs and PARTs are never buffered; the channels they leave joined
+        are joined on connecting instead.
+        """
+        if self._closing:
+            raise QueueClosedError()
+        if msg.command in (b'JOIN', b'PART') and msg.args:
+            channels = msg.args[0].split(b',')
+            if msg.command == b'JOIN':
+                self._joined.update(channels)
+            else:
+                self._joined.difference_update(channels)
+        if self._channel is not None:
+            try:
+                return self._channel.Write(msg)
+            except QueueClosedError:
+                # The connection was lost, but we haven't noticed yet.
+                pass
+        if msg.command not in (b'JOIN', b'PART'):
+            if len(self._buffered) >= self._max_buffered:
+                self._buffered.popleft()
+                self.dropped_messages += 1
+            self._buffered.append(msg)
+        return _Done()
+
+    async def Read(self) -> Optional[Message]:
+        """Reads a message from the server, or returns None once closed."""
+        return await self._read_queue.ReadMessage()
+
+    async def ReadBatch(self) -> Optional[List[Message]]:
+        """Reads a batch of messages that arrived together from the server, or
+        returns None once closed.
+        """
+        return await self._read_queue.ReadBatch()
+
+    async def Close(self) -> None:
+        """Closes the current connection, and stops reconnecting."""
+        self._closing = True
+        if self._channel is not None:
+            self._channel.CloseWrite()
+        if self._run_task is not None:
+            if self._channel is None:
+                # Don't wait out a backoff delay.
+                self._run_task.cancel()
+            try:
+                await self._run_task
+            except asyncio.CancelledError:
+                pass
+        self._read_queue.Close()
+
+    async def _Run(self) -> None:
+        first = True
+        while not self._closing:
+            if not first:
+                await asyncio.sleep(self._backoff.NextDelay())
+                if self._closing:
+                    break
+                self.reconnects += 1
+            first = False
+            try:
+                channel = await self._connect()
+            except OSError as e:
+                LOG.warning("IRC connection failed: %s", e)
+                continue
+            try:
+                await self._RunConnection(channel)
+            finally:
+                self._channel = None
+                if not self._closing:
+                    channel.Abort()
+                try:
+                    await channel.WaitForExit()
+                except (OSError, QueueClosedError):
+                    # The connection is gone either way.
+                    pass
+
+    async def _RunConnection(self, channel: IrcClientChannel) -> None:
+        """Logs in on a new connection and passes on what it reads until the
+        connection is lost.
+        """
+        try:
+            for msg in await self._login():
+                await channel.Write(msg)
+            if self._joined:
+                await channel.Write(Message(b'JOIN', b','.join(sorted(self._joined))))
+            while self._buffered:
+                msg = self._buffered.popleft()
+                try:
+                    await channel.Write(msg)
+                except (QueueClosedError, asyncio.CancelledError):
+                    # Not written, so keep it for the next connection.
+                    self._buffered.appendleft(msg)
+                    raise
+        except QueueClosedError:
+            return
+        self._channel = channel
+
+        awaiting_pong = False
+        while True:
+            timeout = self._ping_timeout if awaiting_pong else self._idle_timeout
+            try:
+                batch = await asyncio.wait_for(channel.ReadBatch(), timeout)
+            except asyncio.TimeoutError:
+                if awaiting_pong:
+                    LOG.warning("IRC server stopped answering PINGs")
+                    return
+                awaiting_pong = True
+                batch = []
+                reply = Message(b'PING', b'minibot')  # type: Optional[Message]
+            else:
+                if batch is None:
+                    return
+                awaiting_pong = False
+                reply = None
+            messages = []  # type: List[Message]
+            reconnect = False
+            for msg in batch:
+                if msg.command == b'PING':
+                    reply = Message(b'PONG', *msg.args)
+                elif msg.command == b'RECONNECT':
+                    reconnect = True
+                elif msg.command == b'001':
+                    # Logged in, so the connection is working again.
+                    self._backoff.Reset()
+                    messages.append(msg)
+                elif msg.command != b'PONG':
+                    messages.append(msg)
+            if reply is not None:
+                try:
+                    channel.Write(reply)
+                except QueueClosedError:
+                    return
+            if messages:
+                await self._read_queue.Put(messages)
+            if reconnect:
+                return
+
+
+def _Done() -> "asyncio.Future[None]":
+    future = asyncio.get_event_loop().create_future()  # type: asyncio.Future[None]
+    future.set_result(None)
+    return future
@@ -0,0 +1,117 @@
+"""JSON encoding and decoding of attrs classes.
+
+The checks for each class are worked out once, from its field annotations,
+so decoding a document is a json.loads() followed by a type check per field.
+"""
+
+import json
+import typing
+from typing import Any, Callable, Dict, Generic, List, Tuple, Type, TypeVar, cast
+
+import attr
+
+T = TypeVar("T")
+
+_Check = Callable[[Any], bool]
+
+
+class Error(BaseException):
+    pass
+
+class DecodeError(Error):
+    pass
+
+
+def _IsStr(value: Any) -> bool:
+    return type(value) is str
+
+def _IsInt(value: Any) -> bool:
+    # Not isinstance(), which would let booleans through.
+    return type(value) is int
+
+def _IsFloat(value: Any) -> bool:
+    return type(value) is float or type(value) is int
+
+def _IsBool(value: Any) -> bool:
+    return type(value) is bool
+
+_SIMPLE_CHECKS = {
+    str: _IsStr,
+    int: _IsInt,
+    float: _IsFloat,
+    bool: _IsBool,
+}  # type: Dict[Any, _Check]
+
+
+def _CompileCheck(field_type: Any) -> _Check:
+    simple = _SIMPLE_CHECKS.get(field_type)
+    if simple is not None:
+        return simple
+    origin = getattr(field_type, '__origin__', None)
+    args = getattr(field_type, '__args__', ())  # type: Tuple[Any, ...]
+    if origin is list:
+        item_check = _CompileCheck(args[0])
+        return lambda value: type(value) is list and all(map(item_check, value))
+    if origin is dict and args[0] is str:
+        value_check = _CompileCheck(args[1])
+        return lambda value: type(value) is dict and all(map(value_check, value.values()))
+    if origin is typing.Union:
+        checks = [_CompileCheck(arg) for arg in args if arg is not type(None)]
+        optional = len(checks) < len(args)
+        return lambda value: (optional and value is None) or any(check(value) for check in checks)
+    raise TypeError(f"Unsupported JSON field type {field_type!r}")
+
+
+class JsonModel(Generic[T]):
+    """The compiled form of an attrs class whose fields are JSON values:
+    str, int, float, bool, and Lists, str keyed Dicts and Optionals of them.
+
+    Fields without a default must be present when decoding. Keys that are not
+    fields are ignored, as services add to their responses over time.
+    """
+    _cls: Type[T]
+    # (name, check, required) for each field.
+    _fields: List[Tuple[str, _Check, bool]]
+    _names: List[str]
+    _encoder: json.JSONEncoder
+
+    def __init__(self, cls: Type[T]):
+        hints = typing.get_type_hints(cls)
+        self._cls = cls
+        self._fields = [
+            (field.name, _CompileCheck(hints[field.name]), field.default is attr.NOTHING)
+            for field in attr.fields(cast(Any, cls))]
+        self._names = [name for (name, _, _) in self._fields]
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def Decode(self, body: bytes) -> T:
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            raise DecodeError(str(e))
+        if type(data) is not dict:
+            raise DecodeError("Expected a JSON object")
+        kwargs = {}  # type: Dict[str, Any]
+        for (name, check, required) in self._fields:
+            if name in data:
+                value = data[name]
+                if not check(value):
+                    raise DecodeError(f"Bad value for {name}: {value!r}")
+                kwargs[name] = value
+            elif required:
+                raise DecodeError(f"Missing field {name}")
+        return self._cls(**kwargs)
+
+    def Encode(self, value: T) -> bytes:
+        return self._encoder.encode(
+            {name: getattr(value, name) for name in self._names}).encode()
+
+
+_COMPILED = {}  # type: Dict[type, JsonModel[Any]]
+
+def Compile(cls: Type[T]) -> JsonModel[T]:
+    """Returns the compiled form of cls, compiling it on first use."""
+    model = _COMPILED.get(cls)
+    if model is None:
+        model = _COMPILED[cls] = JsonModel(cls)
+    return model
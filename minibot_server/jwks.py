@@ -0,0 +1,335 @@
+"""Caching an OAuth provider's signing keys, and verifying ID tokens with them."""
+
+import asyncio
+import json
+import logging
+import re
+import time
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import attr
+import jwt
+from jwt.algorithms import get_default_algorithms
+from tornado.httpclient import HTTPRequest
+
+from .http_client import HttpClient
+from .oauth import OAuthClientInfo, OAuthProviderInfo
+
+LOG = logging.Logger(__name__)
+
+# The algorithm for keys that don't name one, by key type.
+_DEFAULT_ALGORITHMS = {
+    'RSA': 'RS256',
+    'EC': 'ES256',
+    'oct': 'HS256',
+}
+
+_MAX_AGE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)"?', re.IGNORECASE)
+_NO_CACHE = re.compile(r'(?:^|,)\s*no-(?:cache|store)\b', re.IGNORECASE)
+
+
+class Error(BaseException):
+    pass
+
+class UnknownKeyError(Error):
+    pass
+
+class InvalidTokenError(Error):
+    pass
+
+
+def CacheLifetime(cache_control: Optional[str]) -> Optional[int]:
+    """Returns the max-age of a Cache-Control header, 0 if the response may
+    not be cached, or None if the header doesn't say.
+    """
+    if cache_control is None:
+        return None
+    if _NO_CACHE.search(cache_control):
+        return 0
+    match = _MAX_AGE.search(cache_control)
+    return None if match is None else int(match.group(1))
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class SigningKey:
+    kid: str
+    algorithm: str
+    # In the form jwt.decode() takes for the algorithm.
+    key: Any
+
+
+def ParseKeySet(document: Mapping[str, Any]) -> Dict[str, SigningKey]:
+    """Returns the usable signing keys of a JWKS document by kid. Keys for
+    algorithms this PyJWT can't verify, such as RSA ones without the
+    cryptography package installed, are left out.
+    """
+    algorithms = get_default_algorithms()
+    keys = {}  # type: Dict[str, SigningKey]
+    for jwk in document.get('keys', []):
+        kid = jwk.get('kid')
+        use = jwk.get('use', 'sig')
+        name = jwk.get('alg', _DEFAULT_ALGORITHMS.get(jwk.get('kty', '')))
+        if kid is None or use != 'sig' or name not in algorithms:
+            continue
+        try:
+            key = algorithms[name].from_jwk(json.dumps(jwk))
+        except (ValueError, jwt.InvalidKeyError) as e:
+            LOG.warning("Skipping bad JWKS key %s: %s", kid, e)
+            continue
+        keys[kid] = SigningKey(kid, name, key)
+    return keys
+
+
+@attr.s(auto_attribs=True)
+class JwksStats:
+    fetches: int = 0
+    failed_fetches: int = 0
+    # Lookups answered from the cache, and lookups of a kid that wasn't.
+    hits: int = 0
+    misses: int = 0
+
+
+class JwksCache:
+    """The signing keys published at a JWKS URL, by kid.
+
+    Keys are kept for as long as the response's Cache-Control allows,
+    between min_ttl and max_ttl seconds, or default_ttl if it doesn't say.
+    Once started, the keys are refetched in the background shortly before
+    they expire, so looking up a known kid never waits on the network. If a
+    refetch fails, the keys already held are kept.
+
+    Looking up a kid that isn't known refetches the keys, in case the
+    provider has rotated them. Concurrent lookups share a single fetch, and
+    unknown kids cause at most one fetch every min_refetch_interval seconds,
+    so made up kids can't be used to hammer the provider.
+    """
+    _url: str
+    _client: HttpClient
+    _default_ttl: float
+    _min_ttl: float
+    _max_ttl: float
+    _refresh_ahead: float
+    _retry_delay: float
+    _min_refetch_interval: float
+    _clock: Callable[[], float]
+    _keys: Dict[str, SigningKey]
+    # When the keys expire, or None before the first fetch.
+    _expires: Optional[float]
+    _last_fetch: Optional[float]
+    _fetch_task: "Optional[asyncio.Task[None]]"
+    _wakeup: "Optional[asyncio.Future[None]]"
+    _run_task: "Optional[asyncio.Task[None]]"
+    _stats: JwksStats
+
+    def __init__(self, url: str, *, http_client: HttpClient,
+                 default_ttl: float = 3600, min_ttl: float = 60, max_ttl: float = 86400,
+                 refresh_ahead: float = 0.1, retry_delay: float = 30,
+                 min_refetch_interval: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        """refresh_ahead is the fraction of the keys' lifetime before they
+        expire that they are refetched at.
+        """
+        self._url = url
+        self._client = http_client
+        self._default_ttl = default_ttl
+        self._min_ttl = min_ttl
+        self._max_ttl = max_ttl
+        self._refresh_ahead = refresh_ahead
+        self._retry_delay = retry_delay
+        self._min_refetch_interval = min_refetch_interval
+        self._clock = clock
+        self._keys = {}
+        self._expires = None
+        self._last_fetch = None
+        self._fetch_task = None
+        self._wakeup = None
+        self._run_task = None
+        self._stats = JwksStats()
+
+    def Stats(self) -> JwksStats:
+        return attr.evolve(self._stats)
+
+    def Kids(self) -> List[str]:
+        return sorted(self._keys)
+
+    def Expires(self) -> Optional[float]:
+        return self._expires
+
+    def CachedKey(self, kid: str) -> Optional[SigningKey]:
+        """Returns the key if it is cached, without fetching anything."""
+        return self._keys.get(kid)
+
+    async def Key(self, kid: str) -> SigningKey:
+        """Returns the key with the given kid, fetching the keys only if it
+        isn't cached.
+        """
+        key = self._keys.get(kid)
+        if key is not None:
+            self._stats.hits += 1
+            return key
+        self._stats.misses += 1
+        now = self._clock()
+        if (self._fetch_task is not None or self._last_fetch is None
+                or now - self._last_fetch >= self._min_refetch_interval):
+            try:
+                await self.Refresh()
+            except Exception as e:
+                raise UnknownKeyError(kid) from e
+        key = self._keys.get(kid)
+        if key is None:
+            raise UnknownKeyError(kid)
+        return key
+
+    async def Refresh(self) -> None:
+        """Fetches the keys, or waits for the fetch already in flight."""
+        task = self._fetch_task
+        if task is None:
+            task = self._fetch_task = asyncio.ensure_future(self._Fetch())
+        await asyncio.shield(task)
+
+    async def _Fetch(self) -> None:
+        try:
+            self._last_fetch = self._clock()
+            self._stats.fetches += 1
+            try:
+                response = await self._client.Fetch(HTTPRequest(self._url))
+                keys = ParseKeySet(json.loads(response.body))
+            except Exception:
+                self._stats.failed_fetches += 1
+                raise
+            max_age = CacheLifetime(response.headers.get('Cache-Control'))
+            ttl = self._default_ttl if max_age is None else max_age
+            ttl = min(self._max_ttl, max(self._min_ttl, ttl))
+            self._keys = keys
+            self._expires = self._clock() + ttl
+        finally:
+            self._fetch_task = None
+        if self._wakeup is not None and not self._wakeup.done():
+            # The refresh time has moved.
+            self._wakeup.set_result(None)
+
+    def _RefreshAt(self) -> float:
+        if self._expires is None or self._last_fetch is None:
+            return self._clock()
+        lifetime = self._expires - self._last_fetch
+        return self._expires - lifetime * self._refresh_ahead
+
+    def Start(self) -> None:
+        """Starts fetching the keys in the background, now and whenever they
+        are about to expire.
+        """
+        self._run_task = asyncio.ensure_future(self._Run())
+
+    async def Stop(self) -> None:
+        if self._run_task is not None:
+            self._run_task.cancel()
+            try:
+                await self._run_task
+            except asyncio.CancelledError:
+                pass
+            self._run_task = None
+
+    async def _Run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            delay = self._RefreshAt() - self._clock()
+            if delay <= 0:
+                try:
+                    await self.Refresh()
+                    continue
+                except Exception:
+                    LOG.exception("Fetching JWKS keys from %s failed", self._url)
+                    delay = self._retry_delay
+            wakeup = self._wakeup = loop.create_future()
+            timer = loop.call_later(delay, _SetResult, wakeup)
+            try:
+                await wakeup
+            finally:
+                self._wakeup = None
+                timer.cancel()
+
+
+class IdTokenVerifier:
+    """Verifies OpenID Connect ID tokens against a provider's cached keys.
+
+    Checks the signature, expiry, issuer, audience and, if given, nonce.
+    Tokens signed with a cached key are verified without any network calls.
+    """
+    _keys: JwksCache
+    _issuer: Optional[str]
+    _audience: str
+    _algorithms: List[str]
+    _leeway: int
+
+    def __init__(self, keys: JwksCache, *, audience: str, issuer: Optional[str] = None,
+                 algorithms: Iterable[str] = ('RS256',), leeway: int = 60):
+        self._keys = keys
+        self._issuer = issuer
+        self._audience = audience
+        self._algorithms = list(algorithms)
+        self._leeway = leeway
+
+    def _KeyFor(self, token: str) -> Tuple[str, Optional[str]]:
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError as e:
+            raise InvalidTokenError(str(e))
+        alg = header.get('alg')
+        if alg not in self._algorithms:
+            raise InvalidTokenError(f"Algorithm {alg} not allowed")
+        return (alg, header.get('kid'))
+
+    def _Decode(self, token: str, alg: str, key: SigningKey, nonce: Optional[str]) -> Dict[str, Any]:
+        if key.algorithm != alg:
+            raise InvalidTokenError(f"Key {key.kid} is for {key.algorithm}, not {alg}")
+        kwargs = {}  # type: Dict[str, Any]
+        if self._issuer is not None:
+            kwargs['issuer'] = self._issuer
+        try:
+            claims = jwt.decode(token, key.key, algorithms=[alg], audience=self._audience,
+                                leeway=self._leeway, **kwargs)  # type: Dict[str, Any]
+        except jwt.InvalidTokenError as e:
+            raise InvalidTokenError(str(e))
+        for claim in ('sub', 'exp', 'iat'):
+            if claim not in claims:
+                raise InvalidTokenError(f"Missing {claim} claim")
+        if nonce is not None and claims.get('nonce') != nonce:
+            raise InvalidTokenError("Nonce mismatch")
+        return claims
+
+    async def Verify(self, token: str, *, nonce: Optional[str] = None) -> Dict[str, Any]:
+        """Returns the claims of a valid ID token. Fetches the provider's
+        keys only if the token's key isn't cached.
+        """
+        (alg, kid) = self._KeyFor(token)
+        if kid is None:
+            raise InvalidTokenError("No kid in token header")
+        try:
+            key = await self._keys.Key(kid)
+        except UnknownKeyError:
+            raise InvalidTokenError(f"Unknown key {kid}")
+        return self._Decode(token, alg, key, nonce)
+
+    def VerifyCached(self, token: str, *, nonce: Optional[str] = None) -> Dict[str, Any]:
+        """Like Verify(), but raises UnknownKeyError rather than fetching if
+        the token's key isn't cached.
+        """
+        (alg, kid) = self._KeyFor(token)
+        key = None if kid is None else self._keys.CachedKey(kid)
+        if key is None:
+            raise UnknownKeyError(kid)
+        return self._Decode(token, alg, key, nonce)
+
+
+def MakeIdTokenVerifier(client: OAuthClientInfo, provider: OAuthProviderInfo,
+                        http_client: HttpClient) -> IdTokenVerifier:
+    """Returns a verifier for ID tokens the provider issues to the client.
+    The key cache isn't started.
+    """
+    keys = JwksCache(provider.jwks_url, http_client=http_client)
+    return IdTokenVerifier(keys, audience=client.client_id, issuer=provider.issuer)
+
+
+def _SetResult(future: "asyncio.Future[None]") -> None:
+    if not future.done():
+        future.set_result(None)
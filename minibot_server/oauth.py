@@ -1,15 +1,16 @@
 from __future__ import annotations
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
 from tornado import web
 from urllib import parse
 from typing import (
-    List, Union, Any, Dict, Awaitable, Tuple, NamedTuple, Optional, NewType,
+    List, Union, Any, Callable, Dict, Awaitable, Tuple, NamedTuple, Optional, NewType,
     TypeVar, Type, Generic
 )
 from dataclasses import dataclass
 import asyncio
 import json
+import random
 import secrets
 
 import time
@@ -17,6 +18,10 @@ from serde import Model, fields
 from abc import ABC, abstractmethod, abstractclassmethod
 import attr
 
+from .async_util import PendingStats, PendingStore
+from .http_client import HttpClient
+from . import json_models, oauth_state
+
 class Error(BaseException):
     pass
 
@@ -36,6 +41,7 @@ class AuthToken:
         return f"{self._type} {self._token}"
 
 T = TypeVar("T")
+T_co = TypeVar("T_co", covariant=True)
 MT = TypeVar("MT", bound=Model)
 MS = TypeVar("MS", bound=Model)
 
@@ -48,12 +54,17 @@ def SerdeJsonRequest(data: MT) -> RequestBody:
     content = data.to_json().encode()
     return RequestBody(content_type='application/json', content=content)
 
-class ResponseParser(Generic[T]):
+def JsonModelRequest(data: Any) -> RequestBody:
+    """Like SerdeJsonRequest(), for attrs classes (see json_models)."""
+    content = json_models.Compile(type(data)).Encode(data)
+    return RequestBody(content_type='application/json', content=content)
+
+class ResponseParser(Generic[T_co]):
     def ExpectedType(self) -> Optional[str]:
         return None
 
     @abstractmethod
-    def ParseResponseBody(self, content_type: Optional[str], body: bytes) -> T:
+    def ParseResponseBody(self, content_type: Optional[str], body: bytes) -> T_co:
         pass
 
 class SerdeJsonResponseParser(ResponseParser[MS]):
@@ -70,17 +81,35 @@ class SerdeJsonResponseParser(ResponseParser[MS]):
             raise ValueError()
         return self._body_type.from_json(body.decode())
 
+class JsonModelResponseParser(ResponseParser[T]):
+    """Parses JSON responses straight from bytes into attrs classes. Much
+    faster than SerdeJsonResponseParser, and ignores unknown keys rather
+    than rejecting them.
+    """
+    _model: json_models.JsonModel[T]
+
+    def __init__(self, body_type: Type[T]):
+        self._model = json_models.Compile(body_type)
+
+    def ExpectedType(self) -> Optional[str]:
+        return 'application/json'
+
+    def ParseResponseBody(self, content_type: Optional[str], body: bytes) -> T:
+        if content_type is None or content_type != 'application/json':
+            raise ValueError()
+        return self._model.Decode(body)
+
 
 class BaseSimpleHttpClient(ABC):
     pass
 
 class SimpleHttpClient(BaseSimpleHttpClient):
     _base_url: str
-    _http_client: AsyncHTTPClient
+    _http_client: HttpClient
 
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, http_client: HttpClient):
         self._base_url = base_url
-        self._http_client = AsyncHTTPClient()
+        self._http_client = http_client
 
     async def Request(self,
             path: str,
@@ -89,7 +118,8 @@ class SimpleHttpClient(BaseSimpleHttpClient):
             auth: Optional[AuthToken] = None,
             query: Optional[Dict[str, str]] = None,
             body: Optional[RequestBody] = None,
-            resp_parser: Optional[ResponseParser[T]] = None) -> Optional[T]:
+            resp_parser: Optional[ResponseParser[T]] = None,
+            timeout: Optional[float] = None) -> Optional[T]:
         full_url = parse.urljoin(self._base_url, path)
         if query is not None:
             full_url = f"{full_url}?{parse.urlencode(query)}"
@@ -108,8 +138,8 @@ class SimpleHttpClient(BaseSimpleHttpClient):
         if body is not None:
             req_args['body'] = body.content
 
-        req = HTTPRequest(full_url, method=method, headers=headers, **req_args)
-        resp = await self._http_client.fetch(req, raise_error=True)
+        req = HTTPRequest(full_url, method=method, headers=headers, request_timeout=timeout, **req_args)
+        resp = await self._http_client.Fetch(req, raise_error=True)
 
         if resp_parser is not None:
             # Reqire Content-Type headers
@@ -130,6 +160,8 @@ class OAuthProviderInfo:
     authz_endpoint: str
     token_endpoint: str
     jwks_url: str
+    # The iss claim of the provider's ID tokens.
+    issuer: Optional[str] = None
 
 class CodeExchangeResponse(Model):
     access_token: str = fields.Str()
@@ -142,6 +174,21 @@ class TokenRefreshResponse(Model):
     refresh_token: str = fields.Str()
     expires_in: int = fields.Int()
 
+# The same responses, for JsonModelResponseParser.
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class CodeExchangeRecord:
+    access_token: str
+    refresh_token: str
+    expires_in: int
+    scopes: List[str]
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class TokenRefreshRecord:
+    access_token: str
+    refresh_token: str
+    expires_in: int
+
 OAuthToken = NewType("OAuthToken", str)
 Timestamp = NewType("Timestamp", int)
 
@@ -154,6 +201,13 @@ class AccessToken:
         self._token = token
         self._expires = expires
 
+    def Token(self) -> OAuthToken:
+        """Returns the token, whether or not it has expired."""
+        return self._token
+
+    def Expires(self) -> Optional[Timestamp]:
+        return self._expires
+
     def Get(self, current_time: Timestamp) -> Optional[OAuthToken]:
         if self._expires is not None and self._expires < current_time:
             return None
@@ -166,28 +220,104 @@ class RefreshResult:
     expires_in: Optional[int]
 
 class RefreshableToken:
+    """An access token that refreshes itself when it expires.
+
+    Only one refresh runs at a time; callers that need a refresh while one is
+    in flight wait for it, rather than each using up the refresh token. Once
+    within refresh_margin seconds of expiring, less up to refresh_jitter
+    seconds so that tokens issued together don't all refresh together, the
+    token is refreshed in the background while the current one is still
+    handed out.
+    """
     _access_token: AccessToken
     _refresh_token: OAuthToken
-
-    def __init__(self, access_token: AccessToken, refresh_token: OAuthToken):
-        self._access_token = access_token
+    _refresh_margin: int
+    _refresh_jitter: int
+    _rng: random.Random
+    _refresh_at: Optional[Timestamp]
+    _refresh_task: Optional[asyncio.Task[None]]
+    _refresh_listeners: List[Callable[[RefreshableToken], None]]
+
+    def __init__(self, access_token: AccessToken, refresh_token: OAuthToken, *,
+                 refresh_margin: int = 300, refresh_jitter: int = 60,
+                 rng: Optional[random.Random] = None):
         self._refresh_token = refresh_token
+        self._refresh_margin = refresh_margin
+        self._refresh_jitter = refresh_jitter
+        self._rng = random.Random() if rng is None else rng
+        self._refresh_task = None
+        self._refresh_listeners = []
+        self._SetAccessToken(access_token)
+
+    def _SetAccessToken(self, access_token: AccessToken) -> None:
+        self._access_token = access_token
+        expires = access_token.Expires()
+        if expires is None:
+            self._refresh_at = None
+        else:
+            self._refresh_at = Timestamp(
+                expires - self._refresh_margin - self._rng.randint(0, self._refresh_jitter))
 
     def TryGet(self, current_time: Timestamp) -> Optional[OAuthToken]:
         return self._access_token.Get(current_time)
 
+    def AddRefreshListener(self, listener: Callable[[RefreshableToken], None]) -> None:
+        """Calls listener with the token after each successful refresh."""
+        self._refresh_listeners.append(listener)
+
+    def ToJson(self) -> str:
+        """Serializes the tokens, to pass them to another process."""
+        return json.dumps({
+            'access_token': self._access_token.Token(),
+            'expires': self._access_token.Expires(),
+            'refresh_token': self._refresh_token,
+        })
+
+    @staticmethod
+    def FromJson(data: str) -> RefreshableToken:
+        fields = json.loads(data)
+        return RefreshableToken(
+            AccessToken(OAuthToken(fields['access_token']), fields['expires']),
+            OAuthToken(fields['refresh_token']))
+
+    def RefreshAt(self) -> Optional[Timestamp]:
+        """Returns the time from which the token is refreshed ahead of
+        expiring, or None if it never expires.
+        """
+        return self._refresh_at
+
+    def Refreshing(self) -> bool:
+        return self._refresh_task is not None
+
     async def Refresh(self, current_time: Timestamp, provider: "OAuthProvider") -> None:
-        result = await provider.GetTokenFromRefresh(self._refresh_token)
+        """Refreshes the token, or waits for the refresh already in flight."""
+        await asyncio.shield(self._StartRefresh(current_time, provider))
+
+    def _StartRefresh(self, current_time: Timestamp, provider: "OAuthProvider") -> asyncio.Task[None]:
+        task = self._refresh_task
+        if task is None:
+            task = self._refresh_task = asyncio.ensure_future(self._DoRefresh(current_time, provider))
+            # Callers waiting on the refresh see any error. Retrieve it here
+            # as well, for refreshes that were only started in the background.
+            task.add_done_callback(_RetrieveException)
+        return task
+
+    async def _DoRefresh(self, current_time: Timestamp, provider: "OAuthProvider") -> None:
+        try:
+            result = await provider.GetTokenFromRefresh(self._refresh_token)
+        finally:
+            self._refresh_task = None
         expires = None
         if result.expires_in is not None:
             expires = Timestamp(result.expires_in + current_time)
-        self._access_token = AccessToken(
+        self._SetAccessToken(AccessToken(
             token = result.access_token,
             expires = expires
-        )
+        ))
         if result.refresh_token is not None:
             self._refresh_token = result.refresh_token
-
+        for listener in self._refresh_listeners:
+            listener(self)
 
     async def Get(self, current_time: Timestamp, provider: "OAuthProvider") -> OAuthToken:
         token = self._access_token.Get(current_time)
@@ -195,8 +325,14 @@ class RefreshableToken:
             await self.Refresh(current_time, provider)
             token = self._access_token.Get(current_time)
             assert token is not None
+        elif self._refresh_at is not None and self._refresh_at <= current_time:
+            self._StartRefresh(current_time, provider)
         return token
 
+def _RetrieveException(task: asyncio.Task[None]) -> None:
+    if not task.cancelled():
+        task.exception()
+
 class OAuthProvider(ABC):
     @abstractmethod
     def AuthUrl(self, *, state_token: str, scopes: List[str], nonce: Optional[str] = None) -> str:
@@ -214,11 +350,23 @@ class OAuthProviderImpl(OAuthProvider):
     http_client: SimpleHttpClient
     client: OAuthClientInfo
     provider: OAuthProviderInfo
-
-    def __init__(self, client: OAuthClientInfo, provider: OAuthProviderInfo):
-        self.http_client = SimpleHttpClient(provider.token_endpoint)
+    _code_exchange_parser: ResponseParser[Union[CodeExchangeResponse, CodeExchangeRecord]]
+    _token_refresh_parser: ResponseParser[Union[TokenRefreshResponse, TokenRefreshRecord]]
+
+    def __init__(self, client: OAuthClientInfo, provider: OAuthProviderInfo,
+                 http_client: HttpClient, *, use_serde: bool = False):
+        """Responses are parsed with JsonModelResponseParser, or with
+        SerdeJsonResponseParser if use_serde is set.
+        """
+        self.http_client = SimpleHttpClient(provider.token_endpoint, http_client)
         self.client = client
         self.provider = provider
+        if use_serde:
+            self._code_exchange_parser = SerdeJsonResponseParser(CodeExchangeResponse)
+            self._token_refresh_parser = SerdeJsonResponseParser(TokenRefreshResponse)
+        else:
+            self._code_exchange_parser = JsonModelResponseParser(CodeExchangeRecord)
+            self._token_refresh_parser = JsonModelResponseParser(TokenRefreshRecord)
 
     def AuthUrl(self, *, state_token: str, scopes: List[str], nonce: Union[str, None] = None) -> str:
         params: Dict[str, str] = {
@@ -247,7 +395,7 @@ class OAuthProviderImpl(OAuthProvider):
 
         contents = await self.http_client.Request('',
             query = params,
-            resp_parser = SerdeJsonResponseParser(CodeExchangeResponse))
+            resp_parser = self._code_exchange_parser)
 
         assert contents is not None
 
@@ -274,7 +422,7 @@ class OAuthProviderImpl(OAuthProvider):
         )
 
         contents = await self.http_client.Request('',
-            method='POST', query=params, resp_parser=SerdeJsonResponseParser(TokenRefreshResponse))
+            method='POST', query=params, resp_parser=self._token_refresh_parser)
 
         assert contents is not None
 
@@ -289,60 +437,111 @@ TWITCH_PROVIDER = OAuthProviderInfo(
     authz_endpoint = 'https://id.twitch.tv/oauth2/authorize',
     token_endpoint = 'https://id.twitch.tv/oauth2/token',
     jwks_url = 'https://id.twitch.tv/oauth2/keys',
+    issuer = 'https://id.twitch.tv/oauth2',
 )
 
+class UnknownStateError(Error):
+    pass
+
 class OAuthCallbackManager:
-    _lock: asyncio.Lock
-    _callbacks: Dict[str, asyncio.Event]
-    _result: Dict[str, Any]
+    """Starts OAuth flows, and matches their callbacks to them.
+
+    Nothing about a flow is kept between starting it and its callback: the
+    state token is signed, and carries the id of the flow and when it
+    expires. The token from the code exchange is handed off through results,
+    so with a signer key and a results store shared between replicas, a
+    flow can be started, called back and completed on different replicas.
+    Code exchanges for different flows run concurrently, and a flow's code
+    is only exchanged once.
+    """
     _provider: OAuthProvider
-
-    def __init__(self, provider: OAuthProvider):
-        self._lock = asyncio.Lock()
-        self._callbacks = {}
-        self._result = {}
+    _signer: oauth_state.StateSigner
+    _results: oauth_state.ResultHandoff
+    # The tasks waiting on this replica for a flow's result, by flow id.
+    _waiters: PendingStore[asyncio.Future[RefreshableToken]]
+
+    def __init__(self, provider: OAuthProvider, *, ttl: float = 600.0, capacity: int = 10000,
+                 signer: Optional[oauth_state.StateSigner] = None,
+                 results: Optional[oauth_state.ResultHandoff] = None):
+        """Flows not completed within ttl seconds expire. At most capacity
+        flows are waited on at once; past that, the oldest waiters are
+        cancelled. Without a signer or results, flows can only be
+        completed in this process.
+        """
         self._provider = provider
-
-    async def start_auth(self) -> Tuple[str, Awaitable[Any]]:
-        token = secrets.token_urlsafe(30)
+        if signer is None:
+            signer = oauth_state.StateSigner(secrets.token_bytes(32), ttl=ttl)
+        self._signer = signer
+        if results is None:
+            results = oauth_state.InProcessResultHandoff(ttl=ttl, capacity=capacity)
+        self._results = results
+        self._waiters = PendingStore(ttl=ttl, capacity=capacity, on_drop=_CancelFuture)
+
+    def Stats(self) -> PendingStats:
+        return self._waiters.Stats()
+
+    def start_flow(self) -> Tuple[str, str]:
+        """Starts a flow, and returns the token to claim its result with and
+        the URL to send the user to.
+        """
+        claim_secret = secrets.token_urlsafe(30)
+        flow_id = oauth_state.FlowId(claim_secret)
         auth_url = self._provider.AuthUrl(
-            state_token = token,
+            state_token = self._signer.Issue('state', flow_id),
             scopes = ['openid', 'user:edit'])
-
-        event = asyncio.Event()
-
-        async with self._lock:
-            self._callbacks[token] = event
-
-        async def Inner() -> Any:
-            await event.wait()
-            async with self._lock:
-                result = self._result[token]
-                del self._callbacks[token]
-                del self._result[token]
-                return result
-
-        return (auth_url, Inner())
+        return (self._signer.Issue('claim', claim_secret), auth_url)
+
+    def _Watch(self, flow_id: str, expires: float) -> asyncio.Future[RefreshableToken]:
+        """Returns the task waiting on this replica for the flow's result,
+        starting it if needed. The task is cancelled when the flow expires.
+        """
+        waiter = self._waiters.Get(flow_id)
+        if waiter is None:
+            waiter = asyncio.ensure_future(self._Wait(flow_id))
+            self._waiters.Put(flow_id, waiter, max(0.0, expires - time.time()))
+            waiter.add_done_callback(lambda done: self._Unwatch(flow_id, done))
+        return waiter
+
+    def _Unwatch(self, flow_id: str, waiter: asyncio.Future[RefreshableToken]) -> None:
+        if self._waiters.Get(flow_id) is waiter:
+            self._waiters.Pop(flow_id)
+
+    async def _Wait(self, flow_id: str) -> RefreshableToken:
+        return RefreshableToken.FromJson(await self._results.Wait(flow_id))
+
+    async def wait_result(self, claim_token: str) -> RefreshableToken:
+        """Waits for the result of the flow the claim token was returned
+        for by start_flow().
+        """
+        try:
+            (claim_secret, expires) = self._signer.Verify('claim', claim_token)
+        except oauth_state.InvalidStateError:
+            raise UnknownStateError(claim_token)
+        waiter = self._Watch(oauth_state.FlowId(claim_secret), expires)
+        try:
+            return await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            if not waiter.cancelled():
+                # We were cancelled, rather than the flow expiring. Others
+                # may be waiting on the same flow, so the watch is left to
+                # end with it.
+                raise
+            raise UnknownStateError(claim_token)
 
     async def complete(self, state: str, code: str) -> None:
-        async with self._lock:
+        try:
+            (flow_id, expires) = self._signer.Verify('state', state)
+        except oauth_state.InvalidStateError:
+            raise UnknownStateError(state)
+        if not await self._results.Claim(flow_id, max(0.0, expires - time.time())):
+            raise UnknownStateError(state)
+        try:
             result = await self._provider.ExchangeCode(Timestamp(int(time.time())), code)
-            event = self._callbacks[state]
-            self._result[state] = result
-            event.set()
-
-
-class AccountCreationManager:
-    _lock: asyncio.Lock = asyncio.Lock()
-    _pending_creates: Dict[str, Awaitable[RefreshableToken]] = {}
-
-    async def add_creation(self, token: str, callback: Awaitable[RefreshableToken]) -> None:
-        async with self._lock:
-            self._pending_creates[token] = callback
+        except Exception as e:
+            await self._results.PublishError(flow_id, str(e))
+            raise
+        await self._results.Publish(flow_id, result.ToJson())
 
-    async def wait_result(self, token: str) -> RefreshableToken:
-        async with self._lock:
-            callback = self._pending_creates[token]
-            del self._pending_creates[token]
-        return await callback
 
+def _CancelFuture(future: asyncio.Future[Any]) -> None:
+    future.cancel()
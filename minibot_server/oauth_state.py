@@ -0,0 +1,292 @@
+"""Signed OAuth state tokens, and handing flow results between replicas.
+
+A flow's state token carries everything needed to check it, so the replica
+that receives the OAuth callback doesn't need to be the one that started the
+flow. The result of the flow is then handed off to whichever replica the
+client asks for it on.
+"""
+
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Optional, Sequence, Tuple, TypeVar
+
+from .async_util import PendingStore
+from .sqlite_store import OpenDatabase
+
+_VERSION = "1"
+
+T = TypeVar("T")
+
+
+class Error(BaseException):
+    pass
+
+class InvalidStateError(Error):
+    pass
+
+class ExpiredStateError(InvalidStateError):
+    pass
+
+class FlowFailedError(Error):
+    pass
+
+
+def _Encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class StateSigner:
+    """Issues and checks HMAC-SHA256 signed tokens that expire after ttl
+    seconds.
+
+    A token is "version.expiry.value.signature", with the expiry in
+    milliseconds. The purpose a token was issued for is part of what is
+    signed, so that a token issued for one purpose is never accepted for
+    another. Tokens signed with any of previous_keys are still accepted, so
+    that keys can be rotated without breaking flows in progress.
+    """
+    _key: bytes
+    _keys: Sequence[bytes]
+    _ttl: float
+    _clock: Callable[[], float]
+
+    def __init__(self, key: bytes, *, previous_keys: Sequence[bytes] = (),
+                 ttl: float = 600.0, clock: Callable[[], float] = time.time):
+        self._key = key
+        self._keys = [key, *previous_keys]
+        self._ttl = ttl
+        self._clock = clock
+
+    @staticmethod
+    def _Sign(key: bytes, purpose: str, payload: str) -> str:
+        message = f"{purpose}.{payload}".encode('ascii')
+        return _Encode(hmac.new(key, message, hashlib.sha256).digest())
+
+    def Issue(self, purpose: str, value: str) -> str:
+        """Returns a token for value, which must be URL safe and not contain
+        dots.
+        """
+        if '.' in value:
+            raise ValueError("value must not contain '.'")
+        expires = int((self._clock() + self._ttl) * 1000)
+        payload = f"{_VERSION}.{expires}.{value}"
+        return f"{payload}.{self._Sign(self._key, purpose, payload)}"
+
+    def Verify(self, purpose: str, token: str) -> Tuple[str, float]:
+        """Returns the value of a token and the time it expires at."""
+        parts = token.split('.')
+        if len(parts) != 4 or parts[0] != _VERSION:
+            raise InvalidStateError(token)
+        (_, expires, value, signature) = parts
+        payload = f"{_VERSION}.{expires}.{value}"
+        # Check every key, so that how long checking takes doesn't depend on
+        # which one matched.
+        valid = False
+        for key in self._keys:
+            valid |= hmac.compare_digest(self._Sign(key, purpose, payload), signature)
+        if not valid:
+            raise InvalidStateError(token)
+        try:
+            expires_at = int(expires) / 1000
+        except ValueError:
+            raise InvalidStateError(token)
+        if expires_at <= self._clock():
+            raise ExpiredStateError(token)
+        return (value, expires_at)
+
+
+def FlowId(claim_secret: str) -> str:
+    """Returns the id a flow's result is handed off under.
+
+    The client claims the result with a secret that the id is derived from,
+    so that seeing the state token, which carries the id, is not enough to
+    claim it.
+    """
+    return _Encode(hashlib.sha256(claim_secret.encode('ascii')).digest())
+
+
+class ResultHandoff(ABC):
+    """Passes the serialized result of a flow from the replica that
+    completed it to the one waiting for it.
+    """
+
+    @abstractmethod
+    async def Claim(self, flow_id: str, ttl: float) -> bool:
+        """Marks the flow as being completed for the next ttl seconds.
+        Returns False if it already was, so that a callback replayed on any
+        replica is only acted on once.
+        """
+
+    @abstractmethod
+    async def Publish(self, flow_id: str, result: str) -> None: ...
+
+    @abstractmethod
+    async def PublishError(self, flow_id: str, message: str) -> None: ...
+
+    @abstractmethod
+    async def Wait(self, flow_id: str) -> str:
+        """Waits for the flow's result, and takes it. Raises FlowFailedError
+        if the flow failed.
+        """
+
+
+class _Outcome:
+    result: Optional[str]
+    error: Optional[str]
+
+    def __init__(self, result: Optional[str], error: Optional[str]):
+        self.result = result
+        self.error = error
+
+
+class InProcessResultHandoff(ResultHandoff):
+    """Hands off results within a single process. Results not taken within
+    ttl seconds are dropped.
+    """
+    _claims: PendingStore[bool]
+    _outcomes: PendingStore["asyncio.Future[_Outcome]"]
+
+    def __init__(self, *, ttl: float = 600.0, capacity: int = 10000):
+        self._claims = PendingStore(ttl=ttl, capacity=capacity)
+        self._outcomes = PendingStore(ttl=ttl, capacity=capacity, on_drop=_CancelFuture)
+
+    def _Outcome(self, flow_id: str) -> "asyncio.Future[_Outcome]":
+        future = self._outcomes.Get(flow_id)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self._outcomes.Put(flow_id, future)
+        return future
+
+    async def Claim(self, flow_id: str, ttl: float) -> bool:
+        if flow_id in self._claims:
+            return False
+        self._claims.Put(flow_id, True, ttl)
+        return True
+
+    async def Publish(self, flow_id: str, result: str) -> None:
+        future = self._Outcome(flow_id)
+        if not future.done():
+            future.set_result(_Outcome(result, None))
+
+    async def PublishError(self, flow_id: str, message: str) -> None:
+        future = self._Outcome(flow_id)
+        if not future.done():
+            future.set_result(_Outcome(None, message))
+
+    async def Wait(self, flow_id: str) -> str:
+        future = self._Outcome(flow_id)
+        try:
+            outcome = await future
+        finally:
+            if self._outcomes.Get(flow_id) is future:
+                self._outcomes.Pop(flow_id)
+        if outcome.error is not None:
+            raise FlowFailedError(outcome.error)
+        assert outcome.result is not None
+        return outcome.result
+
+
+class SqliteResultHandoff(ResultHandoff):
+    """Hands off results through an SQLite database, which every process
+    sharing the file can use. Waiters poll every poll_interval seconds.
+
+    This stands in for a shared store between replicas on one machine.
+    Queries run on a background thread, since they may wait for another
+    process's write lock.
+    """
+    _db: sqlite3.Connection
+    _executor: concurrent.futures.ThreadPoolExecutor
+    _ttl: float
+    _poll_interval: float
+    _clock: Callable[[], float]
+
+    def __init__(self, path: str, *, ttl: float = 600.0, poll_interval: float = 0.05,
+                 clock: Callable[[], float] = time.time):
+        # Only ever used on the executor's one thread, once set up.
+        self._db = OpenDatabase(path, check_same_thread=False)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._ttl = ttl
+        self._poll_interval = poll_interval
+        self._clock = clock
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS oauth_flows (
+                flow_id TEXT PRIMARY KEY,
+                expires REAL NOT NULL,
+                result TEXT,
+                error TEXT,
+                taken INTEGER NOT NULL DEFAULT 0
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS oauth_flows_expires ON oauth_flows (expires)")
+
+    async def Close(self) -> None:
+        await self._Run(self._db.close)
+        self._executor.shutdown()
+
+    async def _Run(self, func: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    async def Claim(self, flow_id: str, ttl: float) -> bool:
+        return await self._Run(self._Claim, flow_id, ttl)
+
+    def _Claim(self, flow_id: str, ttl: float) -> bool:
+        now = self._clock()
+        self._db.execute("DELETE FROM oauth_flows WHERE expires <= ?", (now,))
+        cursor = self._db.execute(
+            "INSERT OR IGNORE INTO oauth_flows (flow_id, expires) VALUES (?, ?)",
+            (flow_id, now + ttl))
+        return cursor.rowcount == 1
+
+    def _Store(self, flow_id: str, result: Optional[str], error: Optional[str]) -> None:
+        # Results are kept for ttl seconds after they are published, however
+        # long the flow took.
+        expires = self._clock() + self._ttl
+        self._db.execute(
+            """INSERT INTO oauth_flows (flow_id, expires, result, error) VALUES (?, ?, ?, ?)
+               ON CONFLICT (flow_id) DO UPDATE SET
+                   expires = excluded.expires, result = excluded.result, error = excluded.error""",
+            (flow_id, expires, result, error))
+
+    async def Publish(self, flow_id: str, result: str) -> None:
+        await self._Run(self._Store, flow_id, result, None)
+
+    async def PublishError(self, flow_id: str, message: str) -> None:
+        await self._Run(self._Store, flow_id, None, message)
+
+    def _Take(self, flow_id: str) -> Optional[_Outcome]:
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute(
+                """SELECT result, error FROM oauth_flows
+                   WHERE flow_id = ? AND taken = 0 AND expires > ?
+                       AND (result IS NOT NULL OR error IS NOT NULL)""",
+                (flow_id, self._clock())).fetchone()
+            if row is not None:
+                # The row is kept until it expires, so the flow can't be
+                # claimed again.
+                self._db.execute(
+                    "UPDATE oauth_flows SET taken = 1, result = NULL WHERE flow_id = ?",
+                    (flow_id,))
+        finally:
+            self._db.execute("COMMIT")
+        return None if row is None else _Outcome(row[0], row[1])
+
+    async def Wait(self, flow_id: str) -> str:
+        while True:
+            outcome = await self._Run(self._Take, flow_id)
+            if outcome is not None:
+                break
+            await asyncio.sleep(self._poll_interval)
+        if outcome.error is not None:
+            raise FlowFailedError(outcome.error)
+        assert outcome.result is not None
+        return outcome.result
+
+
+def _CancelFuture(future: "asyncio.Future[_Outcome]") -> None:
+    future.cancel()
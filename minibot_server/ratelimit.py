@@ -0,0 +1,236 @@
+"""Rate limiting and prioritization of messages sent to Twitch IRC.
+
+Twitch drops, or globally throttles, clients that go over its limits:
+
+- 20 PRIVMSGs per 30 seconds, or 100 in channels where the bot is a moderator
+- 20 JOINs per 10 seconds
+- 3 whispers per second, and 100 per minute
+
+WriteScheduler keeps outgoing messages in priority lanes, and only releases a
+message once the token buckets for its kind of message allow it.
+"""
+
+import asyncio
+import collections
+import enum
+import time
+from typing import Callable, Deque, Dict, Optional, Sequence, Tuple
+
+import attr
+
+from .irc import Message
+
+Clock = Callable[[], float]
+
+
+class TokenBucket:
+    """A token bucket holding up to capacity tokens, refilled at a fixed rate."""
+    @classmethod
+    def ForLimit(cls, limit: int, period: float, now: float) -> "TokenBucket":
+        """Returns a bucket that never allows more than limit tokens to be
+        taken in any window of period seconds.
+
+        Any window can see at most the burst capacity plus what is refilled
+        during the window, so the limit is split evenly between the two.
+        """
+        capacity = max(1, limit // 2)
+        return cls(capacity, (limit - capacity) / period, now)
+
+    _capacity: float
+    _rate: float
+    _tokens: float
+    _updated_at: float
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self._capacity = capacity
+        self._rate = rate
+        self._tokens = capacity
+        self._updated_at = now
+
+    def _Refill(self, now: float) -> None:
+        if now > self._updated_at:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+
+    def Available(self, now: float) -> bool:
+        self._Refill(now)
+        return self._tokens >= 1
+
+    def Take(self, now: float) -> None:
+        self._Refill(now)
+        self._tokens -= 1
+
+    def TimeUntilAvailable(self, now: float) -> float:
+        self._Refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+
+class Lane(enum.IntEnum):
+    """The lanes of WriteScheduler, in priority order."""
+    # Connection upkeep: PONG, CAP, PASS, NICK and the like.
+    CONTROL = 0
+    # Moderation commands sent as PRIVMSGs, such as /ban and /timeout.
+    MODERATION = 1
+    CHAT = 2
+    WHISPER = 3
+    JOIN = 4
+    OTHER = 5
+
+
+_CONTROL_COMMANDS = frozenset((b'PING', b'PONG', b'CAP', b'PASS', b'NICK', b'USER', b'QUIT'))
+
+_MODERATION_COMMANDS = frozenset((
+    b'/ban', b'/unban', b'/timeout', b'/untimeout', b'/delete', b'/clear',
+    b'/slow', b'/slowoff', b'/followers', b'/followersoff', b'/subscribers',
+    b'/subscribersoff', b'/emoteonly', b'/emoteonlyoff', b'/uniquechat',
+    b'/uniquechatoff',
+))
+
+
+def ClassifyMessage(msg: Message) -> Lane:
+    command = msg.command
+    if command in _CONTROL_COMMANDS:
+        return Lane.CONTROL
+    if command == b'JOIN':
+        return Lane.JOIN
+    if command == b'PRIVMSG' and msg.args:
+        text = msg.args[-1]
+        if text.startswith(b'/'):
+            chat_command = text.split(b' ', 1)[0].lower()
+            if chat_command in (b'/w', b'/whisper'):
+                return Lane.WHISPER
+            if chat_command in _MODERATION_COMMANDS:
+                return Lane.MODERATION
+        return Lane.CHAT
+    return Lane.OTHER
+
+
+@attr.s(auto_attribs=True)
+class LaneStats:
+    queued: int = 0
+    sent: int = 0
+    # Seconds spent queued by the messages sent so far.
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+
+class WriteScheduler:
+    """Orders outgoing messages by priority, holding back each one until the
+    Twitch rate limits that apply to it allow it to be sent.
+
+    Messages within a lane are sent in the order they were pushed. A lane
+    blocked by its rate limit does not hold back lower priority lanes with
+    different limits.
+    """
+    _clock: Clock
+    _lanes: Dict[Lane, Deque[Tuple[Message, float]]]
+    _buckets: Dict[Lane, Sequence[TokenBucket]]
+    _stats: Dict[Lane, LaneStats]
+    _closed: bool
+    _wakeup: Optional["asyncio.Future[None]"]
+
+    def __init__(self, *, is_moderator: bool = False, clock: Clock = time.monotonic):
+        now = clock()
+        privmsg_bucket = TokenBucket.ForLimit(100 if is_moderator else 20, 30, now)
+        self._clock = clock
+        self._lanes = {lane: collections.deque() for lane in Lane}
+        self._buckets = {
+            Lane.CONTROL: (),
+            Lane.MODERATION: (privmsg_bucket,),
+            Lane.CHAT: (privmsg_bucket,),
+            Lane.WHISPER: (
+                TokenBucket.ForLimit(3, 1, now),
+                TokenBucket.ForLimit(100, 60, now),
+            ),
+            Lane.JOIN: (TokenBucket.ForLimit(20, 10, now),),
+            Lane.OTHER: (),
+        }
+        self._stats = {lane: LaneStats() for lane in Lane}
+        self._closed = False
+        self._wakeup = None
+
+    def Push(self, msg: Message) -> None:
+        if self._closed:
+            raise RuntimeError("WriteScheduler is closed")
+        lane = ClassifyMessage(msg)
+        self._lanes[lane].append((msg, self._clock()))
+        self._stats[lane].queued += 1
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def Pop(self) -> Optional[Message]:
+        """Returns the highest priority message that can be sent now, if any."""
+        now = self._clock()
+        for (lane, queue) in self._lanes.items():
+            if not queue:
+                continue
+            buckets = self._buckets[lane]
+            if all(bucket.Available(now) for bucket in buckets):
+                for bucket in buckets:
+                    bucket.Take(now)
+                (msg, queued_at) = queue.popleft()
+                stats = self._stats[lane]
+                wait = now - queued_at
+                stats.queued -= 1
+                stats.sent += 1
+                stats.total_wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+                return msg
+        return None
+
+    def TimeUntilReady(self) -> Optional[float]:
+        """Returns the seconds until Pop() will return a message, or None if
+        there are no queued messages.
+        """
+        now = self._clock()
+        delays = [
+            max((bucket.TimeUntilAvailable(now) for bucket in self._buckets[lane]), default=0.0)
+            for (lane, queue) in self._lanes.items() if queue
+        ]
+        return min(delays, default=None)
+
+    def Close(self, *, drop_queued: bool = False) -> None:
+        """Stops accepting messages. Next() returns None once the queued
+        messages have been sent, or immediately if drop_queued is set.
+        """
+        self._closed = True
+        if drop_queued:
+            for (lane, queue) in self._lanes.items():
+                queue.clear()
+                self._stats[lane].queued = 0
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    async def Next(self) -> Optional[Message]:
+        """Waits until a message can be sent and returns it. Returns None once
+        closed and empty.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            msg = self.Pop()
+            if msg is not None:
+                return msg
+            delay = self.TimeUntilReady()
+            if delay is None and self._closed:
+                return None
+            wakeup = self._wakeup = loop.create_future()
+            timer = None
+            if delay is not None:
+                timer = loop.call_later(delay, _SetResult, wakeup)
+            try:
+                await wakeup
+            finally:
+                self._wakeup = None
+                if timer is not None:
+                    timer.cancel()
+
+    def Stats(self) -> Dict[Lane, LaneStats]:
+        """Returns a copy of the queue depth and wait time stats of each lane."""
+        return {lane: attr.evolve(stats) for (lane, stats) in self._stats.items()}
+
+
+def _SetResult(future: "asyncio.Future[None]") -> None:
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,145 @@
+"""Shared plumbing for the SQLite backed stores."""
+
+import asyncio
+import concurrent.futures
+import logging
+import sqlite3
+from typing import Any, List, Optional, Sequence, Tuple
+
+import attr
+
+LOG = logging.Logger(__name__)
+
+# An SQL statement and its parameters.
+Statement = Tuple[str, Sequence[Any]]
+
+
+def OpenDatabase(path: str, *, check_same_thread: bool = True) -> sqlite3.Connection:
+    """Opens a database in WAL mode, so that reads on the event loop don't
+    wait for writes committing on another connection.
+    """
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=check_same_thread)
+    db.execute("PRAGMA journal_mode=WAL")
+    # With WAL, a crash may lose the last commits but never corrupts the
+    # database.
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA busy_timeout=5000")
+    return db
+
+
+@attr.s(auto_attribs=True)
+class WriteStats:
+    writes: int = 0
+    # Transactions committed, each with every write queued since the last.
+    batches: int = 0
+    max_batch: int = 0
+    # Batches that failed to commit, and were retried one write at a time.
+    failed_batches: int = 0
+    failed_writes: int = 0
+
+
+class WriteBatcher:
+    """Applies writes to a database on a background thread.
+
+    Writes queued while a batch is committing are committed together in the
+    next, so the number of transactions, and fsyncs, grows with the time
+    spent writing rather than with the number of writes. Each write's
+    future completes once its batch is committed.
+
+    If a batch fails, its writes are retried in a transaction each, so that
+    one bad write doesn't undo the others. Only the futures of the writes
+    that fail again get the error.
+    """
+    _db: sqlite3.Connection
+    _executor: concurrent.futures.ThreadPoolExecutor
+    _queue: List[Tuple[Statement, "asyncio.Future[None]"]]
+    _flush_task: "Optional[asyncio.Task[None]]"
+    _stats: WriteStats
+
+    def __init__(self, path: str):
+        # Only ever used on the executor's one thread.
+        self._db = OpenDatabase(path, check_same_thread=False)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._queue = []
+        self._flush_task = None
+        self._stats = WriteStats()
+
+    def Stats(self) -> WriteStats:
+        return attr.evolve(self._stats)
+
+    def Pending(self) -> int:
+        return len(self._queue)
+
+    def Write(self, sql: str, params: Sequence[Any] = ()) -> "asyncio.Future[None]":
+        future = asyncio.get_event_loop().create_future()  # type: asyncio.Future[None]
+        self._queue.append(((sql, params), future))
+        self._stats.writes += 1
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._FlushLoop())
+        return future
+
+    async def Flush(self) -> None:
+        """Waits until every write queued so far is committed."""
+        if self._queue:
+            await asyncio.wait([self._queue[-1][1]])
+        elif self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+
+    async def _FlushLoop(self) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            while self._queue:
+                (batch, self._queue) = (self._queue, [])
+                statements = [statement for (statement, _) in batch]
+                try:
+                    await loop.run_in_executor(self._executor, self._Commit, statements)
+                    errors = [None] * len(batch)  # type: List[Optional[Exception]]
+                except Exception:
+                    LOG.exception("Committing %d writes failed, retrying them one by one",
+                                  len(batch))
+                    self._stats.failed_batches += 1
+                    errors = await loop.run_in_executor(
+                        self._executor, self._CommitEach, statements)
+                self._stats.batches += 1
+                self._stats.max_batch = max(self._stats.max_batch, len(batch))
+                for ((_, future), error) in zip(batch, errors):
+                    if error is not None:
+                        self._stats.failed_writes += 1
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+        finally:
+            self._flush_task = None
+
+    def _Commit(self, statements: List[Statement]) -> None:
+        self._db.execute("BEGIN")
+        try:
+            for (sql, params) in statements:
+                self._db.execute(sql, params)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _CommitEach(self, statements: List[Statement]) -> List[Optional[Exception]]:
+        """Commits each statement on its own, and returns the error of each,
+        or None for those that were committed.
+        """
+        errors = []  # type: List[Optional[Exception]]
+        for statement in statements:
+            try:
+                self._Commit([statement])
+            except Exception as e:
+                LOG.error("Write failed: %s: %r", statement[0], e)
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+    async def Close(self) -> None:
+        await self.Flush()
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._db.close)
+        self._executor.shutdown()
@@ -0,0 +1,362 @@
+"""Reference implementations and fakes for testing minibot_server.irc."""
+
+import asyncio
+import re
+import socket
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from ..async_util import CloseableQueue
+from ..irc import Message
+
+
+class _BytesMuncher:
+    _bytestr: bytes
+
+    def __init__(self, bytestr: bytes):
+        self._bytestr = bytestr
+
+    def SplitToSpace(self) -> bytes:
+        m = re.match(rb'([^ ]+)($|[ ]+)', self._bytestr)
+        if m:
+            self._bytestr = self._bytestr[m.end():]
+            return m.group(1)
+        else:
+            raise ValueError()
+
+    def HasFirstChar(self, firstchar: bytes) -> bool:
+        if not self._bytestr:
+            return False
+        return self._bytestr[0] == ord(firstchar)
+
+    def IsEmpty(self) -> bool:
+        return not self._bytestr
+
+    def Rest(self) -> bytes:
+        return self._bytestr
+
+
+def ReferenceUnescapeTagValue(tag_value: bytes) -> bytes:
+    """The original byte-at-a-time tag value unescaper."""
+    result = bytearray()
+    curr_index = 0
+    while curr_index < len(tag_value):
+        curr_byte = tag_value[curr_index]
+        curr_index += 1
+        if curr_byte != ord(b'\\'):
+            result.append(curr_byte)
+        elif curr_index != len(tag_value):
+            next_byte = tag_value[curr_index]
+            curr_index += 1
+            if next_byte == ord(b':'):
+                result.append(ord(b';'))
+            elif next_byte == ord(b's'):
+                result.append(ord(b' '))
+            elif next_byte == ord(b'\\'):
+                result.append(ord(b'\\'))
+            elif next_byte == ord(b'r'):
+                result.append(ord(b'\r'))
+            elif next_byte == ord(b'n'):
+                result.append(ord(b'\n'))
+            else:
+                result.append(next_byte)
+    return bytes(result)
+
+
+def ReferenceEscapeTagValue(tag_value: bytes) -> bytes:
+    """The original byte-at-a-time tag value escaper."""
+    result = bytearray()
+    for b in tag_value:
+        if b == ord(b';'):
+            result.extend(rb'\:')
+        elif b == ord(b' '):
+            result.extend(rb'\s')
+        elif b == ord(b'\\'):
+            result.extend(rb'\\')
+        elif b == ord(b'\r'):
+            result.extend(rb'\r')
+        elif b == ord(b'\n'):
+            result.extend(rb'\n')
+        else:
+            result.append(b)
+    return bytes(result)
+
+
+def ReferenceParse(msg_data: bytes) -> Tuple[Optional[bytes], bytes, List[bytes], Dict[bytes, bytes]]:
+    """The original regex-based IRC line parser.
+
+    Returns a (prefix, command, args, tags) tuple rather than a Message so that
+    it stays independent of the Message implementation under test.
+    """
+    tags_part = None  # type: Union[bytes, None]
+    prefix = None  # type: Union[bytes, None]
+    args = []  # type: List[bytes]
+    muncher = _BytesMuncher(msg_data)
+    if muncher.HasFirstChar(b'@'):
+        tags_part = muncher.SplitToSpace()[1:]
+    if muncher.HasFirstChar(b':'):
+        prefix = muncher.SplitToSpace()[1:]
+    command = muncher.SplitToSpace().upper()
+    while not muncher.IsEmpty() and not muncher.HasFirstChar(b':'):
+        args.append(muncher.SplitToSpace())
+    if not muncher.IsEmpty():
+        args.append(muncher.Rest()[1:])
+
+    tags = {}  # type: Dict[bytes, bytes]
+    if tags_part is not None:
+        for tag_entry in tags_part.split(b';'):
+            entry_parts = tag_entry.split(b'=', 1)
+            if len(entry_parts) == 1:
+                tags[entry_parts[0]] = b''
+            else:
+                (key, value) = entry_parts
+                tags[key] = ReferenceUnescapeTagValue(value)
+
+    return (prefix, command, args, tags)
+
+
+class FakeIrcConnection:
+    """The server side of a client connection to FakeIrcServer."""
+    joined: Set[bytes]
+    _reader: asyncio.StreamReader
+    _writer: asyncio.StreamWriter
+    _received: CloseableQueue[Message]
+    _read_task: "asyncio.Task[None]"
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.joined = set()
+        self._reader = reader
+        self._writer = writer
+        self._received = CloseableQueue()
+        self._read_task = asyncio.ensure_future(self._ProcessReader())
+
+    async def _ProcessReader(self) -> None:
+        try:
+            while True:
+                line = await self._reader.readuntil(b'\r\n')
+                msg = Message.Parse(line[:-2])
+                if msg.command == b'JOIN':
+                    self.joined.update(msg.args[0].split(b','))
+                elif msg.command == b'PART':
+                    self.joined.difference_update(msg.args[0].split(b','))
+                await self._received.Put(msg)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._received.Close()
+            # Like a real server, hang up once the client has finished.
+            self._writer.close()
+
+    async def Receive(self) -> Optional[Message]:
+        """Returns the next message from the client, or None once it has
+        closed the connection.
+        """
+        return await self._received.Get()
+
+    async def ReceiveUntil(self, command: bytes) -> Message:
+        """Returns the next message from the client with the given command,
+        skipping any others.
+        """
+        while True:
+            msg = await self.Receive()
+            if msg is None:
+                raise EOFError()
+            if msg.command == command:
+                return msg
+
+    def Send(self, *messages: Message) -> None:
+        self.SendRaw(b''.join(msg.ToWireFormat() + b'\r\n' for msg in messages))
+
+    def SendRaw(self, data: bytes) -> None:
+        self._writer.write(data)
+
+    def Drop(self) -> None:
+        """Closes the connection from the server side."""
+        self._writer.close()
+
+    def Reset(self) -> None:
+        """Closes the connection with a TCP reset, as if the server crashed."""
+        sock = self._writer.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self._writer.transport.abort()
+
+    async def WaitClosed(self) -> None:
+        await self._read_task
+
+
+class FakeIrcServer:
+    """A plaintext IRC server on localhost that hands each client connection
+    to the test.
+    """
+    connections: List[FakeIrcConnection]
+    _server: Optional[asyncio.AbstractServer]
+    _new_connections: CloseableQueue[FakeIrcConnection]
+
+    def __init__(self) -> None:
+        self.connections = []
+        self._server = None
+        self._new_connections = CloseableQueue()
+
+    async def Start(self) -> int:
+        """Starts listening, and returns the port to connect to."""
+        self._server = await asyncio.start_server(self._OnConnect, '127.0.0.1', 0)
+        return int(self._server.sockets[0].getsockname()[1])
+
+    async def _OnConnect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = FakeIrcConnection(reader, writer)
+        self.connections.append(connection)
+        await self._new_connections.Put(connection)
+
+    async def Accept(self) -> FakeIrcConnection:
+        """Returns the next connection made to the server."""
+        connection = await self._new_connections.Get()
+        assert connection is not None
+        return connection
+
+    def Stop(self) -> None:
+        assert self._server is not None
+        self._server.close()
+        for connection in self.connections:
+            connection.Drop()
+
+
+class TrafficRecording:
+    """IRC lines received from a server, each with the seconds since the
+    first line.
+
+    Saved as one line per entry: the time offset, a space, then the raw IRC
+    line without its CRLF.
+    """
+    entries: List[Tuple[float, bytes]]
+
+    @classmethod
+    def Load(cls, path: str) -> "TrafficRecording":
+        recording = cls()
+        with open(path, 'rb') as f:
+            for line in f:
+                (offset, _, irc_line) = line.rstrip(b'\n').partition(b' ')
+                recording.entries.append((float(offset), irc_line))
+        return recording
+
+    @classmethod
+    def Synthetic(cls, lines: Iterable[bytes], rate: float) -> "TrafficRecording":
+        """Returns a recording of the lines arriving evenly at rate lines per
+        second.
+        """
+        recording = cls()
+        recording.entries = [(i / rate, line) for (i, line) in enumerate(lines)]
+        return recording
+
+    def __init__(self) -> None:
+        self.entries = []
+
+    def Save(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            for (offset, line) in self.entries:
+                f.write(b'%.6f %s\n' % (offset, line))
+
+    def Lines(self) -> List[bytes]:
+        return [line for (_, line) in self.entries]
+
+
+class TrafficRecorder:
+    """A line filter for IrcClientChannel that records every line read from
+    the server, and accepts them all.
+    """
+    recording: TrafficRecording
+    _start: Optional[float]
+
+    def __init__(self) -> None:
+        self.recording = TrafficRecording()
+        self._start = None
+
+    def __call__(self, line: bytes) -> bool:
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        self.recording.entries.append((now - self._start, line))
+        return True
+
+
+class ReplayIrcServer:
+    """A plaintext IRC server on localhost that replays a recording to each
+    client that connects, then closes the connection.
+
+    Lines are sent at the pace they were recorded at, sped up by a factor of
+    speed, or as fast as the client reads them if speed is None. Lines that
+    are due at the same time are sent with a single write. The time each line
+    was sent to the latest client, from time.perf_counter(), is kept in
+    sent_at so that the client can measure latency.
+    """
+    sent_at: List[float]
+    _recording: TrafficRecording
+    _speed: Optional[float]
+    _server: Optional[asyncio.AbstractServer]
+    _replays: CloseableQueue["asyncio.Task[None]"]
+
+    def __init__(self, recording: TrafficRecording, *, speed: Optional[float] = 1.0):
+        self.sent_at = []
+        self._recording = recording
+        self._speed = speed
+        self._server = None
+        self._replays = CloseableQueue()
+
+    async def Start(self) -> int:
+        """Starts listening, and returns the port to connect to."""
+        self._server = await asyncio.start_server(self._OnConnect, '127.0.0.1', 0)
+        return int(self._server.sockets[0].getsockname()[1])
+
+    async def _OnConnect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await self._replays.Put(asyncio.ensure_future(self._Replay(reader, writer)))
+
+    async def _Replay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Discard whatever the client sends, so it never blocks on writing.
+        discard_task = asyncio.ensure_future(_Discard(reader))
+        self.sent_at = sent_at = []
+        entries = self._recording.entries
+        speed = self._speed
+        start = time.perf_counter()
+        i = 0
+        try:
+            while i < len(entries):
+                if speed is None:
+                    end = len(entries)
+                else:
+                    now = time.perf_counter()
+                    due = start + entries[i][0] / speed
+                    if due > now:
+                        await asyncio.sleep(due - now)
+                        now = time.perf_counter()
+                    end = i + 1
+                    while end < len(entries) and start + entries[end][0] / speed <= now:
+                        end += 1
+                lines = [line for (_, line) in entries[i:end]]
+                lines.append(b'')
+                writer.write(b'\r\n'.join(lines))
+                sent_at.extend([time.perf_counter()] * (end - i))
+                await writer.drain()
+                i = end
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            discard_task.cancel()
+
+    async def WaitReplayed(self) -> None:
+        """Waits until the next client has been sent the whole recording."""
+        replay = await self._replays.Get()
+        assert replay is not None
+        await replay
+
+    def Stop(self) -> None:
+        assert self._server is not None
+        self._server.close()
+
+
+async def _Discard(reader: asyncio.StreamReader) -> None:
+    try:
+        while await reader.read(1 << 16):
+            pass
+    except ConnectionError:
+        pass
@@ -0,0 +1,107 @@
+"""A local stand-in for an OAuth provider's JWKS endpoint."""
+
+import asyncio
+import base64
+import json
+import secrets
+import time
+from typing import Any, Dict, List, Optional
+
+import jwt
+from tornado import web
+
+
+def _Encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class FakeKeySet:
+    """Signing keys that can be published as a JWKS document and used to
+    sign ID tokens.
+
+    By default keys are HMAC secrets, which PyJWT handles without the
+    cryptography package. With algorithm='RS256', they are RSA keys like
+    real providers use, which needs it.
+    """
+    _algorithm: str
+    # The key each token is signed with, and the JWK published for it.
+    _signing_keys: Dict[str, Any]
+    _jwks: Dict[str, Dict[str, str]]
+    issuer: str
+    # Value of the Cache-Control header served with the keys, if any.
+    cache_control: Optional[str]
+    # Seconds each fetch of the keys takes.
+    fetch_delay: float
+    fetches: int
+
+    def __init__(self, issuer: str = 'https://fake.issuer', *, algorithm: str = 'HS256') -> None:
+        self._algorithm = algorithm
+        self._signing_keys = {}
+        self._jwks = {}
+        self.issuer = issuer
+        self.cache_control = 'public, max-age=3600'
+        self.fetch_delay = 0.0
+        self.fetches = 0
+
+    def AddKey(self) -> str:
+        """Adds a new key, and returns its kid."""
+        kid = secrets.token_hex(8)
+        if self._algorithm == 'HS256':
+            secret = secrets.token_bytes(32)
+            self._signing_keys[kid] = secret
+            jwk = {'kty': 'oct', 'k': _Encode(secret)}
+        elif self._algorithm == 'RS256':
+            from cryptography.hazmat.primitives.asymmetric import rsa
+            from jwt.algorithms import RSAAlgorithm
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            self._signing_keys[kid] = private_key
+            jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+        else:
+            raise ValueError(self._algorithm)
+        self._jwks[kid] = dict(jwk, kid=kid, alg=self._algorithm, use='sig')
+        return kid
+
+    def RemoveKey(self, kid: str) -> None:
+        del self._signing_keys[kid]
+        del self._jwks[kid]
+
+    def Document(self) -> Dict[str, List[Dict[str, str]]]:
+        return {'keys': list(self._jwks.values())}
+
+    def SignIdToken(self, kid: str, *, audience: str, subject: str = '12345',
+                    lifetime: int = 900, **claims: Any) -> str:
+        now = int(time.time())
+        payload = dict({
+            'iss': self.issuer,
+            'aud': audience,
+            'sub': subject,
+            'iat': now,
+            'exp': now + lifetime,
+        }, **claims)
+        token = jwt.encode(payload, self._signing_keys[kid], algorithm=self._algorithm,
+                           headers={'kid': kid})
+        # PyJWT before 2.0 returns bytes.
+        return token.decode('ascii') if isinstance(token, bytes) else token
+
+
+class _KeysHandler(web.RequestHandler):
+    _key_set: FakeKeySet
+
+    def initialize(self, key_set: FakeKeySet) -> None:
+        self._key_set = key_set
+
+    async def get(self) -> None:
+        self._key_set.fetches += 1
+        if self._key_set.fetch_delay:
+            await asyncio.sleep(self._key_set.fetch_delay)
+        if self._key_set.cache_control is not None:
+            self.set_header('Cache-Control', self._key_set.cache_control)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(self._key_set.Document()))
+
+
+def MakeJwksApp(key_set: FakeKeySet) -> web.Application:
+    """Returns an application serving the key set at /keys."""
+    return web.Application([
+        (r'/keys', _KeysHandler, dict(key_set=key_set)),
+    ])
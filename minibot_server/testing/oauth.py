@@ -1,9 +1,11 @@
-from typing import Dict, List, Optional, Awaitable, Set
+from typing import Dict, List, Optional, Awaitable, Set, Tuple
+import asyncio
 import attr
 import secrets
 import urllib
-from tornado.httpclient import (AsyncHTTPClient, HTTPRequest)
+from tornado.httpclient import HTTPRequest
 
+from ..http_client import HttpClient
 from ..oauth import (Timestamp, OAuthToken, AccessToken, OAuthProvider, RefreshableToken, RefreshResult)
 
 @attr.s(auto_attribs=True)
@@ -13,18 +15,43 @@ class _AuthInfo:
     scopes: List[str]
 
 class FakeOAuthProvider(OAuthProvider):
-    _client: AsyncHTTPClient
+    _client: HttpClient
     _pending_auths: Dict[str, _AuthInfo]
     _pending_codes: Dict[str, _AuthInfo]
     _valid_refresh_tokens: Set[str]
+    # Seconds issued access tokens last for, or None if they never expire.
+    token_lifetime: Optional[int]
+    # Seconds each ExchangeCode() and GetTokenFromRefresh() call takes.
+    exchange_delay: float
+    refresh_delay: float
+    # The number of GetTokenFromRefresh() calls made.
+    refresh_calls: int
 
-    def __init__(self) -> None:
-        self._client = AsyncHTTPClient()
+    def __init__(self, http_client: HttpClient, *,
+                 token_lifetime: Optional[int] = None) -> None:
+        self._client = http_client
         self._pending_auths = {}
         self._pending_codes = {}
         self._valid_refresh_tokens = set()
+        self.token_lifetime = token_lifetime
+        self.exchange_delay = 0.0
+        self.refresh_delay = 0.0
+        self.refresh_calls = 0
 
-    async def AcceptAuth(self, redirect_url: str, auth_url: str) -> None:
+    def IssueToken(self, current_time: Timestamp) -> RefreshableToken:
+        """Returns a new token, as if a code had been exchanged for it."""
+        expires = None  # type: Optional[Timestamp]
+        if self.token_lifetime is not None:
+            expires = Timestamp(current_time + self.token_lifetime)
+        access_token = AccessToken(OAuthToken(secrets.token_urlsafe(10)), expires)
+        refresh_token = OAuthToken(secrets.token_urlsafe(10))
+        self._valid_refresh_tokens.add(refresh_token)
+        return RefreshableToken(access_token, refresh_token)
+
+    def IssueCode(self, auth_url: str) -> Tuple[str, str]:
+        """Accepts an auth request, and returns the state and code to call
+        back with.
+        """
         parts = urllib.parse.urlsplit(auth_url)
         assert parts.scheme == 'http'
         assert parts.netloc == 'nonexistent.server'
@@ -36,13 +63,17 @@ class FakeOAuthProvider(OAuthProvider):
         # Make a callback with the OAuth parts expected
         code = secrets.token_urlsafe(10)
         self._pending_codes[code] = auth_info
+        return (auth_info.state, code)
+
+    async def AcceptAuth(self, redirect_url: str, auth_url: str) -> None:
+        (state, code) = self.IssueCode(auth_url)
         callback_args = {
             'code': code,
-            'state': auth_info.state
+            'state': state
         }
         callback_url = f"{redirect_url}?{urllib.parse.urlencode(callback_args)}"
         req = HTTPRequest(callback_url)
-        await self._client.fetch(req)
+        await self._client.Fetch(req)
 
     # Overrides
     def AuthUrl(self, *, state_token: str, scopes: List[str], nonce: Optional[str] = None) -> str:
@@ -58,18 +89,21 @@ class FakeOAuthProvider(OAuthProvider):
 
     async def ExchangeCode(self, current_time: Timestamp, code: str) -> RefreshableToken:
         self._pending_codes.pop(code)
-        access_token = AccessToken(OAuthToken(secrets.token_urlsafe(10)))
-        refresh_token = OAuthToken(secrets.token_urlsafe(10))
-        self._valid_refresh_tokens.add(refresh_token)
-        return RefreshableToken(access_token, refresh_token)
+        if self.exchange_delay:
+            await asyncio.sleep(self.exchange_delay)
+        return self.IssueToken(current_time)
 
     async def GetTokenFromRefresh(self, refresh_token: str) -> RefreshResult:
+        self.refresh_calls += 1
+        if self.refresh_delay:
+            await asyncio.sleep(self.refresh_delay)
+        # Refresh tokens are rotated, so each can only be used once.
         self._valid_refresh_tokens.remove(refresh_token)
-        refresh_token = OAuthToken(secrets.token_urlsafe(10))
-        self._valid_refresh_tokens.add(refresh_token)
+        new_refresh_token = OAuthToken(secrets.token_urlsafe(10))
+        self._valid_refresh_tokens.add(new_refresh_token)
         return RefreshResult(
             access_token = OAuthToken(secrets.token_urlsafe(10)),
-            refresh_token = None,
-            expires_in = None,
+            refresh_token = new_refresh_token,
+            expires_in = self.token_lifetime,
         )
 
@@ -0,0 +1,195 @@
+"""Background refreshing of the OAuth tokens of every user."""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import attr
+
+from .oauth import OAuthProvider, Timestamp
+from .users import BaseUserStore, TwitchUser, User
+
+LOG = logging.Logger(__name__)
+
+Clock = Callable[[], Timestamp]
+
+
+def _Now() -> Timestamp:
+    return Timestamp(int(time.time()))
+
+
+@attr.s(auto_attribs=True)
+class RefreshStats:
+    # Tokens waiting for their refresh time.
+    scheduled: int = 0
+    refreshed: int = 0
+    failed: int = 0
+    # Seconds between when tokens were due to be refreshed and when their
+    # refresh started.
+    total_lag: int = 0
+    max_lag: int = 0
+
+
+class TokenRefreshScheduler:
+    """Refreshes the tokens of Twitch users shortly before they expire, so
+    that reading a token on the request path never has to wait for Twitch.
+
+    Tokens are kept in a heap ordered by the time they should be refreshed
+    at (see RefreshableToken.RefreshAt()). The tokens that are due are
+    refreshed together, at most max_concurrent at a time. A token whose
+    refresh fails is tried again after retry_delay seconds. Watch() keeps
+    the schedule in step with a user store.
+    """
+    _provider: OAuthProvider
+    _clock: Clock
+    _max_concurrent: int
+    _retry_delay: int
+    # (refresh time, sequence number, user) entries. Entries whose sequence
+    # number is no longer the one in _sequence_numbers are stale.
+    _heap: List[Tuple[Timestamp, int, TwitchUser]]
+    _sequence_numbers: Dict[TwitchUser, int]
+    # Users whose refresh is running, and who are scheduled again once it
+    # is done unless they are unscheduled in the meantime.
+    _refreshing: Set[TwitchUser]
+    _counter: "itertools.count[int]"
+    _stats: RefreshStats
+    _wakeup: Optional["asyncio.Future[None]"]
+    _run_task: "Optional[asyncio.Task[None]]"
+
+    def __init__(self, provider: OAuthProvider, *, max_concurrent: int = 10,
+                 retry_delay: int = 60, clock: Clock = _Now):
+        self._provider = provider
+        self._clock = clock
+        self._max_concurrent = max_concurrent
+        self._retry_delay = retry_delay
+        self._heap = []
+        self._sequence_numbers = {}
+        self._refreshing = set()
+        self._counter = itertools.count()
+        self._stats = RefreshStats()
+        self._wakeup = None
+        self._run_task = None
+
+    def Schedule(self, twitch_user: TwitchUser, at: Optional[Timestamp] = None) -> None:
+        """Schedules the user's token to be refreshed at the given time, or
+        when it is due to be otherwise. Replaces any earlier schedule.
+        """
+        if at is None:
+            at = twitch_user.Token().RefreshAt()
+        if at is None:
+            # The token never expires.
+            self.Unschedule(twitch_user)
+            return
+        sequence_number = next(self._counter)
+        if twitch_user not in self._sequence_numbers:
+            self._stats.scheduled += 1
+        self._sequence_numbers[twitch_user] = sequence_number
+        heapq.heappush(self._heap, (at, sequence_number, twitch_user))
+        if self._heap[0][1] == sequence_number and self._wakeup is not None and not self._wakeup.done():
+            # The new entry is first, so the run loop may be sleeping too long.
+            self._wakeup.set_result(None)
+
+    def ScheduleUser(self, user: User) -> None:
+        for twitch_user in user.TwitchUsers():
+            self.Schedule(twitch_user)
+
+    def ScheduleAll(self, users: BaseUserStore) -> None:
+        for user in users.AllUsers():
+            self.ScheduleUser(user)
+
+    def Watch(self, users: BaseUserStore) -> None:
+        """Schedules every user in the store, and from then on schedules the
+        users added to it and unschedules the users removed from it.
+        """
+        users.AddTwitchUserListeners(added=self.Schedule, removed=self.Unschedule)
+        self.ScheduleAll(users)
+
+    def Unschedule(self, twitch_user: TwitchUser) -> None:
+        self._refreshing.discard(twitch_user)
+        # The heap entry is left behind, and skipped once it is popped.
+        if self._sequence_numbers.pop(twitch_user, None) is not None:
+            self._stats.scheduled -= 1
+
+    def NextRefreshAt(self) -> Optional[Timestamp]:
+        self._DropStale()
+        return self._heap[0][0] if self._heap else None
+
+    def _DropStale(self) -> None:
+        heap = self._heap
+        while heap and self._sequence_numbers.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+
+    async def RefreshDue(self) -> int:
+        """Refreshes every token that is due now, and returns how many."""
+        now = self._clock()
+        due = []  # type: List[Tuple[Timestamp, TwitchUser]]
+        while self.NextRefreshAt() is not None and self._heap[0][0] <= now:
+            (at, _, twitch_user) = heapq.heappop(self._heap)
+            self.Unschedule(twitch_user)
+            self._refreshing.add(twitch_user)
+            due.append((at, twitch_user))
+        if not due:
+            return 0
+
+        slots = asyncio.Semaphore(self._max_concurrent)
+
+        async def RefreshOne(at: Timestamp, twitch_user: TwitchUser) -> None:
+            async with slots:
+                start = self._clock()
+                lag = max(0, start - at)
+                self._stats.total_lag += lag
+                self._stats.max_lag = max(self._stats.max_lag, lag)
+                try:
+                    await twitch_user.Token().Refresh(start, self._provider)
+                except Exception:
+                    LOG.exception("Refreshing the token of Twitch user %s failed", twitch_user.twitch_id)
+                    self._stats.failed += 1
+                    retry_at = Timestamp(self._clock() + self._retry_delay)  # type: Optional[Timestamp]
+                else:
+                    self._stats.refreshed += 1
+                    retry_at = None
+                if twitch_user in self._refreshing:
+                    self._refreshing.discard(twitch_user)
+                    self.Schedule(twitch_user, retry_at)
+
+        await asyncio.gather(*[RefreshOne(at, twitch_user) for (at, twitch_user) in due])
+        return len(due)
+
+    def Start(self) -> None:
+        self._run_task = asyncio.ensure_future(self._Run())
+
+    async def Stop(self) -> None:
+        if self._run_task is not None:
+            self._run_task.cancel()
+            try:
+                await self._run_task
+            except asyncio.CancelledError:
+                pass
+            self._run_task = None
+
+    async def _Run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.RefreshDue()
+            next_at = self.NextRefreshAt()
+            wakeup = self._wakeup = loop.create_future()
+            timer = None
+            if next_at is not None:
+                timer = loop.call_later(max(0, next_at - self._clock()), _SetResult, wakeup)
+            try:
+                await wakeup
+            finally:
+                self._wakeup = None
+                if timer is not None:
+                    timer.cancel()
+
+    def Stats(self) -> RefreshStats:
+        return attr.evolve(self._stats)
+
+
+def _SetResult(future: "asyncio.Future[None]") -> None:
+    if not future.done():
+        future.set_result(None)
@@ -1,10 +1,33 @@
-from typing import Dict, Mapping, Any, NewType, Set, Optional, List
+from typing import (Dict, Mapping, Any, Callable, NewType, Set, Optional, List, Sequence, Tuple,
+                    Generic, TypeVar)
 from .users import UserId
 from .oauth import Timestamp
+from .sqlite_store import OpenDatabase, WriteBatcher, WriteStats
+from abc import ABC, abstractmethod
 
+import asyncio
+import collections
+import hashlib
+import heapq
+import itertools
+import logging
 import secrets
+import sqlite3
+import time
 import attr
 
+LOG = logging.Logger(__name__)
+
+Clock = Callable[[], Timestamp]
+
+
+def _Now() -> Timestamp:
+    return Timestamp(int(time.time()))
+
+# What clients authenticate with. Only ever handed out once, by CreateToken.
+TokenSecret = NewType("TokenSecret", str)
+# Identifies a token without giving access to it: a keyed hash of its
+# secret. Safe to keep, log and show.
 TokenId = NewType("TokenId", str)
 
 @attr.s(auto_attribs=True)
@@ -13,42 +36,601 @@ class Token:
     user: UserId
     created_at: Timestamp
     desc: Optional[str] = None
+    # None if the token never expires.
+    expires_at: Optional[Timestamp] = None
+
+    def Expired(self, current_time: Timestamp) -> bool:
+        return self.expires_at is not None and self.expires_at <= current_time
+
+
+@attr.s(auto_attribs=True)
+class TokenStoreStats:
+    # Tokens in the store, including expired tokens not yet swept.
+    live: int = 0
+    created: int = 0
+    revoked: int = 0
+    # Expired tokens swept from the store.
+    expired: int = 0
+
+
+class TokenHasher:
+    """Derives token ids from token secrets, with BLAKE2s keyed by a server
+    key.
+
+    Stores keep only ids, so their contents, in memory or on disk, can't be
+    used to authenticate. Looking a secret up is hashing it and an ordinary
+    lookup of the id. Timing that lookup only tells an attacker about ids of
+    secrets they chose, which they can't compute without the key, so it
+    needs no constant-time comparison.
+    """
+    _keyed: "hashlib.blake2s"
+
+    def __init__(self, key: Optional[bytes] = None):
+        """Without a key, a random one is used, and ids change with every
+        process.
+        """
+        if key is None:
+            key = secrets.token_bytes(32)
+        # Copying a hash that has already taken the key is cheaper than
+        # keying a new one for every secret. Ids only need to be hard to
+        # guess and not to collide, which 128 bits are plenty for, and for
+        # inputs this short BLAKE2s is about a third cheaper than BLAKE2b.
+        self._keyed = hashlib.blake2s(key=key, digest_size=16, person=b'minibot')
+
+    def IdFor(self, secret: TokenSecret) -> TokenId:
+        hasher = self._keyed.copy()
+        hasher.update(secret.encode())
+        return TokenId(hasher.hexdigest())
 
+    def NewSecret(self) -> Tuple[TokenSecret, TokenId]:
+        secret = TokenSecret(secrets.token_urlsafe(30))
+        return (secret, self.IdFor(secret))
 
-class TokenStore:
+
+class BaseTokenStore(ABC):
+    @abstractmethod
+    def IdFor(self, secret: TokenSecret) -> TokenId: ...
+
+    @abstractmethod
+    def CreateToken(self, user_id: UserId, current_time: Timestamp, *,
+                    ttl: Optional[int] = None) -> Tuple[TokenSecret, Token]:
+        """Creates a token that expires ttl seconds from current_time, or
+        never if ttl is None, and returns it with its secret. The secret
+        can't be recovered afterwards.
+        """
+
+    def FindToken(self, secret: TokenSecret, current_time: Timestamp) -> Optional[Token]:
+        """Returns the token with the given secret, unless it has expired."""
+        return self.FindTokenById(self.IdFor(secret), current_time)
+
+    @abstractmethod
+    def FindTokenById(self, token_id: TokenId, current_time: Timestamp) -> Optional[Token]:
+        """Like FindToken(), for callers that already have the secret's id,
+        so that it is only hashed once.
+        """
+
+    @abstractmethod
+    def FindUserTokens(self, user_id: UserId) -> List[Token]:
+        """Returns the user's tokens, including expired tokens not yet
+        swept.
+        """
+
+    @abstractmethod
+    def RevokeToken(self, token_id: TokenId) -> Optional[Token]:
+        """Revokes a token, and returns it, or None if there was none."""
+
+    @abstractmethod
+    def RevokeUserTokens(self, user_id: UserId) -> None: ...
+
+    @abstractmethod
+    def NextExpiry(self) -> Optional[Timestamp]:
+        """Returns the earliest expiry time of the tokens in the store, or
+        None if none of them expire.
+        """
+
+    @abstractmethod
+    def Sweep(self, current_time: Timestamp, limit: int) -> List[Token]:
+        """Removes up to limit tokens that have expired by current_time,
+        earliest first, and returns them.
+        """
+
+
+class TokenStore(BaseTokenStore):
+    _hasher: TokenHasher
     _tokens: Dict[TokenId, Token]
     _tokens_by_user: Dict[UserId, Set[TokenId]]
+    # (expiry time, token id) entries for the tokens that expire. Entries of
+    # revoked tokens are left behind, and skipped once they are popped.
+    _expiries: List[Tuple[Timestamp, TokenId]]
+    _stats: TokenStoreStats
 
-    def __init__(self) -> None:
+    def __init__(self, hasher: Optional[TokenHasher] = None) -> None:
+        self._hasher = TokenHasher() if hasher is None else hasher
         self._tokens = {}
         self._tokens_by_user = {}
+        self._expiries = []
+        self._stats = TokenStoreStats()
+
+    def Stats(self) -> TokenStoreStats:
+        return attr.evolve(self._stats, live = len(self._tokens))
 
-    def CreateToken(self, user_id: UserId, current_time: Timestamp) -> Token:
-        token_id = TokenId(secrets.token_urlsafe(30))
-        token = Token(id = token_id, user = user_id, created_at = current_time)
+    def IdFor(self, secret: TokenSecret) -> TokenId:
+        return self._hasher.IdFor(secret)
+
+    def CreateToken(self, user_id: UserId, current_time: Timestamp, *,
+                    ttl: Optional[int] = None) -> Tuple[TokenSecret, Token]:
+        (secret, token_id) = self._hasher.NewSecret()
+        expires_at = None if ttl is None else Timestamp(current_time + ttl)
+        token = Token(id = token_id, user = user_id, created_at = current_time,
+                      expires_at = expires_at)
         self._tokens[token_id] = token
         self._tokens_by_user.setdefault(user_id, set()).add(token_id)
-        return token
+        if expires_at is not None:
+            heapq.heappush(self._expiries, (expires_at, token_id))
+        self._stats.created += 1
+        return (secret, token)
 
-    def FindToken(self, token_id: TokenId) -> Optional[Token]:
-        return self._tokens.get(token_id, None)
+    def FindTokenById(self, token_id: TokenId, current_time: Timestamp) -> Optional[Token]:
+        token = self._tokens.get(token_id, None)
+        if token is None or token.Expired(current_time):
+            return None
+        return token
 
     def FindUserTokens(self, user_id: UserId) -> List[Token]:
         return [self._tokens[id] for id in self._tokens_by_user.get(user_id, set())]
 
-    def RevokeToken(self, token_id: TokenId) -> None:
-        try:
+    def _Remove(self, token: Token) -> None:
+        del self._tokens[token.id]
+        user_tokens = self._tokens_by_user[token.user]
+        user_tokens.remove(token.id)
+        if not user_tokens:
+            del self._tokens_by_user[token.user]
+
+    def RevokeToken(self, token_id: TokenId) -> Optional[Token]:
+        token = self._tokens.get(token_id)
+        if token is None:
+            return None
+        self._Remove(token)
+        self._stats.revoked += 1
+        self._DropRevoked()
+        return token
+
+    def RevokeUserTokens(self, user_id: UserId) -> None:
+        for token_id in self._tokens_by_user.pop(user_id, set()):
+            del self._tokens[token_id]
+            self._stats.revoked += 1
+        self._DropRevoked()
+
+    def _DropRevoked(self) -> None:
+        # Rebuilding the heap once most of its entries are stale keeps it
+        # from growing with revocations, at an amortized O(1) per token.
+        if len(self._expiries) > 2 * len(self._tokens) + 64:
+            self._expiries = [entry for entry in self._expiries if entry[1] in self._tokens]
+            heapq.heapify(self._expiries)
+
+    def NextExpiry(self) -> Optional[Timestamp]:
+        heap = self._expiries
+        while heap and heap[0][1] not in self._tokens:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def Sweep(self, current_time: Timestamp, limit: int) -> List[Token]:
+        swept = []  # type: List[Token]
+        while len(swept) < limit:
+            expires_at = self.NextExpiry()
+            if expires_at is None or expires_at > current_time:
+                break
+            (_, token_id) = heapq.heappop(self._expiries)
             token = self._tokens[token_id]
-        except KeyError:
+            self._Remove(token)
+            swept.append(token)
+        self._stats.expired += len(swept)
+        return swept
+
+class SqliteTokenStore(BaseTokenStore):
+    """A TokenStore kept in an SQLite database.
+
+    Lookups read the database directly. Writes are queued and committed in
+    batches off the event loop (see sqlite_store.WriteBatcher); until they
+    are, the tokens they create or revoke are kept in an overlay that
+    lookups check first, so the store always reads its own writes. Writes
+    that fail stay in the overlay, and are logged.
+
+    The hasher's key has to stay the same for the store to find the tokens
+    it already has.
+    """
+    _hasher: TokenHasher
+    _db: sqlite3.Connection
+    _writer: WriteBatcher
+    # Tokens created (or None if revoked) by writes not yet committed, with
+    # the write's sequence number.
+    _pending: Dict[TokenId, Tuple[int, Optional[Token]]]
+    _counter: "itertools.count[int]"
+    _stats: TokenStoreStats
+
+    def __init__(self, path: str, hasher: TokenHasher) -> None:
+        self._hasher = hasher
+        self._db = OpenDatabase(path)
+        # The first version of the table; the migrations below bring it up
+        # to date.
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                id TEXT PRIMARY KEY,
+                user INTEGER NOT NULL,
+                created_at INTEGER NOT NULL,
+                desc TEXT
+            )""")
+        (version,) = self._db.execute("PRAGMA user_version").fetchone()
+        if version < 2:
+            self._db.execute("BEGIN")
+            self._db.execute("ALTER TABLE tokens ADD COLUMN expires_at INTEGER")
+            self._db.execute("PRAGMA user_version = 2")
+            self._db.execute("COMMIT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tokens_user ON tokens (user)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tokens_expires ON tokens (expires_at) "
+                         "WHERE expires_at IS NOT NULL")
+        self._writer = WriteBatcher(path)
+        self._pending = {}
+        self._counter = itertools.count()
+        (live,) = self._db.execute("SELECT COUNT(*) FROM tokens").fetchone()
+        self._stats = TokenStoreStats(live = live)
+
+    def Stats(self) -> TokenStoreStats:
+        return attr.evolve(self._stats)
+
+    def WriteStats(self) -> WriteStats:
+        return self._writer.Stats()
+
+    async def Flush(self) -> None:
+        """Waits until every change so far is committed."""
+        await self._writer.Flush()
+
+    async def Close(self) -> None:
+        await self._writer.Close()
+        self._db.close()
+
+    def _Write(self, token_id: TokenId, token: Optional[Token], sql: str,
+               params: Sequence[Any]) -> None:
+        sequence_number = next(self._counter)
+        self._pending[token_id] = (sequence_number, token)
+        future = self._writer.Write(sql, params)
+        future.add_done_callback(lambda done: self._Committed(done, [token_id], sequence_number))
+
+    def _Committed(self, future: "asyncio.Future[None]", token_ids: List[TokenId],
+                   sequence_number: int) -> None:
+        if future.exception() is not None:
+            # Keep the overlay, so that the store goes on reading what it
+            # told its callers rather than silently undoing the change.
+            LOG.error("Writing tokens failed; keeping them in memory: %r", future.exception())
             return
-        del self._tokens[token_id]
-        self._tokens_by_user[token.user].remove(token_id)
+        for token_id in token_ids:
+            entry = self._pending.get(token_id)
+            if entry is not None and entry[0] == sequence_number:
+                del self._pending[token_id]
+
+    _COLUMNS = "id, user, created_at, desc, expires_at"
+
+    @staticmethod
+    def _FromRow(row: Tuple[str, int, int, Optional[str], Optional[int]]) -> Token:
+        (token_id, user, created_at, desc, expires_at) = row
+        return Token(id = TokenId(token_id), user = UserId(user),
+                     created_at = Timestamp(created_at), desc = desc,
+                     expires_at = None if expires_at is None else Timestamp(expires_at))
+
+    def IdFor(self, secret: TokenSecret) -> TokenId:
+        return self._hasher.IdFor(secret)
+
+    def CreateToken(self, user_id: UserId, current_time: Timestamp, *,
+                    ttl: Optional[int] = None) -> Tuple[TokenSecret, Token]:
+        (secret, token_id) = self._hasher.NewSecret()
+        expires_at = None if ttl is None else Timestamp(current_time + ttl)
+        token = Token(id = token_id, user = user_id, created_at = current_time,
+                      expires_at = expires_at)
+        self._Write(token_id, token,
+                    f"INSERT INTO tokens ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+                    (token_id, user_id, current_time, token.desc, expires_at))
+        self._stats.created += 1
+        self._stats.live += 1
+        return (secret, token)
+
+    def FindTokenById(self, token_id: TokenId, current_time: Timestamp) -> Optional[Token]:
+        token = self._FindById(token_id)
+        if token is None or token.Expired(current_time):
+            return None
+        return token
+
+    def _FindById(self, token_id: TokenId) -> Optional[Token]:
+        entry = self._pending.get(token_id)
+        if entry is not None:
+            return entry[1]
+        row = self._db.execute(
+            f"SELECT {self._COLUMNS} FROM tokens WHERE id = ?", (token_id,)).fetchone()
+        return None if row is None else self._FromRow(row)
+
+    def FindUserTokens(self, user_id: UserId) -> List[Token]:
+        rows = self._db.execute(
+            f"SELECT {self._COLUMNS} FROM tokens WHERE user = ?", (user_id,)).fetchall()
+        tokens = {row[0]: self._FromRow(row) for row in rows}  # type: Dict[str, Token]
+        for (token_id, (_, token)) in self._pending.items():
+            if token is None:
+                tokens.pop(token_id, None)
+            elif token.user == user_id:
+                tokens[token_id] = token
+        return list(tokens.values())
+
+    def RevokeToken(self, token_id: TokenId) -> Optional[Token]:
+        token = self._FindById(token_id)
+        if token is not None:
+            self._Delete(token_id)
+            self._stats.revoked += 1
+        return token
+
+    def _Delete(self, token_id: TokenId) -> None:
+        self._Write(token_id, None, "DELETE FROM tokens WHERE id = ?", (token_id,))
+        self._stats.live -= 1
 
     def RevokeUserTokens(self, user_id: UserId) -> None:
-        try:
-            user_tokens = self._tokens_by_user[user_id]
-        except KeyError:
+        tokens = self.FindUserTokens(user_id)
+        if not tokens:
             return
-        for user_token in user_tokens:
-            del self._tokens[user_token]
-        del self._tokens_by_user[user_id]
\ No newline at end of file
+        self._stats.revoked += len(tokens)
+        self._stats.live -= len(tokens)
+        sequence_number = next(self._counter)
+        for token in tokens:
+            self._pending[token.id] = (sequence_number, None)
+        token_ids = [token.id for token in tokens]
+        future = self._writer.Write("DELETE FROM tokens WHERE user = ?", (user_id,))
+        future.add_done_callback(lambda done: self._Committed(done, token_ids, sequence_number))
+
+    def NextExpiry(self) -> Optional[Timestamp]:
+        row = self._db.execute(
+            "SELECT MIN(expires_at) FROM tokens WHERE expires_at IS NOT NULL"
+        ).fetchone()  # type: Tuple[Optional[Timestamp]]
+        earliest = row[0]
+        for (_, token) in self._pending.values():
+            if (token is not None and token.expires_at is not None
+                    and (earliest is None or token.expires_at < earliest)):
+                earliest = token.expires_at
+        return earliest
+
+    def Sweep(self, current_time: Timestamp, limit: int) -> List[Token]:
+        # Rows deleted by writes not yet committed are still in the table,
+        # so read past as many rows as there are of those.
+        deleted = sum(1 for (_, token) in self._pending.values() if token is None)
+        rows = self._db.execute(
+            f"SELECT {self._COLUMNS} FROM tokens WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+            (current_time, limit + deleted)).fetchall()
+        expired = {row[0]: self._FromRow(row) for row in rows
+                   if row[0] not in self._pending}  # type: Dict[str, Token]
+        for (token_id, (_, token)) in self._pending.items():
+            if token is not None and token.Expired(current_time):
+                expired[token_id] = token
+        swept = sorted(expired.values(), key=lambda token: token.expires_at or 0)[:limit]
+        for token in swept:
+            self._Delete(token.id)
+        self._stats.expired += len(swept)
+        return swept
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+class _LruCache(Generic[K, V]):
+    _entries: "collections.OrderedDict[K, V]"
+    _capacity: int
+    evictions: int
+
+    def __init__(self, capacity: int):
+        self._entries = collections.OrderedDict()
+        self._capacity = capacity
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def Get(self, key: K) -> Optional[V]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def Put(self, key: K, value: V) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def Pop(self, key: K) -> Optional[V]:
+        return self._entries.pop(key, None)
+
+
+@attr.s(auto_attribs=True)
+class TokenCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Lookups of token ids recently found not to exist.
+    negative_hits: int = 0
+    user_hits: int = 0
+    user_misses: int = 0
+    evictions: int = 0
+    size: int = 0
+    negative_size: int = 0
+
+
+class CachedTokenStore(BaseTokenStore):
+    """Keeps the most recently used tokens, and tokens by user, of another
+    store in memory.
+
+    Secrets that were looked up and not found are remembered, by id, in a
+    cache of their own, so that guessing at tokens neither reaches the store nor
+    pushes real tokens out of the cache. Changes made through this store
+    keep the caches up to date; changes made to the store behind it
+    directly are not seen.
+    """
+    _store: BaseTokenStore
+    _tokens: _LruCache[TokenId, Token]
+    _missing: _LruCache[TokenId, bool]
+    _by_user: _LruCache[UserId, Tuple[Token, ...]]
+    _stats: TokenCacheStats
+
+    def __init__(self, store: BaseTokenStore, *, capacity: int = 10000,
+                 negative_capacity: int = 10000, user_capacity: int = 1000):
+        self._store = store
+        self._tokens = _LruCache(capacity)
+        self._missing = _LruCache(negative_capacity)
+        self._by_user = _LruCache(user_capacity)
+        self._stats = TokenCacheStats()
+
+    def Stats(self) -> TokenCacheStats:
+        return attr.evolve(
+            self._stats,
+            evictions = self._tokens.evictions + self._missing.evictions + self._by_user.evictions,
+            size = len(self._tokens),
+            negative_size = len(self._missing))
+
+    def IdFor(self, secret: TokenSecret) -> TokenId:
+        return self._store.IdFor(secret)
+
+    def CreateToken(self, user_id: UserId, current_time: Timestamp, *,
+                    ttl: Optional[int] = None) -> Tuple[TokenSecret, Token]:
+        (secret, token) = self._store.CreateToken(user_id, current_time, ttl = ttl)
+        self._missing.Pop(token.id)
+        self._tokens.Put(token.id, token)
+        self._by_user.Pop(user_id)
+        return (secret, token)
+
+    def FindTokenById(self, token_id: TokenId, current_time: Timestamp) -> Optional[Token]:
+        token = self._tokens.Get(token_id)
+        if token is not None:
+            self._stats.hits += 1
+            return None if token.Expired(current_time) else token
+        if self._missing.Get(token_id) is not None:
+            self._stats.negative_hits += 1
+            return None
+        self._stats.misses += 1
+        token = self._store.FindTokenById(token_id, current_time)
+        if token is None:
+            self._missing.Put(token_id, True)
+        else:
+            self._tokens.Put(token_id, token)
+        return token
+
+    def FindUserTokens(self, user_id: UserId) -> List[Token]:
+        tokens = self._by_user.Get(user_id)
+        if tokens is not None:
+            self._stats.user_hits += 1
+            return list(tokens)
+        self._stats.user_misses += 1
+        found = self._store.FindUserTokens(user_id)
+        self._by_user.Put(user_id, tuple(found))
+        return found
+
+    def RevokeToken(self, token_id: TokenId) -> Optional[Token]:
+        token = self._store.RevokeToken(token_id)
+        self._tokens.Pop(token_id)
+        self._missing.Put(token_id, True)
+        if token is not None:
+            self._by_user.Pop(token.user)
+        return token
+
+    def RevokeUserTokens(self, user_id: UserId) -> None:
+        tokens = self.FindUserTokens(user_id)
+        self._store.RevokeUserTokens(user_id)
+        for token in tokens:
+            self._tokens.Pop(token.id)
+            self._missing.Put(token.id, True)
+        self._by_user.Put(user_id, ())
+
+    def NextExpiry(self) -> Optional[Timestamp]:
+        return self._store.NextExpiry()
+
+    def Sweep(self, current_time: Timestamp, limit: int) -> List[Token]:
+        swept = self._store.Sweep(current_time, limit)
+        for token in swept:
+            self._tokens.Pop(token.id)
+            self._missing.Put(token.id, True)
+            self._by_user.Pop(token.user)
+        return swept
+
+
+@attr.s(auto_attribs=True)
+class SweepStats:
+    sweeps: int = 0
+    # Calls to the store's Sweep(), each of at most slice_size tokens.
+    slices: int = 0
+    swept: int = 0
+
+
+class TokenSweeper:
+    """Removes expired tokens from a store in the background.
+
+    Expired tokens are removed slice_size at a time, with the event loop
+    running in between, so that many tokens expiring together don't hold up
+    requests. Between sweeps, the sweeper sleeps until the next token
+    expires, but for at most max_interval seconds, so that tokens created
+    since with shorter lifetimes are swept in time.
+    """
+    _store: BaseTokenStore
+    _slice_size: int
+    _max_interval: int
+    _clock: Clock
+    _stats: SweepStats
+    _run_task: "Optional[asyncio.Task[None]]"
+
+    def __init__(self, store: BaseTokenStore, *, slice_size: int = 100,
+                 max_interval: int = 60, clock: Clock = _Now):
+        self._store = store
+        self._slice_size = slice_size
+        self._max_interval = max_interval
+        self._clock = clock
+        self._stats = SweepStats()
+        self._run_task = None
+
+    def Stats(self) -> SweepStats:
+        return attr.evolve(self._stats)
+
+    async def SweepExpired(self) -> int:
+        """Removes every token that has expired by now, and returns how
+        many.
+        """
+        now = self._clock()
+        self._stats.sweeps += 1
+        swept = 0
+        while True:
+            count = len(self._store.Sweep(now, self._slice_size))
+            self._stats.slices += 1
+            self._stats.swept += count
+            swept += count
+            if count < self._slice_size:
+                return swept
+            await asyncio.sleep(0)
+
+    def Start(self) -> None:
+        self._run_task = asyncio.ensure_future(self._Run())
+
+    async def Stop(self) -> None:
+        if self._run_task is not None:
+            self._run_task.cancel()
+            try:
+                await self._run_task
+            except asyncio.CancelledError:
+                pass
+            self._run_task = None
+
+    async def _Run(self) -> None:
+        while True:
+            try:
+                await self.SweepExpired()
+            except Exception:
+                LOG.exception("Sweeping expired tokens failed")
+            delay = self._max_interval
+            next_expiry = self._store.NextExpiry()
+            if next_expiry is not None:
+                delay = min(delay, next_expiry - self._clock())
+            # At least a second: the store may still report tokens whose
+            # removal isn't committed yet.
+            await asyncio.sleep(max(1, delay))
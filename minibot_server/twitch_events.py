@@ -0,0 +1,470 @@
+"""Decoding of Twitch IRC messages into typed events.
+
+DecodeEvent() turns a Message read from Twitch into one of the event classes
+below, or None if it isn't an event clients can listen to. Decoders are looked
+up by command, and USERNOTICEs again by their msg-id tag, and each decoder
+only reads the tags its event needs.
+
+The EVENT_TYPE of each class is the event type name used by the websocket
+protocol in docs/design/minibot_api.md. SubscriptionRegistry keeps track of
+which event types are listened to in each channel, and can drop raw lines
+that nobody listens to before they are parsed.
+"""
+
+from typing import Callable, ClassVar, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+import attr
+
+from .irc import FindRawTag, Message
+
+
+class Event:
+    """Base class of the events decoded from Twitch IRC."""
+    __slots__ = ()
+    EVENT_TYPE: ClassVar[str]
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class ChatMessage(Event):
+    EVENT_TYPE: ClassVar[str] = 'user_chat_message'
+    channel: str
+    user: str
+    display_name: str
+    user_id: str
+    text: str
+    message_id: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class ChatCommand(Event):
+    """A chat message starting with "!"."""
+    EVENT_TYPE: ClassVar[str] = 'user_chat_command'
+    channel: str
+    user: str
+    display_name: str
+    user_id: str
+    # The command name, without the "!".
+    command: str
+    # The rest of the message after the command name.
+    args: str
+    message_id: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class Cheer(Event):
+    EVENT_TYPE: ClassVar[str] = 'user_cheer'
+    channel: str
+    user: str
+    display_name: str
+    user_id: str
+    bits: int
+    text: str
+    message_id: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class UserJoin(Event):
+    EVENT_TYPE: ClassVar[str] = 'user_chat_join'
+    channel: str
+    user: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class UserLeave(Event):
+    EVENT_TYPE: ClassVar[str] = 'user_chat_leave'
+    channel: str
+    user: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class Subscription(Event):
+    EVENT_TYPE: ClassVar[str] = 'user_subscribe'
+    channel: str
+    user: str
+    display_name: str
+    user_id: str
+    # "Prime", "1000", "2000" or "3000".
+    plan: str
+    text: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class Resubscription(Event):
+    """A subscriber sharing their renewed subscription in chat."""
+    EVENT_TYPE: ClassVar[str] = 'user_subscribe_notify'
+    channel: str
+    user: str
+    display_name: str
+    user_id: str
+    plan: str
+    cumulative_months: int
+    text: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class GiftSubscription(Event):
+    EVENT_TYPE: ClassVar[str] = 'gift_subscribe'
+    channel: str
+    # The gifter, or None if they gifted anonymously.
+    user: Optional[str]
+    recipient: str
+    recipient_id: str
+    plan: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class MysteryGift(Event):
+    """A user gifting subscriptions to several random viewers at once.
+
+    Twitch follows this with a GiftSubscription for each recipient.
+    """
+    EVENT_TYPE: ClassVar[str] = 'mystery_gift'
+    channel: str
+    user: Optional[str]
+    count: int
+    plan: str
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class Raid(Event):
+    EVENT_TYPE: ClassVar[str] = 'user_raid'
+    channel: str
+    user: str
+    display_name: str
+    viewer_count: int
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class ChatCleared(Event):
+    """Chat cleared by a moderator, or a single user timed out or banned."""
+    EVENT_TYPE: ClassVar[str] = 'chat_cleared'
+    channel: str
+    # The user whose messages were removed, or None if all chat was cleared.
+    target_user: Optional[str]
+    # The length of a timeout in seconds, or None for a permanent ban.
+    ban_duration: Optional[int]
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class Whisper(Event):
+    EVENT_TYPE: ClassVar[str] = 'bot_whisper'
+    user: str
+    display_name: str
+    user_id: str
+    text: str
+
+
+EventDecoder = Callable[[Message], Optional[Event]]
+
+
+def _Str(value: bytes) -> str:
+    return value.decode('utf-8', 'replace')
+
+
+def _Channel(msg: Message) -> str:
+    """Returns the channel a message was sent to, without the leading "#"."""
+    channel = msg.args[0]
+    if channel.startswith(b'#'):
+        channel = channel[1:]
+    return _Str(channel)
+
+
+def _Nick(msg: Message) -> str:
+    """Returns the nick in a "nick!user@host" prefix."""
+    if msg.prefix is None:
+        return ''
+    return _Str(msg.prefix.split(b'!', 1)[0])
+
+
+def _Text(msg: Message) -> str:
+    return _Str(msg.args[1]) if len(msg.args) > 1 else ''
+
+
+def _Int(value: Optional[bytes]) -> int:
+    try:
+        return int(value) if value else 0
+    except ValueError:
+        return 0
+
+
+def _DecodePrivmsg(msg: Message) -> Optional[Event]:
+    if len(msg.args) < 2:
+        return None
+    tags = msg.tags
+    channel = _Channel(msg)
+    user = _Nick(msg)
+    display_name = _Str(tags.get(b'display-name', b''))
+    user_id = _Str(tags.get(b'user-id', b''))
+    message_id = _Str(tags.get(b'id', b''))
+    bits = tags.get(b'bits')
+    if bits is not None:
+        return Cheer(channel, user, display_name, user_id, _Int(bits), _Text(msg), message_id)
+    text = msg.args[1]
+    if text.startswith(b'!'):
+        parts = text[1:].split(b' ', 1)
+        return ChatCommand(
+            channel, user, display_name, user_id, _Str(parts[0]),
+            _Str(parts[1]) if len(parts) > 1 else '', message_id)
+    return ChatMessage(channel, user, display_name, user_id, _Str(text), message_id)
+
+
+def _DecodeJoin(msg: Message) -> Optional[Event]:
+    if not msg.args:
+        return None
+    return UserJoin(_Channel(msg), _Nick(msg))
+
+
+def _DecodePart(msg: Message) -> Optional[Event]:
+    if not msg.args:
+        return None
+    return UserLeave(_Channel(msg), _Nick(msg))
+
+
+def _DecodeClearchat(msg: Message) -> Optional[Event]:
+    if not msg.args:
+        return None
+    duration = msg.tags.get(b'ban-duration')
+    return ChatCleared(
+        _Channel(msg),
+        _Str(msg.args[1]) if len(msg.args) > 1 else None,
+        _Int(duration) if duration is not None else None)
+
+
+def _DecodeWhisper(msg: Message) -> Optional[Event]:
+    tags = msg.tags
+    return Whisper(
+        _Nick(msg), _Str(tags.get(b'display-name', b'')), _Str(tags.get(b'user-id', b'')),
+        _Text(msg))
+
+
+def _DecodeSub(msg: Message) -> Optional[Event]:
+    tags = msg.tags
+    return Subscription(
+        _Channel(msg), _Str(tags.get(b'login', b'')), _Str(tags.get(b'display-name', b'')),
+        _Str(tags.get(b'user-id', b'')), _Str(tags.get(b'msg-param-sub-plan', b'')), _Text(msg))
+
+
+def _DecodeResub(msg: Message) -> Optional[Event]:
+    tags = msg.tags
+    return Resubscription(
+        _Channel(msg), _Str(tags.get(b'login', b'')), _Str(tags.get(b'display-name', b'')),
+        _Str(tags.get(b'user-id', b'')), _Str(tags.get(b'msg-param-sub-plan', b'')),
+        _Int(tags.get(b'msg-param-cumulative-months')), _Text(msg))
+
+
+def _DecodeSubgift(msg: Message) -> Optional[Event]:
+    tags = msg.tags
+    gifter = None  # type: Optional[str]
+    if tags.get(b'msg-id') == b'subgift':
+        gifter = _Str(tags.get(b'login', b''))
+    return GiftSubscription(
+        _Channel(msg), gifter, _Str(tags.get(b'msg-param-recipient-user-name', b'')),
+        _Str(tags.get(b'msg-param-recipient-id', b'')),
+        _Str(tags.get(b'msg-param-sub-plan', b'')))
+
+
+def _DecodeMysteryGift(msg: Message) -> Optional[Event]:
+    tags = msg.tags
+    gifter = None  # type: Optional[str]
+    if tags.get(b'msg-id') == b'submysterygift':
+        gifter = _Str(tags.get(b'login', b''))
+    return MysteryGift(
+        _Channel(msg), gifter, _Int(tags.get(b'msg-param-mass-gift-count')),
+        _Str(tags.get(b'msg-param-sub-plan', b'')))
+
+
+def _DecodeRaid(msg: Message) -> Optional[Event]:
+    tags = msg.tags
+    return Raid(
+        _Channel(msg), _Str(tags.get(b'msg-param-login', b'')),
+        _Str(tags.get(b'msg-param-displayName', b'')),
+        _Int(tags.get(b'msg-param-viewerCount')))
+
+
+_USERNOTICE_DECODERS = {
+    b'sub': _DecodeSub,
+    b'resub': _DecodeResub,
+    b'subgift': _DecodeSubgift,
+    b'anonsubgift': _DecodeSubgift,
+    b'submysterygift': _DecodeMysteryGift,
+    b'anonsubmysterygift': _DecodeMysteryGift,
+    b'raid': _DecodeRaid,
+}  # type: Dict[bytes, EventDecoder]
+
+
+def _DecodeUsernotice(msg: Message) -> Optional[Event]:
+    if not msg.args:
+        return None
+    msg_id = msg.tags.get(b'msg-id')
+    if msg_id is None:
+        return None
+    decoder = _USERNOTICE_DECODERS.get(msg_id)
+    if decoder is None:
+        return None
+    return decoder(msg)
+
+
+_DECODERS = {
+    b'PRIVMSG': _DecodePrivmsg,
+    b'JOIN': _DecodeJoin,
+    b'PART': _DecodePart,
+    b'CLEARCHAT': _DecodeClearchat,
+    b'WHISPER': _DecodeWhisper,
+    b'USERNOTICE': _DecodeUsernotice,
+}  # type: Dict[bytes, EventDecoder]
+
+
+def DecodeEvent(msg: Message) -> Optional[Event]:
+    """Returns the event a message from Twitch represents, or None if it
+    isn't one.
+    """
+    decoder = _DECODERS.get(msg.command)
+    if decoder is None:
+        return None
+    return decoder(msg)
+
+
+# The commands, and msg-ids for USERNOTICEs, of the lines each event type is
+# decoded from. A msg-id set of None matches any line with the command.
+_EVENT_SOURCES = {
+    ChatMessage.EVENT_TYPE: ((b'PRIVMSG', None),),
+    ChatCommand.EVENT_TYPE: ((b'PRIVMSG', None),),
+    Cheer.EVENT_TYPE: ((b'PRIVMSG', None),),
+    UserJoin.EVENT_TYPE: ((b'JOIN', None),),
+    UserLeave.EVENT_TYPE: ((b'PART', None),),
+    Subscription.EVENT_TYPE: ((b'USERNOTICE', frozenset((b'sub',))),),
+    Resubscription.EVENT_TYPE: ((b'USERNOTICE', frozenset((b'resub',))),),
+    GiftSubscription.EVENT_TYPE: ((b'USERNOTICE', frozenset((b'subgift', b'anonsubgift'))),),
+    MysteryGift.EVENT_TYPE: ((b'USERNOTICE', frozenset((
+        b'submysterygift', b'anonsubmysterygift'))),),
+    Raid.EVENT_TYPE: ((b'USERNOTICE', frozenset((b'raid',))),),
+    ChatCleared.EVENT_TYPE: ((b'CLEARCHAT', None),),
+    Whisper.EVENT_TYPE: ((b'WHISPER', None),),
+}  # type: Dict[str, Tuple[Tuple[bytes, Optional[FrozenSet[bytes]]], ...]]
+
+EVENT_TYPES = frozenset(_EVENT_SOURCES)
+
+# Whispers are sent to the bot rather than to a channel, so they are wanted
+# if anyone listens to them in any channel.
+_CHANNELLESS_COMMANDS = frozenset((b'WHISPER',))
+
+# For each command, None if every line is wanted, or the msg-ids wanted.
+_CommandFilter = Dict[bytes, Optional[FrozenSet[bytes]]]
+
+
+def _ChannelKey(channel: str) -> bytes:
+    return b'#' + channel.encode('utf-8')
+
+
+class SubscriptionRegistry:
+    """Tracks the event types each listener wants from its channel.
+
+    AcceptLine() can be used as the line filter of an IrcClientChannel. It
+    looks at the command, channel and msg-id of a raw line, and rejects event
+    lines that no listener in the channel wants before they are parsed. Lines
+    that aren't events at all, such as PINGs, are always accepted.
+    """
+    _listeners: Dict[int, Tuple[str, FrozenSet[str]]]
+    # Compiled from _listeners, or None if it needs compiling again.
+    _channel_filters: Optional[Dict[bytes, _CommandFilter]]
+    _channelless: Set[bytes]
+    # The number of event lines dropped, and accepted, by AcceptLine().
+    lines_filtered: int
+    lines_accepted: int
+
+    def __init__(self) -> None:
+        self._listeners = {}
+        self._channel_filters = None
+        self._channelless = set()
+        self.lines_filtered = 0
+        self.lines_accepted = 0
+
+    def Listen(self, listener_id: int, channel: str, event_types: Iterable[str]) -> List[str]:
+        """Listens to events of the given types in a channel, replacing what
+        the listener listened to before.
+
+        Returns the event types that will be listened to, leaving out any
+        that are unknown.
+        """
+        registered = frozenset(event_types) & EVENT_TYPES
+        self._listeners[listener_id] = (channel, registered)
+        self._channel_filters = None
+        return sorted(registered)
+
+    def Unlisten(self, listener_id: int) -> None:
+        if self._listeners.pop(listener_id, None) is not None:
+            self._channel_filters = None
+
+    def Listeners(self, channel: str, event: Event) -> List[int]:
+        """Returns the listeners in the channel that want the event."""
+        event_type = event.EVENT_TYPE
+        channelless = isinstance(event, Whisper)
+        return [
+            listener_id
+            for (listener_id, (listener_channel, event_types)) in self._listeners.items()
+            if event_type in event_types and (channelless or listener_channel == channel)
+        ]
+
+    def _Compile(self) -> Dict[bytes, _CommandFilter]:
+        channel_filters = {}  # type: Dict[bytes, _CommandFilter]
+        channelless = set()  # type: Set[bytes]
+        for (channel, event_types) in self._listeners.values():
+            command_filter = channel_filters.setdefault(_ChannelKey(channel), {})
+            for event_type in event_types:
+                for (command, msg_ids) in _EVENT_SOURCES[event_type]:
+                    if command in _CHANNELLESS_COMMANDS:
+                        channelless.add(command)
+                        continue
+                    wanted = command_filter.get(command, frozenset())
+                    if msg_ids is None or wanted is None:
+                        command_filter[command] = None
+                    else:
+                        command_filter[command] = wanted | msg_ids
+        self._channel_filters = channel_filters
+        self._channelless = channelless
+        return channel_filters
+
+    def AcceptLine(self, line: bytes) -> bool:
+        """Returns whether a raw IRC line may be an event someone listens to,
+        or isn't an event at all.
+        """
+        channel_filters = self._channel_filters
+        if channel_filters is None:
+            channel_filters = self._Compile()
+        tags = None  # type: Optional[bytes]
+        start = 0
+        # Lines that are malformed, or have no channel, are left to the parser.
+        if line.startswith(b'@'):
+            tags_end = line.find(b' ')
+            if tags_end < 0:
+                return True
+            tags = line[1:tags_end]
+            start = tags_end + 1
+        if line.startswith(b':', start):
+            prefix_end = line.find(b' ', start)
+            if prefix_end < 0:
+                return True
+            start = prefix_end + 1
+        end = line.find(b' ', start)
+        if end < 0:
+            return True
+        command = line[start:end]
+        if command not in _DECODERS:
+            return True
+        if command in _CHANNELLESS_COMMANDS:
+            accept = command in self._channelless
+        else:
+            channel_end = line.find(b' ', end + 1)
+            channel = line[end + 1:] if channel_end < 0 else line[end + 1:channel_end]
+            command_filter = channel_filters.get(channel)
+            if command_filter is None or command not in command_filter:
+                accept = False
+            else:
+                msg_ids = command_filter[command]
+                accept = (msg_ids is None or
+                          tags is not None and FindRawTag(tags, b'msg-id') in msg_ids)
+        if accept:
+            self.lines_accepted += 1
+        else:
+            self.lines_filtered += 1
+        return accept
@@ -1,8 +1,15 @@
-from typing import Dict, List, NewType, Optional
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, NewType, Optional, Tuple
 
 from .oauth import OAuthProvider, RefreshableToken, Timestamp, OAuthToken
+from .sqlite_store import OpenDatabase, WriteBatcher, WriteStats
 
+import asyncio
 import attr
+import logging
+import sqlite3
+
+LOG = logging.Logger(__name__)
 
 class Error(BaseException):
     pass
@@ -18,9 +25,12 @@ class TwitchUser:
     _user_token: RefreshableToken
 
     def __init__(self, twitch_id: str, token: RefreshableToken):
-        self._twitch_id = twitch_id
+        self.twitch_id = twitch_id
         self._user_token = token
 
+    def Token(self) -> RefreshableToken:
+        return self._user_token
+
     async def GetToken(self, current_time: Timestamp, provider: OAuthProvider) -> OAuthToken:
         return await self._user_token.Get(current_time, provider)
 
@@ -36,12 +46,71 @@ class User:
     def AddBot(self, twitch_bot: TwitchUser) -> None:
         self.twitch_bot = twitch_bot
 
-class UserStore:
+    def TwitchUsers(self) -> List[TwitchUser]:
+        """Returns the streamer's Twitch user, and the bot's if there is one."""
+        if self.twitch_bot is None:
+            return [self.twitch_user]
+        return [self.twitch_user, self.twitch_bot]
+
+# Called with each Twitch user added to or removed from a store.
+TwitchUserListener = Callable[[TwitchUser], None]
+
+class BaseUserStore(ABC):
+    _added_listeners: List[TwitchUserListener]
+    _removed_listeners: List[TwitchUserListener]
+
+    def __init__(self) -> None:
+        self._added_listeners = []
+        self._removed_listeners = []
+
+    def AddTwitchUserListeners(self, *, added: TwitchUserListener,
+                               removed: TwitchUserListener) -> None:
+        """Calls added with the Twitch users of users created and bots added
+        through the store from now on, and removed with those of users
+        deleted and bots replaced.
+        """
+        self._added_listeners.append(added)
+        self._removed_listeners.append(removed)
+
+    def _NotifyAdded(self, twitch_user: TwitchUser) -> None:
+        for listener in self._added_listeners:
+            listener(twitch_user)
+
+    def _NotifyRemoved(self, twitch_user: TwitchUser) -> None:
+        for listener in self._removed_listeners:
+            listener(twitch_user)
+
+    def _NotifyBotAdded(self, previous_bot: Optional[TwitchUser], twitch_bot: TwitchUser) -> None:
+        if previous_bot is not None and previous_bot is not twitch_bot:
+            self._NotifyRemoved(previous_bot)
+        self._NotifyAdded(twitch_bot)
+
+    @abstractmethod
+    def CreateUser(self, current_time: Timestamp, twitch_user: TwitchUser) -> User: ...
+
+    @abstractmethod
+    def DeleteUser(self, user_id: UserId) -> None: ...
+
+    @abstractmethod
+    def AddBot(self, user_id: UserId, twitch_bot: TwitchUser) -> None: ...
+
+    @abstractmethod
+    def AllUsers(self) -> List[User]: ...
+
+    @abstractmethod
+    def GetUser(self, user_id: UserId) -> User: ...
+
+    @abstractmethod
+    def GetUserByTwitchId(self, twitch_id: str) -> User: ...
+
+
+class UserStore(BaseUserStore):
     _users: Dict[UserId, User]
     _by_twitch_id: Dict[str, UserId]
     _next_user_id: int
 
     def __init__(self) -> None:
+        super().__init__()
         self._users = {}
         self._by_twitch_id = {}
         self._next_user_id = 1
@@ -59,6 +128,7 @@ class UserStore:
         self._next_user_id += 1
         self._users[user.user_id] = user
         self._by_twitch_id[user.twitch_user.twitch_id] = user.user_id
+        self._NotifyAdded(twitch_user)
 
         return user
 
@@ -69,6 +139,18 @@ class UserStore:
             raise NoSuchUserError()
 
         del self._by_twitch_id[user.twitch_user.twitch_id]
+        del self._users[user_id]
+        for twitch_user in user.TwitchUsers():
+            self._NotifyRemoved(twitch_user)
+
+    def AddBot(self, user_id: UserId, twitch_bot: TwitchUser) -> None:
+        user = self.GetUser(user_id)
+        previous_bot = user.twitch_bot
+        user.AddBot(twitch_bot)
+        self._NotifyBotAdded(previous_bot, twitch_bot)
+
+    def AllUsers(self) -> List[User]:
+        return list(self._users.values())
 
     def GetUser(self, user_id: UserId) -> User:
         try:
@@ -80,4 +162,172 @@ class UserStore:
         try:
             return self._users[self._by_twitch_id[twitch_id]]
         except KeyError:
-            raise NoSuchUserError()
\ No newline at end of file
+            raise NoSuchUserError()
+
+
+_UserRow = Tuple[int, int, str, str, Optional[str], Optional[str]]
+
+class SqliteUserStore(BaseUserStore):
+    """A UserStore kept in an SQLite database.
+
+    Each user is loaded at most once, and the same User is returned from
+    then on, so that refreshing a user's tokens, which happens in place, is
+    seen by everyone holding the user. Refreshed tokens are written back.
+    Writes are queued and committed in batches off the event loop (see
+    sqlite_store.WriteBatcher). Users whose deletion isn't committed yet,
+    or failed to commit, are hidden from lookups.
+    """
+    _db: sqlite3.Connection
+    _writer: WriteBatcher
+    # The users loaded so far, including those not yet committed.
+    _users: Dict[UserId, User]
+    _by_twitch_id: Dict[str, UserId]
+    _deleting: Dict[UserId, int]
+    _write_count: int
+    _next_user_id: int
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._db = OpenDatabase(path)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at INTEGER NOT NULL,
+                twitch_id TEXT NOT NULL UNIQUE,
+                twitch_token TEXT NOT NULL,
+                bot_twitch_id TEXT,
+                bot_token TEXT
+            )""")
+        self._writer = WriteBatcher(path)
+        self._users = {}
+        self._by_twitch_id = {}
+        self._deleting = {}
+        self._write_count = 0
+        # AUTOINCREMENT keeps the highest id ever used, so ids of deleted
+        # users aren't handed out again.
+        row = self._db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'users'").fetchone()
+        self._next_user_id = 1 if row is None else row[0] + 1
+
+    def WriteStats(self) -> WriteStats:
+        return self._writer.Stats()
+
+    async def Flush(self) -> None:
+        """Waits until every change so far is committed."""
+        await self._writer.Flush()
+
+    async def Close(self) -> None:
+        await self._writer.Close()
+        self._db.close()
+
+    def _Track(self, user: User) -> User:
+        self._users[user.user_id] = user
+        self._by_twitch_id[user.twitch_user.twitch_id] = user.user_id
+        self._ListenForRefresh(user.user_id, user.twitch_user, 'twitch_token')
+        if user.twitch_bot is not None:
+            self._ListenForRefresh(user.user_id, user.twitch_bot, 'bot_token')
+        return user
+
+    def _ListenForRefresh(self, user_id: UserId, twitch_user: TwitchUser, column: str) -> None:
+        def Save(token: RefreshableToken) -> None:
+            user = self._users.get(user_id)
+            if user is None:
+                return
+            current = user.twitch_user if column == 'twitch_token' else user.twitch_bot
+            # A replaced bot's token may still be refreshed by whoever holds
+            # it, but it mustn't overwrite its replacement.
+            if current is twitch_user:
+                self._writer.Write(f"UPDATE users SET {column} = ? WHERE user_id = ?",
+                                   (token.ToJson(), user_id))
+        twitch_user.Token().AddRefreshListener(Save)
+
+    def _Load(self, row: _UserRow) -> User:
+        (user_id, created_at, twitch_id, twitch_token, bot_twitch_id, bot_token) = row
+        user = self._users.get(UserId(user_id))
+        if user is not None:
+            return user
+        user = User(
+            user_id = UserId(user_id),
+            created_at = Timestamp(created_at),
+            twitch_user = TwitchUser(twitch_id, RefreshableToken.FromJson(twitch_token)),
+        )
+        if bot_twitch_id is not None and bot_token is not None:
+            user.AddBot(TwitchUser(bot_twitch_id, RefreshableToken.FromJson(bot_token)))
+        return self._Track(user)
+
+    def _Select(self, where: str, *params: object) -> List[User]:
+        rows = self._db.execute(
+            "SELECT user_id, created_at, twitch_id, twitch_token, bot_twitch_id, bot_token "
+            f"FROM users {where}", params).fetchall()
+        return [self._Load(row) for row in rows if row[0] not in self._deleting]
+
+    def CreateUser(self, current_time: Timestamp, twitch_user: TwitchUser) -> User:
+        try:
+            self.GetUserByTwitchId(twitch_user.twitch_id)
+        except NoSuchUserError:
+            pass
+        else:
+            raise UserAlreadyExistsError()
+
+        user = User(
+            user_id = UserId(self._next_user_id),
+            created_at = current_time,
+            twitch_user = twitch_user,
+        )
+        self._next_user_id += 1
+        self._writer.Write(
+            "INSERT INTO users (user_id, created_at, twitch_id, twitch_token) VALUES (?, ?, ?, ?)",
+            (user.user_id, current_time, twitch_user.twitch_id, twitch_user.Token().ToJson()))
+        self._Track(user)
+        self._NotifyAdded(twitch_user)
+        return user
+
+    def DeleteUser(self, user_id: UserId) -> None:
+        user = self.GetUser(user_id)
+        del self._users[user_id]
+        del self._by_twitch_id[user.twitch_user.twitch_id]
+        self._write_count += 1
+        write_count = self._deleting[user_id] = self._write_count
+        future = self._writer.Write("DELETE FROM users WHERE user_id = ?", (user_id,))
+        future.add_done_callback(lambda done: self._Deleted(done, user_id, write_count))
+        for twitch_user in user.TwitchUsers():
+            self._NotifyRemoved(twitch_user)
+
+    def _Deleted(self, future: "asyncio.Future[None]", user_id: UserId, write_count: int) -> None:
+        if future.exception() is not None:
+            # Keep hiding the user, rather than bringing them back.
+            LOG.error("Deleting user %d failed: %r", user_id, future.exception())
+            return
+        if self._deleting.get(user_id) == write_count:
+            del self._deleting[user_id]
+
+    def AddBot(self, user_id: UserId, twitch_bot: TwitchUser) -> None:
+        user = self.GetUser(user_id)
+        previous_bot = user.twitch_bot
+        user.AddBot(twitch_bot)
+        self._ListenForRefresh(user_id, twitch_bot, 'bot_token')
+        self._writer.Write(
+            "UPDATE users SET bot_twitch_id = ?, bot_token = ? WHERE user_id = ?",
+            (twitch_bot.twitch_id, twitch_bot.Token().ToJson(), user_id))
+        self._NotifyBotAdded(previous_bot, twitch_bot)
+
+    def AllUsers(self) -> List[User]:
+        self._Select("")
+        return list(self._users.values())
+
+    def GetUser(self, user_id: UserId) -> User:
+        user = self._users.get(user_id)
+        if user is None:
+            users = self._Select("WHERE user_id = ?", user_id)
+            if not users:
+                raise NoSuchUserError()
+            user = users[0]
+        return user
+
+    def GetUserByTwitchId(self, twitch_id: str) -> User:
+        user_id = self._by_twitch_id.get(twitch_id)
+        if user_id is not None:
+            return self._users[user_id]
+        users = self._Select("WHERE twitch_id = ?", twitch_id)
+        if not users:
+            raise NoSuchUserError()
+        return users[0]
@@ -10,6 +10,10 @@ setup(name='minibot_server',
         "PyJWT>=1.7",
         "serde>=0.6",
       ],
+      extras_require={
+        # Lets the HTTP client keep connections alive between requests.
+        'curl': ["pycurl>=7.43"],
+      },
       entry_points={
           'console_scripts': [
               'run_minibot_server=minibot_server:main',
@@ -0,0 +1,210 @@
+import asyncio
+import random
+from typing import List
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from minibot_server import async_util
+
+
+class CloseableQueueTest(AsyncTestCase):
+    @gen_test
+    async def testGetAfterClose(self) -> None:
+        queue = async_util.CloseableQueue()  # type: async_util.CloseableQueue[int]
+        await queue.Put(1)
+        queue.PutNowait(2)
+        queue.Close()
+        with self.assertRaises(async_util.QueueClosedError):
+            await queue.Put(3)
+        with self.assertRaises(async_util.QueueClosedError):
+            queue.PutNowait(3)
+        self.assertEqual(await queue.Get(), 1)
+        self.assertEqual(await queue.GetMany(10), [2])
+        self.assertIsNone(await queue.Get())
+        self.assertIsNone(await queue.GetMany(10))
+        await queue.WaitUntilEmpty()
+
+    @gen_test
+    async def testCloseWakesGetters(self) -> None:
+        queue = async_util.CloseableQueue()  # type: async_util.CloseableQueue[int]
+        getters = [asyncio.ensure_future(queue.Get()) for _ in range(3)]
+        await asyncio.sleep(0)
+        queue.Close()
+        self.assertEqual(await asyncio.gather(*getters), [None, None, None])
+
+    @gen_test
+    async def testBlockedPuttersKeepOrder(self) -> None:
+        queue = async_util.CloseableQueue(2)  # type: async_util.CloseableQueue[int]
+        queue.PutNowait(0)
+        queue.PutNowait(1)
+        with self.assertRaises(asyncio.QueueFull):
+            queue.PutNowait(2)
+        putters = [asyncio.ensure_future(queue.Put(value)) for value in (2, 3)]
+        await asyncio.sleep(0)
+        self.assertEqual(await queue.Get(), 0)
+        # The blocked putters are still ahead of any new value.
+        with self.assertRaises(asyncio.QueueFull):
+            queue.PutNowait(4)
+        queue.Close()
+        self.assertEqual(await queue.GetMany(10), [1, 2])
+        self.assertEqual(await queue.GetMany(10), [3])
+        self.assertIsNone(await queue.Get())
+        await asyncio.gather(*putters)
+        await queue.WaitUntilEmpty()
+
+    @gen_test
+    async def testBlockedPutWakesGetter(self) -> None:
+        queue = async_util.CloseableQueue(1)  # type: async_util.CloseableQueue[str]
+        getters = [asyncio.ensure_future(queue.Get()) for _ in range(2)]
+        await asyncio.sleep(0)
+        queue.PutNowait('a')
+        await queue.Put('b')
+        # Neither getter needs Close() to see its value.
+        done = await asyncio.wait_for(asyncio.gather(*getters), 1)
+        self.assertEqual(sorted(done), ['a', 'b'])
+
+    @gen_test
+    async def testCancelledGetterDoesNotTakeValue(self) -> None:
+        queue = async_util.CloseableQueue()  # type: async_util.CloseableQueue[int]
+        cancelled = asyncio.ensure_future(queue.Get())
+        waiting = asyncio.ensure_future(queue.Get())
+        await asyncio.sleep(0)
+        # Wake the first getter, then cancel it before it runs.
+        queue.PutNowait(1)
+        cancelled.cancel()
+        self.assertEqual(await waiting, 1)
+        self.assertTrue(cancelled.cancelled())
+
+    @gen_test
+    async def testCancelledPutterDoesNotPutValue(self) -> None:
+        queue = async_util.CloseableQueue(1)  # type: async_util.CloseableQueue[int]
+        queue.PutNowait(1)
+        putter = asyncio.ensure_future(queue.Put(2))
+        await asyncio.sleep(0)
+        putter.cancel()
+        self.assertEqual(await queue.Get(), 1)
+        queue.PutNowait(3)
+        self.assertEqual(await queue.Get(), 3)
+        with self.assertRaises(asyncio.CancelledError):
+            await putter
+
+    @gen_test(timeout=30)
+    async def testNoLossUnderCloseRaces(self) -> None:
+        rng = random.Random(42)
+        for _ in range(50):
+            queue = async_util.CloseableQueue(rng.randrange(0, 4))  # type: async_util.CloseableQueue[int]
+            accepted = []  # type: List[int]
+            received = []  # type: List[int]
+
+            async def Producer(start: int) -> None:
+                for value in range(start, start + 100):
+                    try:
+                        await queue.Put(value)
+                    except async_util.QueueClosedError:
+                        return
+                    accepted.append(value)
+                    if rng.random() < 0.3:
+                        await asyncio.sleep(0)
+
+            async def Consumer() -> None:
+                while True:
+                    get = asyncio.ensure_future(
+                        queue.GetMany(rng.randrange(1, 5)) if rng.random() < 0.5 else queue.Get())
+                    if rng.random() < 0.2:
+                        # Race a cancellation against the get.
+                        await asyncio.sleep(0)
+                        get.cancel()
+                    try:
+                        result = await get  # type: object
+                    except asyncio.CancelledError:
+                        continue
+                    if result is None:
+                        return
+                    if isinstance(result, list):
+                        received.extend(result)
+                    else:
+                        assert isinstance(result, int)
+                        received.append(result)
+
+            async def Closer() -> None:
+                for _ in range(rng.randrange(200)):
+                    await asyncio.sleep(0)
+                queue.Close()
+
+            await asyncio.gather(
+                *[Producer(1000 * i) for i in range(3)],
+                *[Consumer() for _ in range(3)],
+                Closer())
+            await queue.WaitUntilEmpty()
+            self.assertEqual(sorted(received), sorted(accepted))
+
+
+class PendingStoreTest(AsyncTestCase):
+    @gen_test
+    async def testExpiresEntries(self) -> None:
+        dropped = []  # type: List[str]
+        store = async_util.PendingStore(ttl=0.05, capacity=10, on_drop=dropped.append)  # type: async_util.PendingStore[str]
+        store.Put('a', 'value a')
+        store.Put('b', 'value b', ttl=1.0)
+        store.Put('c', 'value c')
+        self.assertEqual(store.Pop('c'), 'value c')
+        self.assertIsNone(store.Pop('c'))
+        await asyncio.sleep(0.1)
+        # Expired by the timer, without any other call into the store.
+        self.assertEqual(dropped, ['value a'])
+        self.assertNotIn('a', store)
+        self.assertEqual(store.Get('b'), 'value b')
+        stats = store.Stats()
+        self.assertEqual((stats.size, stats.added, stats.removed, stats.expired, stats.evicted),
+                         (1, 3, 1, 1, 0))
+        store.Clear()
+        self.assertEqual(dropped, ['value a', 'value b'])
+        self.assertEqual(len(store), 0)
+
+    @gen_test
+    async def testEvictsClosestToExpiringWhenFull(self) -> None:
+        dropped = []  # type: List[int]
+        store = async_util.PendingStore(ttl=60, capacity=3, on_drop=dropped.append)  # type: async_util.PendingStore[int]
+        store.Put('long', 0, ttl=120)
+        store.Put('first', 1)
+        store.Put('second', 2)
+        store.Put('third', 3)
+        self.assertEqual(dropped, [1])
+        self.assertEqual(store.Stats().evicted, 1)
+        # Replacing an entry doesn't count against the capacity twice, and
+        # drops the value it replaces.
+        store.Put('third', 4)
+        self.assertEqual(dropped, [1, 3])
+        self.assertEqual(store.Stats().evicted, 1)
+        self.assertEqual(store.Get('third'), 4)
+        store.Clear()
+
+    def testRejectsZeroCapacity(self) -> None:
+        with self.assertRaises(ValueError):
+            async_util.PendingStore(ttl=60, capacity=0)
+
+    @gen_test
+    async def testStaleDeadlinesAreCompacted(self) -> None:
+        store = async_util.PendingStore(ttl=60, capacity=10)  # type: async_util.PendingStore[int]
+        for i in range(1000):
+            store.Put(str(i), i)
+            store.Pop(str(i))
+        self.assertLess(len(store._deadlines), 100)
+        store.Clear()
+
+
+class CallbackSetTest(AsyncTestCase):
+    @gen_test
+    async def testSendAndExpire(self) -> None:
+        callbacks = async_util.CallbackSet(ttl=0.05)  # type: async_util.CallbackSet[int]
+        (nonce, waiter) = callbacks.MakeCallback()
+        callbacks.SendCallback(nonce, 5)
+        self.assertEqual(await waiter, 5)
+        with self.assertRaises(KeyError):
+            callbacks.SendCallback(nonce, 6)
+
+        (nonce, waiter) = callbacks.MakeCallback()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        with self.assertRaises(KeyError):
+            callbacks.SendCallback(nonce, 6)
@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+from tornado import web
+from tornado.httpclient import HTTPClientError, HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from minibot_server import oauth
+from minibot_server.http_client import HttpClient, HttpClientConfig
+
+
+class _SlowHandler(web.RequestHandler):
+    async def get(self) -> None:
+        state = self.application.settings['state']
+        state['active'] += 1
+        state['max_active'] = max(state['max_active'], state['active'])
+        try:
+            await asyncio.sleep(float(self.get_argument('delay', '0.05')))
+        finally:
+            state['active'] -= 1
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({'access_token': 'a', 'refresh_token': 'r', 'expires_in': 60}))
+
+
+class HttpClientTest(AsyncHTTPTestCase):
+    def get_app(self) -> web.Application:
+        self.state = {'active': 0, 'max_active': 0}
+        return web.Application([(r'/slow', _SlowHandler)], state=self.state)
+
+    @gen_test
+    async def testLimitsRequestsPerHost(self) -> None:
+        client = HttpClient(HttpClientConfig(max_per_host=2))
+        self.addCleanup(client.Close)
+        responses = await asyncio.gather(*[
+            client.Fetch(HTTPRequest(self.get_url('/slow'))) for _ in range(6)])
+        self.assertTrue(all(response.code == 200 for response in responses))
+        self.assertEqual(self.state['max_active'], 2)
+        (stats,) = client.Stats().values()
+        self.assertEqual((stats.requests, stats.in_flight, stats.waiting), (6, 0, 0))
+        # Four requests had to wait for at least one earlier request.
+        self.assertGreater(stats.total_queue_wait, 4 * 0.04)
+        self.assertGreater(stats.max_queue_wait, 0.08)
+
+    @gen_test
+    async def testLeavesRequestUnchanged(self) -> None:
+        client = HttpClient()
+        self.addCleanup(client.Close)
+        request = HTTPRequest(self.get_url('/slow'))
+        await client.Fetch(request)
+        self.assertIsNone(request.connect_timeout)
+        self.assertIsNone(request.request_timeout)
+
+    @gen_test
+    async def testTimeoutIncludesQueueWait(self) -> None:
+        client = HttpClient(HttpClientConfig(max_per_host=1))
+        self.addCleanup(client.Close)
+        slow = asyncio.ensure_future(client.Fetch(HTTPRequest(self.get_url('/slow?delay=0.3'))))
+        await asyncio.sleep(0.01)
+        with self.assertRaises(HTTPClientError) as context:
+            await client.Fetch(HTTPRequest(self.get_url('/slow'), request_timeout=0.1))
+        self.assertEqual(context.exception.code, 599)
+        await slow
+
+    @gen_test
+    async def testSimpleHttpClientUsesSharedClient(self) -> None:
+        client = HttpClient()
+        self.addCleanup(client.Close)
+        simple = oauth.SimpleHttpClient(self.get_url('/'), client)
+        result = await simple.Request(
+            'slow', resp_parser=oauth.SerdeJsonResponseParser(oauth.TokenRefreshResponse), timeout=5)
+        assert result is not None
+        self.assertEqual(result.access_token, 'a')
+        self.assertEqual(sum(stats.requests for stats in client.Stats().values()), 1)
@@ -0,0 +1,270 @@
+import asyncio
+import os
+import random
+import tempfile
+import time
+import unittest
+from unittest import mock
+from typing import Dict, List, Optional, Tuple
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from minibot_server import irc
+from minibot_server.testing import irc as irc_testing
+
+_ParseResult = Tuple[Optional[bytes], bytes, List[bytes], Dict[bytes, bytes]]
+
+
+def _ParseFields(line: bytes) -> _ParseResult:
+    msg = irc.Message.Parse(line)
+    return (msg.prefix, msg.command, list(msg.args), dict(msg.tags))
+
+
+class MessageParseTest(unittest.TestCase):
+    def assertParsesLikeReference(self, line: bytes) -> None:
+        try:
+            expected = irc_testing.ReferenceParse(line)  # type: Optional[_ParseResult]
+        except ValueError:
+            expected = None
+        if expected is None:
+            with self.assertRaises(ValueError, msg=repr(line)):
+                irc.Message.Parse(line)
+        else:
+            self.assertEqual(_ParseFields(line), expected, msg=repr(line))
+
+    def testParseFullLine(self) -> None:
+        msg = irc.Message.Parse(
+            b'@badges=;color=#FF0000;display-name=Some\\sOne :some!some@some.tmi.twitch.tv '
+            b'privmsg #channel :hello there :)')
+        self.assertEqual(msg.command, b'PRIVMSG')
+        self.assertEqual(msg.prefix, b'some!some@some.tmi.twitch.tv')
+        self.assertEqual(list(msg.args), [b'#channel', b'hello there :)'])
+        self.assertEqual(dict(msg.tags), {
+            b'badges': b'',
+            b'color': b'#FF0000',
+            b'display-name': b'Some One',
+        })
+
+    def testParseMiddleArgs(self) -> None:
+        msg = irc.Message.Parse(b'CAP  * ACK   :twitch.tv/tags twitch.tv/commands')
+        self.assertIsNone(msg.prefix)
+        self.assertEqual(list(msg.args), [b'*', b'ACK', b'twitch.tv/tags twitch.tv/commands'])
+
+    def testParseInvalid(self) -> None:
+        for line in (b'', b' PING', b'@tags', b':prefix', b'@tags :prefix '):
+            with self.assertRaises(ValueError, msg=repr(line)):
+                irc.Message.Parse(line)
+
+    def testParseMatchesReferenceOnEdgeCases(self) -> None:
+        for line in (
+                b'PING',
+                b'PING :',
+                b'PING :tmi.twitch.tv',
+                b'CMD a b   ',
+                b'CMD a :',
+                b'CMD :a :b',
+                b'CMD a:b c',
+                b'@ CMD',
+                b'@a;b=;c=d\\ CMD',
+                b': CMD x',
+                b'::prefix CMD',
+                b'@a=b @c CMD'):
+            self.assertParsesLikeReference(line)
+
+    def testParseMatchesReferenceFuzzed(self) -> None:
+        rng = random.Random(1234)
+        alphabet = [b' ', b' ', b':', b'@', b'=', b';', b'\\', b's', b'a', b'B', b'\r', b'\n']
+        for _ in range(5000):
+            line = b''.join(rng.choice(alphabet) for _ in range(rng.randrange(24)))
+            self.assertParsesLikeReference(line)
+
+
+class MessageTagsTest(unittest.TestCase):
+    def testDecodesOnlyReadValues(self) -> None:
+        msg = irc.Message.Parse(b'@a=x\\sy;b=\\:;c CMD')
+        with mock.patch.object(irc, 'UnescapeTagValue', wraps=irc.UnescapeTagValue) as unescape:
+            self.assertEqual(msg.command, b'CMD')
+            self.assertEqual(unescape.call_count, 0)
+            self.assertEqual(msg.tags[b'b'], b';')
+            self.assertEqual(msg.tags[b'b'], b';')
+            self.assertEqual(unescape.call_count, 1)
+        self.assertEqual(list(msg.tags), [b'a', b'b', b'c'])
+        self.assertEqual(msg.tags, {b'a': b'x y', b'b': b';', b'c': b''})
+        self.assertIn(b'c', msg.tags)
+        self.assertNotIn(b'd', msg.tags)
+        self.assertIsNone(msg.tags.get(b'd'))
+
+    def testLooksUpTagsWithoutSplitting(self) -> None:
+        raw = b'user-id=1;id=2;bare;a=x\\sy;id=3;b=;bar=4'
+        expected = irc.Message.Parse(b'@' + raw + b' CMD').tags
+        for key in (b'user-id', b'id', b'bare', b'a', b'b', b'bar', b'ba', b'd', b'', b'=4'):
+            tags = irc.Message.Parse(b'@' + raw + b' CMD').tags
+            self.assertEqual(tags.get(key), dict(expected).get(key), key)
+            self.assertEqual(key in tags, key in dict(expected), key)
+
+    def testUntouchedTagsAreReemittedRaw(self) -> None:
+        # "\\q" unescapes to "q", so re-escaping would not round trip.
+        line = b'@a=\\q;b=1 :prefix CMD arg :trailing arg'
+        msg = irc.Message.Parse(line)
+        self.assertEqual(msg.tags[b'a'], b'q')
+        self.assertEqual(msg.ToWireFormat(), line)
+
+    def testMessageIsImmutable(self) -> None:
+        msg = irc.Message.Parse(b'@a=1 PRIVMSG #channel :hi')
+        with self.assertRaises(AttributeError):
+            msg.command = b'PART'
+        with self.assertRaises(TypeError):
+            msg.tags[b'a'] = b'2'  # type: ignore
+        self.assertEqual(msg.args, (b'#channel', b'hi'))
+        self.assertEqual(msg, irc.Message(b'PRIVMSG', b'#channel', b'hi', tags={b'a': b'1'}))
+        self.assertEqual(hash(msg), hash(irc.Message(b'PRIVMSG', b'#channel', b'hi')))
+        self.assertEqual(len({msg, irc.Message(b'PRIVMSG', b'#channel', b'hi', tags={b'a': b'1'})}), 1)
+
+    def testKnownNamesAreShared(self) -> None:
+        first = irc.Message.Parse(b'@display-name=a;badge-info= privmsg #channel :hi')
+        second = irc.Message.Parse(b'@display-name=b :user PRIVMSG #channel :hi')
+        self.assertIs(first.command, second.command)
+        (first_key, _) = list(first.tags)
+        (second_key,) = list(second.tags)
+        self.assertIs(first_key, second_key)
+
+    def testConstructedTags(self) -> None:
+        msg = irc.Message(b'PRIVMSG', b'#channel', b'hi', tags={b'reply-parent-msg-id': b'abc', b'x': b'a;b'})
+        self.assertEqual(msg.ToWireFormat(), b'@reply-parent-msg-id=abc;x=a\\:b PRIVMSG #channel :hi')
+        self.assertEqual(irc.Message(b'PING').ToWireFormat(), b'PING')
+
+
+class TagEscapeTest(unittest.TestCase):
+    def testUnescape(self) -> None:
+        self.assertEqual(irc.UnescapeTagValue(b'plain'), b'plain')
+        self.assertEqual(irc.UnescapeTagValue(b'a\\sb\\:c\\\\d\\r\\n'), b'a b;c\\d\r\n')
+        self.assertEqual(irc.UnescapeTagValue(b'\\\\s'), b'\\s')
+        self.assertEqual(irc.UnescapeTagValue(b'\\q\\'), b'q')
+
+    def testEscape(self) -> None:
+        self.assertEqual(irc.EscapeTagValue(b'plain'), b'plain')
+        self.assertEqual(irc.EscapeTagValue(b'a b;c\\d\r\n'), b'a\\sb\\:c\\\\d\\r\\n')
+
+    def testMatchesReferenceFuzzed(self) -> None:
+        rng = random.Random(5678)
+        alphabet = [b'\\', b'\\', b':', b';', b's', b' ', b'r', b'\r', b'n', b'\n', b'x']
+        for _ in range(5000):
+            value = b''.join(rng.choice(alphabet) for _ in range(rng.randrange(16)))
+            self.assertEqual(
+                irc.UnescapeTagValue(value), irc_testing.ReferenceUnescapeTagValue(value), msg=repr(value))
+            self.assertEqual(
+                irc.EscapeTagValue(value), irc_testing.ReferenceEscapeTagValue(value), msg=repr(value))
+            self.assertEqual(irc.UnescapeTagValue(irc.EscapeTagValue(value)), value, msg=repr(value))
+
+
+class IrcClientChannelTest(AsyncTestCase):
+    async def _Connect(self, line_filter: Optional[irc.LineFilter] = None
+                       ) -> Tuple[irc.IrcClientChannel, asyncio.StreamReader, asyncio.StreamWriter]:
+        streams = asyncio.Queue()  # type: asyncio.Queue[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]
+
+        async def OnConnect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            await streams.put((reader, writer))
+
+        server = await asyncio.start_server(OnConnect, '127.0.0.1', 0)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+        client = await irc.IrcClientChannel.Connect('127.0.0.1', port, ssl=False, line_filter=line_filter)
+        (server_reader, server_writer) = await streams.get()
+        return (client, server_reader, server_writer)
+
+    @gen_test
+    async def testReadBatch(self) -> None:
+        (client, _, server_writer) = await self._Connect()
+        server_writer.write(b''.join(b'PRIVMSG #channel :message %d\r\n' % i for i in range(500)))
+        server_writer.write_eof()
+        received = []  # type: List[irc.Message]
+        num_batches = 0
+        while True:
+            batch = await client.ReadBatch()
+            if batch is None:
+                break
+            self.assertTrue(batch)
+            num_batches += 1
+            received.extend(batch)
+        self.assertEqual([msg.args[1] for msg in received], [b'message %d' % i for i in range(500)])
+        self.assertLess(num_batches, 500)
+        client.CloseWrite()
+        await client.WaitForExit()
+
+    @gen_test
+    async def testLineFilter(self) -> None:
+        (client, _, server_writer) = await self._Connect(lambda line: not line.startswith(b'NOTICE'))
+        with mock.patch.object(irc.Message, 'Parse', wraps=irc.Message.Parse) as parse:
+            server_writer.write(b'NOTICE #channel :skipped\r\nPING :kept\r\n')
+            server_writer.write_eof()
+            msg = await client.Read()
+            assert msg is not None
+            self.assertEqual(msg.command, b'PING')
+            self.assertIsNone(await client.Read())
+            self.assertEqual(parse.call_count, 1)
+        client.CloseWrite()
+        await client.WaitForExit()
+
+    @gen_test
+    async def testReadJoinsSplitLines(self) -> None:
+        (client, _, server_writer) = await self._Connect()
+        server_writer.write(b'PING :one\r\n\r\nPING :t')
+        await server_writer.drain()
+        first = await client.Read()
+        assert first is not None
+        self.assertEqual(first.args, (b'one',))
+        server_writer.write(b'wo\r\nPING :three\r\nPING :incomplete')
+        server_writer.write_eof()
+        second = await client.Read()
+        assert second is not None
+        self.assertEqual(second.args, (b'two',))
+        self.assertEqual(await client.ReadBatch(), [irc.Message(b'PING', b'three')])
+        self.assertIsNone(await client.Read())
+        client.CloseWrite()
+        await client.WaitForExit()
+
+    @gen_test
+    async def testWriteBurst(self) -> None:
+        (client, server_reader, _) = await self._Connect()
+        writes = [client.Write(irc.Message(b'PRIVMSG', b'#channel', b'message %d' % i)) for i in range(1000)]
+        # The first writes fit in the queue without waiting.
+        self.assertTrue(asyncio.ensure_future(writes[0]).done())
+        await asyncio.gather(*writes)
+        client.CloseWrite()
+        received = await server_reader.read()
+        self.assertEqual(
+            received.split(b'\r\n'),
+            [b'PRIVMSG #channel :message %d' % i for i in range(1000)] + [b''])
+
+
+class ReplayIrcServerTest(AsyncTestCase):
+    @gen_test
+    async def testRecordAndReplay(self) -> None:
+        lines = [b'PRIVMSG #channel :message %d' % i for i in range(100)] + [b'PING :tmi.twitch.tv']
+        server = irc_testing.ReplayIrcServer(irc_testing.TrafficRecording.Synthetic(lines, rate=2000))
+        port = await server.Start()
+        self.addCleanup(server.Stop)
+        recorder = irc_testing.TrafficRecorder()
+        client = await irc.IrcClientChannel.Connect('127.0.0.1', port, ssl=False, line_filter=recorder)
+        start = time.monotonic()
+        received = []  # type: List[irc.Message]
+        while True:
+            msg = await client.Read()
+            if msg is None:
+                break
+            received.append(msg)
+        # Paced at the recorded rate, rather than sent all at once.
+        self.assertGreater(time.monotonic() - start, 0.03)
+        self.assertEqual([msg.ToWireFormat() for msg in received], lines)
+        self.assertEqual(recorder.recording.Lines(), lines)
+        self.assertEqual(len(server.sent_at), len(lines))
+        client.CloseWrite()
+        await client.WaitForExit()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'recording.txt')
+            recorder.recording.Save(path)
+            loaded = irc_testing.TrafficRecording.Load(path)
+        self.assertEqual(loaded.Lines(), lines)
+        self.assertEqual([offset for (offset, _) in loaded.entries],
+                         [round(offset, 6) for (offset, _) in recorder.recording.entries])
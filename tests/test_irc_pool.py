@@ -0,0 +1,122 @@
+import asyncio
+from typing import List, Optional, Set
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from minibot_server import irc, irc_pool
+from minibot_server.testing import irc as irc_testing
+
+
+class IrcConnectionPoolTest(AsyncTestCase):
+    connect_error: Optional[OSError] = None
+
+    async def _StartPool(self, **kwargs: int) -> irc_pool.IrcConnectionPool:
+        self.server = irc_testing.FakeIrcServer()
+        port = await self.server.Start()
+        self.addCleanup(self.server.Stop)
+
+        async def Connect() -> irc.IrcClientChannel:
+            if self.connect_error is not None:
+                raise self.connect_error
+            return await irc.IrcClientChannel.Connect('127.0.0.1', port, ssl=False)
+
+        return irc_pool.IrcConnectionPool(Connect, **kwargs)
+
+    async def _WaitForJoins(self, connections: List[irc_testing.FakeIrcConnection], count: int) -> None:
+        while sum(len(connection.joined) for connection in connections) < count:
+            await asyncio.sleep(0.01)
+
+    @gen_test
+    async def testShardsChannels(self) -> None:
+        pool = await self._StartPool(max_channels_per_connection=2)
+        channels = [b'#channel%d' % i for i in range(5)]
+        for channel in channels:
+            await pool.Join(channel)
+        self.assertEqual(pool.ConnectionCount(), 3)
+        self.assertTrue(all(len(joined) <= 2 for joined in pool.ChannelsByConnection()))
+        await self._WaitForJoins(self.server.connections, 5)
+        server_joined = set()  # type: Set[bytes]
+        for connection in self.server.connections:
+            server_joined.update(connection.joined)
+        self.assertEqual(server_joined, set(channels))
+
+        # Messages from every connection show up in the merged stream, and
+        # PINGs are answered on the connection they came from.
+        for (i, connection) in enumerate(self.server.connections):
+            connection.Send(
+                irc.Message(b'PING', b'tmi.twitch.tv'),
+                irc.Message(b'PRIVMSG', sorted(connection.joined)[0], b'hello %d' % i))
+        received = set()
+        for _ in range(3):
+            msg = await pool.Read()
+            assert msg is not None
+            received.add(msg.args[1])
+        self.assertEqual(received, {b'hello 0', b'hello 1', b'hello 2'})
+        for connection in self.server.connections:
+            pong = await connection.ReceiveUntil(b'PONG')
+            self.assertEqual(pong.args, (b'tmi.twitch.tv',))
+
+        await pool.Write(irc.Message(b'PRIVMSG', b'#channel4', b'hi'))
+        owner = next(c for c in self.server.connections if b'#channel4' in c.joined)
+        self.assertEqual((await owner.ReceiveUntil(b'PRIVMSG')).args, (b'#channel4', b'hi'))
+
+        await pool.Close()
+        self.assertIsNone(await pool.Read())
+
+    @gen_test
+    async def testRebalancesOnDisconnect(self) -> None:
+        pool = await self._StartPool(max_channels_per_connection=2)
+        for i in range(4):
+            await pool.Join(b'#channel%d' % i)
+        await self._WaitForJoins(self.server.connections, 4)
+        (first, second) = self.server.connections
+        lost_channels = set(first.joined)
+        first.Drop()
+        while len(self.server.connections) < 3:
+            await asyncio.sleep(0.01)
+        replacement = self.server.connections[2]
+        await self._WaitForJoins([replacement], 2)
+        self.assertEqual(replacement.joined, lost_channels)
+        self.assertEqual(pool.ConnectionCount(), 2)
+        await pool.Close()
+
+    @gen_test
+    async def testRebalancesOnReset(self) -> None:
+        pool = await self._StartPool(max_channels_per_connection=2)
+        for i in range(4):
+            await pool.Join(b'#channel%d' % i)
+        await self._WaitForJoins(self.server.connections, 4)
+        (first, second) = self.server.connections
+        lost_channels = set(first.joined)
+        first.Reset()
+        while len(self.server.connections) < 3:
+            await asyncio.sleep(0.01)
+        replacement = self.server.connections[2]
+        await self._WaitForJoins([replacement], 2)
+        self.assertEqual(replacement.joined, lost_channels)
+        channel = sorted(lost_channels)[0]
+        await pool.Write(irc.Message(b'PRIVMSG', channel, b'hi'))
+        self.assertEqual((await replacement.ReceiveUntil(b'PRIVMSG')).args, (channel, b'hi'))
+        await pool.Close()
+
+    @gen_test
+    async def testDropsChannelsWhenReconnectingFails(self) -> None:
+        pool = await self._StartPool(max_channels_per_connection=2)
+        for i in range(4):
+            await pool.Join(b'#channel%d' % i)
+        await self._WaitForJoins(self.server.connections, 4)
+        (first, second) = self.server.connections
+        lost_channels = set(first.joined)
+        self.connect_error = ConnectionRefusedError()
+        first.Reset()
+        while pool.ConnectionCount() > 1:
+            await asyncio.sleep(0.01)
+        self.assertEqual(pool.ChannelsByConnection(), [second.joined])
+        channel = sorted(lost_channels)[0]
+        with self.assertRaises(irc_pool.NotJoinedError):
+            pool.Write(irc.Message(b'PRIVMSG', channel, b'hi'))
+        # Joining again works once connecting does.
+        self.connect_error = None
+        await pool.Join(channel)
+        await pool.Write(irc.Message(b'PRIVMSG', channel, b'hi'))
+        await pool.Close()
@@ -0,0 +1,166 @@
+import asyncio
+import random
+import unittest
+from typing import List
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from minibot_server import irc, irc_reconnect
+from minibot_server.testing import irc as irc_testing
+
+
+class BackoffTest(unittest.TestCase):
+    def testDelaysGrowUpToMaximum(self) -> None:
+        backoff = irc_reconnect.Backoff(initial=1.0, maximum=8.0, rng=random.Random(1))
+        for cap in (1.0, 2.0, 4.0, 8.0, 8.0, 8.0):
+            delay = backoff.NextDelay()
+            self.assertGreaterEqual(delay, 0.0)
+            self.assertLessEqual(delay, cap)
+        backoff.Reset()
+        self.assertLessEqual(backoff.NextDelay(), 1.0)
+
+
+class ReconnectingIrcChannelTest(AsyncTestCase):
+    async def _Start(self, idle_timeout: float = 360.0,
+                     ping_timeout: float = 15.0) -> irc_reconnect.ReconnectingIrcChannel:
+        self.server = irc_testing.FakeIrcServer()
+        port = await self.server.Start()
+        self.addCleanup(self.server.Stop)
+
+        # Cleared to hold off reconnecting.
+        self.can_connect = asyncio.Event()
+        self.can_connect.set()
+
+        async def Connect() -> irc.IrcClientChannel:
+            await self.can_connect.wait()
+            return await irc.IrcClientChannel.Connect('127.0.0.1', port, ssl=False)
+
+        async def Login() -> List[irc.Message]:
+            return irc_reconnect.TwitchLoginMessages(b'minibot', b'token')
+
+        channel = irc_reconnect.ReconnectingIrcChannel(
+            Connect, Login, backoff=irc_reconnect.Backoff(initial=0.01),
+            idle_timeout=idle_timeout, ping_timeout=ping_timeout)
+        channel.Start()
+        return channel
+
+    async def _ExpectLogin(self, connection: irc_testing.FakeIrcConnection) -> None:
+        self.assertEqual((await connection.ReceiveUntil(b'PASS')).args, (b'oauth:token',))
+        self.assertEqual((await connection.ReceiveUntil(b'NICK')).args, (b'minibot',))
+        connection.Send(irc.Message(b'001', b'minibot', b'Welcome, GLHF!', prefix=b'tmi.twitch.tv'))
+
+    async def _ReadUntil(self, channel: irc_reconnect.ReconnectingIrcChannel,
+                         command: bytes) -> irc.Message:
+        while True:
+            msg = await channel.Read()
+            assert msg is not None
+            if msg.command == command:
+                return msg
+
+    @gen_test
+    async def testRejoinsAfterDrop(self) -> None:
+        channel = await self._Start()
+        first = await self.server.Accept()
+        await self._ExpectLogin(first)
+        await channel.Write(irc.Message(b'JOIN', b'#a,#b'))
+        await channel.Write(irc.Message(b'PART', b'#b'))
+        await first.ReceiveUntil(b'PART')
+        first.Send(irc.Message(b'PRIVMSG', b'#a', b'before', prefix=b'x!x@x'))
+        self.assertEqual((await self._ReadUntil(channel, b'PRIVMSG')).args, (b'#a', b'before'))
+
+        self.can_connect.clear()
+        first.Drop()
+        while channel.IsConnected():
+            await asyncio.sleep(0.01)
+        # Written while the connection is down, and sent once it is back.
+        await channel.Write(irc.Message(b'PRIVMSG', b'#a', b'queued'))
+        self.can_connect.set()
+        second = await self.server.Accept()
+        await self._ExpectLogin(second)
+        self.assertEqual((await second.ReceiveUntil(b'JOIN')).args, (b'#a',))
+        self.assertEqual((await second.ReceiveUntil(b'PRIVMSG')).args, (b'#a', b'queued'))
+        self.assertEqual(channel.reconnects, 1)
+        self.assertEqual(channel.JoinedChannels(), {b'#a'})
+
+        # The read stream carries on across connections, with PINGs answered.
+        second.Send(
+            irc.Message(b'PING', b'tmi.twitch.tv'),
+            irc.Message(b'PRIVMSG', b'#a', b'after', prefix=b'x!x@x'))
+        self.assertEqual((await second.ReceiveUntil(b'PONG')).args, (b'tmi.twitch.tv',))
+        self.assertEqual((await self._ReadUntil(channel, b'PRIVMSG')).args, (b'#a', b'after'))
+
+        await channel.Close()
+        self.assertIsNone(await channel.Read())
+
+    @gen_test
+    async def testReconnectsWhenServerStopsAnswering(self) -> None:
+        channel = await self._Start(idle_timeout=0.05, ping_timeout=0.05)
+        first = await self.server.Accept()
+        await self._ExpectLogin(first)
+        ping = await first.ReceiveUntil(b'PING')
+        self.assertEqual(ping.args, (b'minibot',))
+        second = await self.server.Accept()
+        await self._ExpectLogin(second)
+        self.assertEqual(channel.reconnects, 1)
+        await channel.Close()
+
+    @gen_test
+    async def testReconnectsOnReconnectCommand(self) -> None:
+        channel = await self._Start()
+        first = await self.server.Accept()
+        await self._ExpectLogin(first)
+        await channel.Write(irc.Message(b'JOIN', b'#a'))
+        await first.ReceiveUntil(b'JOIN')
+        first.Send(irc.Message(b'RECONNECT', prefix=b'tmi.twitch.tv'))
+        second = await self.server.Accept()
+        await self._ExpectLogin(second)
+        self.assertEqual((await second.ReceiveUntil(b'JOIN')).args, (b'#a',))
+        await channel.Close()
+
+    @gen_test
+    async def testKeepsBufferedMessagesThatWerentWritten(self) -> None:
+        server = irc_testing.FakeIrcServer()
+        port = await server.Start()
+        self.addCleanup(server.Stop)
+        can_connect = asyncio.Event()
+        connections = []  # type: List[irc.IrcClientChannel]
+
+        async def Connect() -> irc.IrcClientChannel:
+            await can_connect.wait()
+            connection = await irc.IrcClientChannel.Connect('127.0.0.1', port, ssl=False)
+            connections.append(connection)
+            return connection
+
+        async def Login() -> List[irc.Message]:
+            if len(connections) == 1:
+                # Lost while the buffered messages are still being written.
+                asyncio.get_event_loop().call_soon(connections[0].Abort)
+            return []
+
+        channel = irc_reconnect.ReconnectingIrcChannel(
+            Connect, Login, backoff=irc_reconnect.Backoff(initial=0.01))
+        channel.Start()
+        for i in range(15):
+            await channel.Write(irc.Message(b'PRIVMSG', b'#a', b'%d' % i))
+        can_connect.set()
+        await server.Accept()
+        second = await server.Accept()
+        # The first connection's write queue only had room for ten.
+        for i in range(10, 15):
+            self.assertEqual((await second.ReceiveUntil(b'PRIVMSG')).args, (b'#a', b'%d' % i))
+        await channel.Close()
+
+    @gen_test
+    async def testDropsOldestBufferedMessages(self) -> None:
+        async def Connect() -> irc.IrcClientChannel:
+            raise ConnectionRefusedError()
+
+        async def Login() -> List[irc.Message]:
+            return []
+
+        channel = irc_reconnect.ReconnectingIrcChannel(Connect, Login, max_buffered=2)
+        channel.Start()
+        for i in range(3):
+            await channel.Write(irc.Message(b'PRIVMSG', b'#a', b'%d' % i))
+        self.assertEqual(channel.dropped_messages, 1)
+        await asyncio.wait_for(channel.Close(), 1)
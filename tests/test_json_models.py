@@ -0,0 +1,56 @@
+import json
+import unittest
+from typing import Dict, List, Optional
+
+import attr
+
+from minibot_server import json_models, oauth
+
+
+@attr.s(auto_attribs=True, slots=True)
+class _Record:
+    name: str
+    count: int
+    ratio: float
+    tags: List[str]
+    extra: Dict[str, int]
+    note: Optional[str] = None
+
+
+class JsonModelTest(unittest.TestCase):
+    def testRoundTrip(self) -> None:
+        model = json_models.Compile(_Record)
+        record = _Record('a', 1, 0.5, ['x'], {'y': 2}, 'z')
+        self.assertEqual(model.Decode(model.Encode(record)), record)
+        self.assertIs(json_models.Compile(_Record), model)
+
+    def testDefaultsAndUnknownKeys(self) -> None:
+        model = json_models.Compile(_Record)
+        body = b'{"name": "a", "count": 1, "ratio": 2, "tags": [], "extra": {}, "other": true}'
+        self.assertEqual(model.Decode(body), _Record('a', 1, 2, [], {}))
+
+    def testRejectsBadDocuments(self) -> None:
+        model = json_models.Compile(_Record)
+        good = {'name': 'a', 'count': 1, 'ratio': 0.5, 'tags': [], 'extra': {}}
+        for (key, value) in [('count', True), ('count', '1'), ('tags', ['x', 1]),
+                             ('extra', {'y': 'z'}), ('note', 5), ('name', None)]:
+            with self.assertRaises(json_models.DecodeError):
+                model.Decode(json.dumps(dict(good, **{key: value})).encode())
+        for body in [b'[]', b'{', json.dumps({'name': 'a'}).encode()]:
+            with self.assertRaises(json_models.DecodeError):
+                model.Decode(body)
+
+    def testMatchesSerde(self) -> None:
+        body = json.dumps({
+            'access_token': 'access',
+            'refresh_token': 'refresh',
+            'expires_in': 3600,
+            'scopes': ['openid'],
+        }).encode()
+        serde = oauth.SerdeJsonResponseParser(oauth.CodeExchangeResponse).ParseResponseBody(
+            'application/json', body)
+        fast = oauth.JsonModelResponseParser(oauth.CodeExchangeRecord).ParseResponseBody(
+            'application/json', body)
+        self.assertEqual(attr.asdict(fast), serde.to_dict())
+        self.assertEqual(json.loads(oauth.JsonModelRequest(fast).content),
+                         json.loads(oauth.SerdeJsonRequest(serde).content))
@@ -0,0 +1,161 @@
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado import web
+import asyncio
+import unittest
+from typing import Any
+
+from minibot_server import jwks
+from minibot_server.http_client import HttpClient
+from minibot_server.testing import jwks as jwks_testing
+
+try:
+    import cryptography  # noqa: F401
+    _HAVE_CRYPTOGRAPHY = True
+except ImportError:
+    _HAVE_CRYPTOGRAPHY = False
+
+
+class CacheLifetimeTest(unittest.TestCase):
+    def testParsesCacheControl(self) -> None:
+        self.assertEqual(jwks.CacheLifetime('public, max-age=3600'), 3600)
+        self.assertEqual(jwks.CacheLifetime('max-age="60", must-revalidate'), 60)
+        self.assertEqual(jwks.CacheLifetime('no-store'), 0)
+        self.assertEqual(jwks.CacheLifetime('public, no-cache'), 0)
+        self.assertIsNone(jwks.CacheLifetime('public'))
+        self.assertIsNone(jwks.CacheLifetime(None))
+
+
+class JwksCacheTest(AsyncHTTPTestCase):
+    key_set: jwks_testing.FakeKeySet
+
+    def get_app(self) -> web.Application:
+        self.key_set = jwks_testing.FakeKeySet()
+        return jwks_testing.MakeJwksApp(self.key_set)
+
+    def MakeVerifier(self, **kwargs: Any) -> jwks.IdTokenVerifier:
+        http_client = HttpClient()
+        self.addCleanup(http_client.Close)
+        cache = jwks.JwksCache(self.get_url('/keys'), http_client=http_client, **kwargs)
+        return jwks.IdTokenVerifier(cache, audience='client', issuer=self.key_set.issuer,
+                                    algorithms=['HS256'])
+
+    @gen_test
+    async def testVerifiesFromCache(self) -> None:
+        kid = self.key_set.AddKey()
+        verifier = self.MakeVerifier()
+        token = self.key_set.SignIdToken(kid, audience='client', nonce='n')
+        with self.assertRaises(jwks.UnknownKeyError):
+            verifier.VerifyCached(token)
+        claims = await verifier.Verify(token, nonce='n')
+        self.assertEqual(claims['sub'], '12345')
+        for _ in range(100):
+            await verifier.Verify(token)
+            verifier.VerifyCached(token)
+        self.assertEqual(self.key_set.fetches, 1)
+
+    @gen_test
+    async def testRejectsBadTokens(self) -> None:
+        kid = self.key_set.AddKey()
+        verifier = self.MakeVerifier()
+        other_keys = jwks_testing.FakeKeySet()
+        other_kid = other_keys.AddKey()
+        bad_tokens = [
+            self.key_set.SignIdToken(kid, audience='other client'),
+            self.key_set.SignIdToken(kid, audience='client', lifetime=-3600),
+            self.key_set.SignIdToken(kid, audience='client', iss='https://other.issuer'),
+            other_keys.SignIdToken(other_kid, audience='client'),
+            'not a token',
+        ]
+        # A signature made with another key, under a kid we know.
+        (header, payload, _) = self.key_set.SignIdToken(kid, audience='client').split('.')
+        (_, _, signature) = other_keys.SignIdToken(other_kid, audience='client').split('.')
+        bad_tokens.append('.'.join([header, payload, signature]))
+        for token in bad_tokens:
+            with self.assertRaises(jwks.InvalidTokenError):
+                await verifier.Verify(token)
+        with self.assertRaises(jwks.InvalidTokenError):
+            await verifier.Verify(self.key_set.SignIdToken(kid, audience='client', nonce='other'),
+                                  nonce='n')
+
+    @gen_test
+    async def testUnknownKidsShareOneFetch(self) -> None:
+        first = self.key_set.AddKey()
+        verifier = self.MakeVerifier(min_refetch_interval=0)
+        await verifier.Verify(self.key_set.SignIdToken(first, audience='client'))
+
+        # The provider rotates in a new key.
+        self.key_set.fetch_delay = 0.05
+        second = self.key_set.AddKey()
+        token = self.key_set.SignIdToken(second, audience='client')
+        await asyncio.gather(*[verifier.Verify(token) for _ in range(20)])
+        self.assertEqual(self.key_set.fetches, 2)
+
+    @gen_test
+    async def testUnknownKidFetchesAreLimited(self) -> None:
+        kid = self.key_set.AddKey()
+        verifier = self.MakeVerifier()
+        await verifier.Verify(self.key_set.SignIdToken(kid, audience='client'))
+        other_keys = jwks_testing.FakeKeySet()
+        for _ in range(10):
+            token = other_keys.SignIdToken(other_keys.AddKey(), audience='client')
+            with self.assertRaises(jwks.InvalidTokenError):
+                await verifier.Verify(token)
+        self.assertEqual(self.key_set.fetches, 1)
+
+    @gen_test
+    async def testHonorsCacheControl(self) -> None:
+        now = [1000.0]
+        self.key_set.AddKey()
+        self.key_set.cache_control = 'max-age=120'
+        http_client = HttpClient()
+        self.addCleanup(http_client.Close)
+        cache = jwks.JwksCache(self.get_url('/keys'), http_client=http_client, min_ttl=60,
+                               max_ttl=600, clock=lambda: now[0])
+        await cache.Refresh()
+        self.assertEqual(cache.Expires(), 1120)
+        self.key_set.cache_control = 'no-store'
+        await cache.Refresh()
+        self.assertEqual(cache.Expires(), 1060)
+        self.key_set.cache_control = 'max-age=86400'
+        await cache.Refresh()
+        self.assertEqual(cache.Expires(), 1600)
+
+    @gen_test
+    async def testRefreshesInBackground(self) -> None:
+        kid = self.key_set.AddKey()
+        self.key_set.cache_control = 'no-cache'
+        http_client = HttpClient()
+        self.addCleanup(http_client.Close)
+        cache = jwks.JwksCache(self.get_url('/keys'), http_client=http_client, min_ttl=0.1,
+                               refresh_ahead=0.5)
+        cache.Start()
+        try:
+            await asyncio.sleep(0.3)
+            self.assertGreaterEqual(self.key_set.fetches, 3)
+            self.assertEqual(cache.Kids(), [kid])
+            # Keys the provider stops publishing are dropped.
+            self.key_set.RemoveKey(kid)
+            await asyncio.sleep(0.15)
+            self.assertEqual(cache.Kids(), [])
+        finally:
+            await cache.Stop()
+
+
+@unittest.skipUnless(_HAVE_CRYPTOGRAPHY, "RSA keys need the cryptography package")
+class RsaJwksTest(AsyncHTTPTestCase):
+    key_set: jwks_testing.FakeKeySet
+
+    def get_app(self) -> web.Application:
+        self.key_set = jwks_testing.FakeKeySet(algorithm='RS256')
+        return jwks_testing.MakeJwksApp(self.key_set)
+
+    @gen_test
+    async def testVerifiesRsaKeys(self) -> None:
+        kid = self.key_set.AddKey()
+        http_client = HttpClient()
+        self.addCleanup(http_client.Close)
+        verifier = jwks.IdTokenVerifier(
+            jwks.JwksCache(self.get_url('/keys'), http_client=http_client),
+            audience='client', issuer=self.key_set.issuer)
+        claims = await verifier.Verify(self.key_set.SignIdToken(kid, audience='client'))
+        self.assertEqual(claims['aud'], 'client')
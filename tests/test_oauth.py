@@ -1,12 +1,15 @@
-from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
 from tornado import web
 from tornado import httpclient as hc
+import asyncio
 import json
 import logging
+import time
 import urllib
 
 from minibot_server import oauth, app
 from minibot_server.testing import oauth as oauth_testing
+from minibot_server.http_client import HttpClient
 
 LOG = logging.Logger(__name__)
 
@@ -14,7 +17,7 @@ class OauthTest(AsyncHTTPTestCase):
     provider: oauth_testing.FakeOAuthProvider
 
     def get_app(self) -> web.Application:
-        self.provider = oauth_testing.FakeOAuthProvider()
+        self.provider = oauth_testing.FakeOAuthProvider(HttpClient())
         return app.CreateApp(self.provider)
 
     @gen_test
@@ -32,3 +35,123 @@ class OauthTest(AsyncHTTPTestCase):
         })}'''
         resp = await client.fetch(complete_url, method='POST', body='')
 
+    @gen_test
+    async def testCallbackRejectsUnknownState(self) -> None:
+        client = hc.AsyncHTTPClient()
+        callback_url = self.get_url('/callback?' + urllib.parse.urlencode({
+            'state': 'forged', 'code': 'code'}))
+        with self.assertRaises(hc.HTTPClientError) as raised:
+            await client.fetch(callback_url)
+        self.assertEqual(raised.exception.code, 400)
+
+
+class RefreshableTokenTest(AsyncTestCase):
+    @gen_test
+    async def testConcurrentCallersShareOneRefresh(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient(), token_lifetime=3600)
+        provider.refresh_delay = 0.05
+        token = provider.IssueToken(oauth.Timestamp(0))
+        expired_time = oauth.Timestamp(4000)
+        self.assertIsNone(token.TryGet(expired_time))
+        results = await asyncio.gather(*[token.Get(expired_time, provider) for _ in range(50)])
+        self.assertEqual(provider.refresh_calls, 1)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(token.TryGet(expired_time), results[0])
+
+        # The rotated refresh token is used next time.
+        await token.Refresh(expired_time, provider)
+        self.assertEqual(provider.refresh_calls, 2)
+
+    @gen_test
+    async def testRefreshesAheadOfExpiry(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient(), token_lifetime=3600)
+        token = provider.IssueToken(oauth.Timestamp(0))
+        refresh_at = token.RefreshAt()
+        assert refresh_at is not None
+        self.assertTrue(3600 - 300 - 60 <= refresh_at <= 3600 - 300)
+
+        old = await token.Get(oauth.Timestamp(refresh_at - 1), provider)
+        self.assertFalse(token.Refreshing())
+        # Past the refresh time, the current token is still returned while
+        # the refresh runs in the background.
+        self.assertEqual(await token.Get(oauth.Timestamp(refresh_at), provider), old)
+        self.assertTrue(token.Refreshing())
+        self.assertEqual(await token.Get(oauth.Timestamp(refresh_at), provider), old)
+        await token.Refresh(oauth.Timestamp(refresh_at), provider)
+        self.assertEqual(provider.refresh_calls, 1)
+        self.assertNotEqual(token.TryGet(oauth.Timestamp(refresh_at)), old)
+
+    @gen_test
+    async def testFailedRefreshIsRetried(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient(), token_lifetime=3600)
+        token = provider.IssueToken(oauth.Timestamp(0))
+        other_provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        with self.assertRaises(KeyError):
+            await token.Get(oauth.Timestamp(4000), other_provider)
+        self.assertFalse(token.Refreshing())
+        await token.Get(oauth.Timestamp(4000), provider)
+        self.assertEqual(provider.refresh_calls, 1)
+
+class OAuthCallbackManagerTest(AsyncTestCase):
+    @gen_test
+    async def testExchangesRunConcurrently(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        provider.exchange_delay = 0.2
+        manager = oauth.OAuthCallbackManager(provider)
+        flows = [manager.start_flow() for _ in range(20)]
+        waiters = [asyncio.ensure_future(manager.wait_result(claim_token))
+                   for (claim_token, _) in flows]
+        callbacks = [provider.IssueCode(auth_url) for (_, auth_url) in flows]
+
+        start = time.monotonic()
+        await asyncio.gather(*[manager.complete(state, code) for (state, code) in callbacks])
+        elapsed = time.monotonic() - start
+        # Twenty exchanges in about the time of one, rather than of twenty.
+        self.assertLess(elapsed, 3 * provider.exchange_delay)
+
+        tokens = await asyncio.gather(*waiters)
+        self.assertEqual(len({token.TryGet(oauth.Timestamp(0)) for token in tokens}), 20)
+
+    @gen_test
+    async def testCodeIsOnlyExchangedOnce(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        provider.exchange_delay = 0.05
+        manager = oauth.OAuthCallbackManager(provider)
+        (claim_token, auth_url) = manager.start_flow()
+        (state, code) = provider.IssueCode(auth_url)
+        first = asyncio.ensure_future(manager.complete(state, code))
+        await asyncio.sleep(0)
+        with self.assertRaises(oauth.UnknownStateError):
+            await manager.complete(state, code)
+        await first
+        with self.assertRaises(oauth.UnknownStateError):
+            await manager.complete(state, code)
+        self.assertIsNotNone(await manager.wait_result(claim_token))
+        with self.assertRaises(oauth.UnknownStateError):
+            await manager.complete('unknown', code)
+
+    @gen_test
+    async def testCancelledWaiterLeavesOthersWaiting(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        manager = oauth.OAuthCallbackManager(provider)
+        (claim_token, auth_url) = manager.start_flow()
+        waiters = [asyncio.ensure_future(manager.wait_result(claim_token)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(waiters[0], 0.01)
+        await manager.complete(*provider.IssueCode(auth_url))
+        self.assertIsNotNone(await waiters[1])
+
+    @gen_test
+    async def testAbandonedFlowsExpire(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        manager = oauth.OAuthCallbackManager(provider, ttl=0.05, capacity=2)
+        waiters = [asyncio.ensure_future(manager.wait_result(manager.start_flow()[0]))
+                   for _ in range(3)]
+        await asyncio.sleep(0)
+        self.assertEqual(manager.Stats().evicted, 1)
+        await asyncio.sleep(0.1)
+        self.assertEqual(manager.Stats().size, 0)
+        for waiter in waiters:
+            with self.assertRaises(oauth.UnknownStateError):
+                await waiter
@@ -0,0 +1,101 @@
+from tornado.testing import AsyncTestCase, gen_test
+import asyncio
+import os
+import tempfile
+import unittest
+
+from minibot_server import oauth, oauth_state
+from minibot_server.testing import oauth as oauth_testing
+from minibot_server.http_client import HttpClient
+
+
+class StateSignerTest(unittest.TestCase):
+    def testRoundTrip(self) -> None:
+        signer = oauth_state.StateSigner(b'key', clock=lambda: 1000.0)
+        token = signer.Issue('state', 'flow')
+        self.assertEqual(signer.Verify('state', token), ('flow', 1600.0))
+
+    def testRejectsForgedTokens(self) -> None:
+        signer = oauth_state.StateSigner(b'key')
+        token = signer.Issue('state', 'flow')
+        (version, expires, _, signature) = token.split('.')
+        for forged in [
+                '.'.join([version, expires, 'other', signature]),
+                '.'.join([version, str(int(expires) + 1000), 'flow', signature]),
+                oauth_state.StateSigner(b'other key').Issue('state', 'flow'),
+                'garbage']:
+            with self.assertRaises(oauth_state.InvalidStateError):
+                signer.Verify('state', forged)
+        # A token is only good for the purpose it was issued for.
+        with self.assertRaises(oauth_state.InvalidStateError):
+            signer.Verify('claim', token)
+
+    def testExpires(self) -> None:
+        now = [1000.0]
+        signer = oauth_state.StateSigner(b'key', ttl=60, clock=lambda: now[0])
+        token = signer.Issue('state', 'flow')
+        now[0] += 61
+        with self.assertRaises(oauth_state.ExpiredStateError):
+            signer.Verify('state', token)
+
+    def testAcceptsPreviousKeys(self) -> None:
+        token = oauth_state.StateSigner(b'old key').Issue('state', 'flow')
+        signer = oauth_state.StateSigner(b'new key', previous_keys=[b'old key'])
+        self.assertEqual(signer.Verify('state', token)[0], 'flow')
+
+
+class ResultHandoffTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tempdir.name, 'results.db')
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    @gen_test
+    async def testReplicasCompleteEachOthersFlows(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        replicas = []
+        handoffs = []
+        for _ in range(2):
+            results = oauth_state.SqliteResultHandoff(self.db_path, poll_interval=0.01)
+            handoffs.append(results)
+            replicas.append(oauth.OAuthCallbackManager(
+                provider, signer=oauth_state.StateSigner(b'shared key'), results=results))
+        (first, second) = replicas
+
+        (claim_token, auth_url) = first.start_flow()
+        (state, code) = provider.IssueCode(auth_url)
+        waiter = asyncio.ensure_future(second.wait_result(claim_token))
+        await second.complete(state, code)
+        token = await asyncio.wait_for(waiter, 1)
+        self.assertIsNotNone(token.TryGet(oauth.Timestamp(0)))
+
+        # A replayed callback is refused by every replica.
+        for replica in replicas:
+            with self.assertRaises(oauth.UnknownStateError):
+                await replica.complete(state, code)
+        for results in handoffs:
+            await results.Close()
+
+    @gen_test
+    async def testFailedExchangeIsReported(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        manager = oauth.OAuthCallbackManager(provider)
+        (claim_token, auth_url) = manager.start_flow()
+        (state, _) = provider.IssueCode(auth_url)
+        waiter = asyncio.ensure_future(manager.wait_result(claim_token))
+        with self.assertRaises(KeyError):
+            await manager.complete(state, 'bad code')
+        with self.assertRaises(oauth_state.FlowFailedError):
+            await waiter
+
+    @gen_test
+    async def testForgedClaimTokenIsRefused(self) -> None:
+        manager = oauth.OAuthCallbackManager(oauth_testing.FakeOAuthProvider(HttpClient()))
+        (claim_token, auth_url) = manager.start_flow()
+        other = oauth.OAuthCallbackManager(oauth_testing.FakeOAuthProvider(HttpClient()))
+        with self.assertRaises(oauth.UnknownStateError):
+            await other.wait_result(claim_token)
@@ -0,0 +1,128 @@
+import asyncio
+import collections
+import unittest
+from typing import Deque, List
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from minibot_server import irc, ratelimit
+
+
+class FakeClock:
+    now: float
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _Chat(text: bytes) -> irc.Message:
+    return irc.Message(b'PRIVMSG', b'#channel', text)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def testForLimitNeverExceedsLimitInAnyWindow(self) -> None:
+        bucket = ratelimit.TokenBucket.ForLimit(20, 30, 0.0)
+        taken = collections.deque()  # type: Deque[float]
+        now = 0.0
+        while now < 300:
+            while bucket.Available(now):
+                bucket.Take(now)
+                taken.append(now)
+            while taken[0] <= now - 30:
+                taken.popleft()
+            self.assertLessEqual(len(taken), 20)
+            now += 0.1
+
+
+class WriteSchedulerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.scheduler = ratelimit.WriteScheduler(clock=self.clock)
+
+    def _PopAll(self) -> List[irc.Message]:
+        popped = []  # type: List[irc.Message]
+        while True:
+            msg = self.scheduler.Pop()
+            if msg is None:
+                return popped
+            popped.append(msg)
+
+    def testClassifyMessage(self) -> None:
+        self.assertEqual(ratelimit.ClassifyMessage(irc.Message(b'PONG', b'tmi.twitch.tv')), ratelimit.Lane.CONTROL)
+        self.assertEqual(ratelimit.ClassifyMessage(_Chat(b'/timeout spammer 600')), ratelimit.Lane.MODERATION)
+        self.assertEqual(ratelimit.ClassifyMessage(_Chat(b'/w friend hi')), ratelimit.Lane.WHISPER)
+        self.assertEqual(ratelimit.ClassifyMessage(_Chat(b'hello')), ratelimit.Lane.CHAT)
+        self.assertEqual(ratelimit.ClassifyMessage(irc.Message(b'JOIN', b'#channel')), ratelimit.Lane.JOIN)
+        self.assertEqual(ratelimit.ClassifyMessage(irc.Message(b'PART', b'#channel')), ratelimit.Lane.OTHER)
+
+    def testChatIsRateLimited(self) -> None:
+        for i in range(30):
+            self.scheduler.Push(_Chat(b'%d' % i))
+        self.assertEqual([msg.args[1] for msg in self._PopAll()], [b'%d' % i for i in range(10)])
+        self.assertAlmostEqual(self.scheduler.TimeUntilReady() or 0, 3.0)
+        self.clock.now += 3.0
+        self.assertEqual([msg.args[1] for msg in self._PopAll()], [b'10'])
+        self.assertIsNone(self.scheduler.Pop())
+
+    def testPriorityLanes(self) -> None:
+        for i in range(12):
+            self.scheduler.Push(_Chat(b'%d' % i))
+        self.scheduler.Push(_Chat(b'/ban spammer'))
+        self.scheduler.Push(irc.Message(b'PONG', b'tmi.twitch.tv'))
+        self.scheduler.Push(irc.Message(b'JOIN', b'#other'))
+        popped = self._PopAll()
+        self.assertEqual(popped[0].command, b'PONG')
+        self.assertEqual(popped[1].args[1], b'/ban spammer')
+        # The chat lane running out of tokens doesn't hold back the JOIN.
+        self.assertEqual(popped[-1].command, b'JOIN')
+        self.assertEqual(len(popped), 12)
+
+    def testModeratorLimit(self) -> None:
+        scheduler = ratelimit.WriteScheduler(is_moderator=True, clock=self.clock)
+        for i in range(60):
+            scheduler.Push(_Chat(b'%d' % i))
+        sent = 0
+        while scheduler.Pop() is not None:
+            sent += 1
+        self.assertEqual(sent, 50)
+
+    def testStats(self) -> None:
+        for i in range(12):
+            self.scheduler.Push(_Chat(b'%d' % i))
+        self.clock.now += 1.0
+        self._PopAll()
+        stats = self.scheduler.Stats()[ratelimit.Lane.CHAT]
+        self.assertEqual((stats.queued, stats.sent), (2, 10))
+        self.assertAlmostEqual(stats.max_wait, 1.0)
+        self.clock.now += 6.0
+        self._PopAll()
+        stats = self.scheduler.Stats()[ratelimit.Lane.CHAT]
+        self.assertEqual((stats.queued, stats.sent), (0, 12))
+        self.assertAlmostEqual(stats.max_wait, 7.0)
+
+
+class ScheduledChannelTest(AsyncTestCase):
+    @gen_test
+    async def testChannelSendsThroughScheduler(self) -> None:
+        received = asyncio.get_event_loop().create_future()  # type: asyncio.Future[bytes]
+
+        async def OnConnect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            received.set_result(await reader.read())
+            writer.close()
+
+        server = await asyncio.start_server(OnConnect, '127.0.0.1', 0)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+        scheduler = ratelimit.WriteScheduler()
+        client = await irc.IrcClientChannel.Connect('127.0.0.1', port, ssl=False, scheduler=scheduler)
+        for i in range(10):
+            client.Write(_Chat(b'%d' % i))
+        await client.Write(irc.Message(b'PONG', b'tmi.twitch.tv'))
+        client.CloseWrite()
+        lines = (await received).split(b'\r\n')
+        self.assertEqual(lines[0], b'PONG :tmi.twitch.tv')
+        self.assertEqual(lines[1:], [b'PRIVMSG #channel :%d' % i for i in range(10)] + [b''])
+        await client.WaitForExit()
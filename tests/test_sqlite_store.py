@@ -0,0 +1,267 @@
+from tornado.testing import AsyncTestCase, gen_test
+import asyncio
+import os
+import sqlite3
+import tempfile
+from typing import List
+
+from minibot_server import oauth, sqlite_store, tokens, users
+from minibot_server.testing import oauth as oauth_testing
+from minibot_server.http_client import HttpClient
+
+
+def NewTwitchUser(provider: oauth_testing.FakeOAuthProvider, twitch_id: str) -> users.TwitchUser:
+    return users.TwitchUser(twitch_id, provider.IssueToken(oauth.Timestamp(0)))
+
+
+class SqliteStoreTestCase(AsyncTestCase):
+    path: str
+
+    def setUp(self) -> None:
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = os.path.join(tempdir.name, 'minibot.db')
+
+
+class WriteBatcherTest(SqliteStoreTestCase):
+    @gen_test
+    async def testFailedWriteDoesNotUndoOthers(self) -> None:
+        db = sqlite_store.OpenDatabase(self.path)
+        db.execute("CREATE TABLE t (id INTEGER PRIMARY KEY)")
+        writer = sqlite_store.WriteBatcher(self.path)
+        futures = [writer.Write("INSERT INTO t (id) VALUES (?)", (i,)) for i in (1, 2, 1, 3)]
+        await writer.Flush()
+        await asyncio.wait(futures)
+        self.assertIsInstance(futures[2].exception(), sqlite3.IntegrityError)
+        self.assertTrue(all(futures[i].exception() is None for i in (0, 1, 3)))
+        self.assertEqual([row[0] for row in db.execute("SELECT id FROM t ORDER BY id")], [1, 2, 3])
+        stats = writer.Stats()
+        self.assertEqual((stats.failed_batches, stats.failed_writes), (1, 1))
+        await writer.Close()
+        db.close()
+
+
+class SqliteTokenStoreTest(SqliteStoreTestCase):
+    hasher = tokens.TokenHasher(b'test key')
+
+    @gen_test
+    async def testReadsOwnWritesAndPersists(self) -> None:
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        created = [store.CreateToken(users.UserId(1), oauth.Timestamp(100)) for _ in range(3)]
+        (_, other) = store.CreateToken(users.UserId(2), oauth.Timestamp(100))
+        # Visible before anything is committed.
+        self.assertEqual(store.FindToken(created[0][0], oauth.Timestamp(100)), created[0][1])
+        self.assertEqual(store.RevokeToken(created[0][1].id), created[0][1])
+        self.assertIsNone(store.FindToken(created[0][0], oauth.Timestamp(100)))
+        self.assertEqual(len(store.FindUserTokens(users.UserId(1))), 2)
+        await store.Flush()
+        stats = store.WriteStats()
+        self.assertEqual(stats.writes, 5)
+        self.assertLess(stats.batches, stats.writes)
+        await store.Close()
+
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        self.assertIsNone(store.FindToken(created[0][0], oauth.Timestamp(100)))
+        self.assertEqual(store.FindToken(created[1][0], oauth.Timestamp(100)), created[1][1])
+        self.assertEqual({token.id for token in store.FindUserTokens(users.UserId(1))},
+                         {created[1][1].id, created[2][1].id})
+        self.assertEqual(store.FindUserTokens(users.UserId(2)), [other])
+        await store.Close()
+
+    @gen_test
+    async def testRevokeUserTokens(self) -> None:
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        (committed, _) = store.CreateToken(users.UserId(1), oauth.Timestamp(100))
+        await store.Flush()
+        (pending, _) = store.CreateToken(users.UserId(1), oauth.Timestamp(100))
+        store.RevokeUserTokens(users.UserId(1))
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [])
+        self.assertIsNone(store.FindToken(committed, oauth.Timestamp(100)))
+        self.assertIsNone(store.FindToken(pending, oauth.Timestamp(100)))
+        await store.Close()
+
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [])
+        await store.Close()
+
+    @gen_test
+    async def testFailedWritesStayInOverlay(self) -> None:
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        (kept_secret, kept) = store.CreateToken(users.UserId(1), oauth.Timestamp(100))
+        await store.Flush()
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TRIGGER keep BEFORE DELETE ON tokens WHEN old.id = '%s' "
+                   "BEGIN SELECT RAISE(ABORT, 'kept'); END" % kept.id)
+        db.commit()
+        db.close()
+
+        store.RevokeToken(kept.id)
+        (other_secret, other) = store.CreateToken(users.UserId(2), oauth.Timestamp(100))
+        await store.Flush()
+        self.assertEqual(store.WriteStats().failed_writes, 1)
+        # The revocation isn't undone, and the unrelated write is committed.
+        self.assertIsNone(store.FindToken(kept_secret, oauth.Timestamp(100)))
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [])
+        self.assertEqual(store.Stats().live, 1)
+        await store.Close()
+
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        self.assertEqual(store.FindToken(other_secret, oauth.Timestamp(100)), other)
+        await store.Close()
+
+    @gen_test
+    async def testExpiry(self) -> None:
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        (secret, token) = store.CreateToken(users.UserId(1), oauth.Timestamp(100), ttl=10)
+        self.assertEqual(token.expires_at, 110)
+        await store.Flush()
+        await store.Close()
+
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        self.assertEqual(store.FindToken(secret, oauth.Timestamp(109)), token)
+        self.assertIsNone(store.FindToken(secret, oauth.Timestamp(110)))
+        # Expired tokens are still there until they are swept.
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [token])
+        await store.Close()
+
+    @gen_test
+    async def testSweepsInExpiryOrder(self) -> None:
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        committed = [store.CreateToken(users.UserId(1), oauth.Timestamp(0), ttl=ttl)[1]
+                     for ttl in (30, 10, 20)]
+        await store.Flush()
+        (_, pending) = store.CreateToken(users.UserId(2), oauth.Timestamp(0), ttl=5)
+        store.CreateToken(users.UserId(2), oauth.Timestamp(0))
+        self.assertEqual(store.NextExpiry(), 5)
+        self.assertEqual(store.Sweep(oauth.Timestamp(25), 2), [pending, committed[1]])
+        # The swept rows are still in the table until the deletes commit.
+        self.assertEqual(store.Sweep(oauth.Timestamp(25), 2), [committed[2]])
+        self.assertEqual(store.Sweep(oauth.Timestamp(25), 2), [])
+        self.assertEqual(store.Stats(), tokens.TokenStoreStats(live=2, created=5, expired=3))
+        await store.Close()
+
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        self.assertEqual(store.Stats().live, 2)
+        self.assertEqual(store.NextExpiry(), 30)
+        self.assertEqual(store.Sweep(oauth.Timestamp(25), 2), [])
+        await store.Close()
+
+    @gen_test
+    async def testAddsExpiryToVersion1(self) -> None:
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE tokens (id TEXT PRIMARY KEY, user INTEGER NOT NULL, "
+                   "created_at INTEGER NOT NULL, desc TEXT)")
+        db.execute("INSERT INTO tokens (id, user, created_at) VALUES (?, 1, 100)",
+                   (self.hasher.IdFor(tokens.TokenSecret('secret')),))
+        db.execute("PRAGMA user_version = 1")
+        db.commit()
+        db.close()
+
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        token = store.FindToken(tokens.TokenSecret('secret'), oauth.Timestamp(100))
+        assert token is not None
+        self.assertIsNone(token.expires_at)
+        store.CreateToken(users.UserId(1), oauth.Timestamp(100), ttl=10)
+        await store.Flush()
+        await store.Close()
+
+        store = tokens.SqliteTokenStore(self.path, self.hasher)
+        self.assertEqual(store.NextExpiry(), 110)
+        self.assertEqual(len(store.FindUserTokens(users.UserId(1))), 2)
+        await store.Close()
+
+
+class SqliteUserStoreTest(SqliteStoreTestCase):
+    @gen_test
+    async def testPersistsUsersAndRefreshedTokens(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient(), token_lifetime=3600)
+        store = users.SqliteUserStore(self.path)
+        user = store.CreateUser(oauth.Timestamp(100), NewTwitchUser(provider, 'streamer'))
+        store.AddBot(user.user_id, NewTwitchUser(provider, 'bot'))
+        self.assertIs(store.GetUserByTwitchId('streamer'), user)
+        with self.assertRaises(users.UserAlreadyExistsError):
+            store.CreateUser(oauth.Timestamp(100), NewTwitchUser(provider, 'streamer'))
+        await store.Flush()
+        await user.twitch_user.Token().Refresh(oauth.Timestamp(4000), provider)
+        refreshed = user.twitch_user.Token().TryGet(oauth.Timestamp(4000))
+        await store.Close()
+
+        store = users.SqliteUserStore(self.path)
+        loaded = store.GetUserByTwitchId('streamer')
+        self.assertIs(store.GetUser(user.user_id), loaded)
+        self.assertEqual(loaded.created_at, 100)
+        self.assertEqual(loaded.twitch_user.Token().TryGet(oauth.Timestamp(4000)), refreshed)
+        assert loaded.twitch_bot is not None
+        self.assertEqual(loaded.twitch_bot.twitch_id, 'bot')
+        # The rotated refresh token was saved, so the next refresh works.
+        await loaded.twitch_user.Token().Refresh(oauth.Timestamp(8000), provider)
+        await store.Close()
+
+    @gen_test
+    async def testReplacedBotTokenIsNotSaved(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient(), token_lifetime=3600)
+        store = users.SqliteUserStore(self.path)
+        user = store.CreateUser(oauth.Timestamp(100), NewTwitchUser(provider, 'streamer'))
+        old_bot = NewTwitchUser(provider, 'old bot')
+        store.AddBot(user.user_id, old_bot)
+        new_bot = NewTwitchUser(provider, 'new bot')
+        store.AddBot(user.user_id, new_bot)
+        await old_bot.Token().Refresh(oauth.Timestamp(4000), provider)
+        await store.Close()
+
+        store = users.SqliteUserStore(self.path)
+        loaded = store.GetUser(user.user_id).twitch_bot
+        assert loaded is not None
+        self.assertEqual(loaded.twitch_id, 'new bot')
+        self.assertEqual(loaded.Token().ToJson(), new_bot.Token().ToJson())
+        await store.Close()
+
+    @gen_test
+    async def testDeleteUser(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        store = users.SqliteUserStore(self.path)
+        added = []  # type: List[str]
+        removed = []  # type: List[str]
+        store.AddTwitchUserListeners(added=lambda twitch_user: added.append(twitch_user.twitch_id),
+                                     removed=lambda twitch_user: removed.append(twitch_user.twitch_id))
+        first = store.CreateUser(oauth.Timestamp(100), NewTwitchUser(provider, 'a'))
+        store.AddBot(first.user_id, NewTwitchUser(provider, 'bot'))
+        store.CreateUser(oauth.Timestamp(100), NewTwitchUser(provider, 'b'))
+        await store.Flush()
+        store.DeleteUser(first.user_id)
+        self.assertEqual((added, removed), (['a', 'bot', 'b'], ['a', 'bot']))
+        with self.assertRaises(users.NoSuchUserError):
+            store.GetUser(first.user_id)
+        with self.assertRaises(users.NoSuchUserError):
+            store.GetUserByTwitchId('a')
+        again = store.CreateUser(oauth.Timestamp(200), NewTwitchUser(provider, 'a'))
+        self.assertNotEqual(again.user_id, first.user_id)
+        self.assertEqual(len(store.AllUsers()), 2)
+        await store.Close()
+
+        store = users.SqliteUserStore(self.path)
+        self.assertEqual({user.twitch_user.twitch_id for user in store.AllUsers()}, {'a', 'b'})
+        self.assertEqual(store.GetUserByTwitchId('a').user_id, again.user_id)
+        created = store.CreateUser(oauth.Timestamp(300), NewTwitchUser(provider, 'c'))
+        self.assertEqual(created.user_id, again.user_id + 1)
+        await store.Close()
+
+    @gen_test
+    async def testFailedDeleteKeepsUserHidden(self) -> None:
+        provider = oauth_testing.FakeOAuthProvider(HttpClient())
+        store = users.SqliteUserStore(self.path)
+        user = store.CreateUser(oauth.Timestamp(100), NewTwitchUser(provider, 'a'))
+        await store.Flush()
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TRIGGER keep BEFORE DELETE ON users "
+                   "BEGIN SELECT RAISE(ABORT, 'kept'); END")
+        db.commit()
+        db.close()
+        store.DeleteUser(user.user_id)
+        await store.Flush()
+        self.assertEqual(store.WriteStats().failed_writes, 1)
+        with self.assertRaises(users.NoSuchUserError):
+            store.GetUserByTwitchId('a')
+        self.assertEqual(store.AllUsers(), [])
+        await store.Close()
@@ -0,0 +1,132 @@
+import asyncio
+from typing import List
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from minibot_server import oauth, token_refresh, users
+from minibot_server.testing import oauth as oauth_testing
+from minibot_server.http_client import HttpClient
+
+
+class _CountingProvider(oauth_testing.FakeOAuthProvider):
+    active: int
+    max_active: int
+
+    def __init__(self) -> None:
+        super().__init__(HttpClient(), token_lifetime=3600)
+        self.active = 0
+        self.max_active = 0
+        self.refresh_delay = 0.01
+
+    async def GetTokenFromRefresh(self, refresh_token: str) -> oauth.RefreshResult:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            return await super().GetTokenFromRefresh(refresh_token)
+        finally:
+            self.active -= 1
+
+
+class TokenRefreshSchedulerTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.now = oauth.Timestamp(0)
+        self.provider = _CountingProvider()
+        self.store = users.UserStore()
+        self.twitch_users = []  # type: List[users.TwitchUser]
+        for i in range(20):
+            twitch_user = users.TwitchUser(str(i), self.provider.IssueToken(self.now))
+            user = self.store.CreateUser(self.now, twitch_user)
+            self.twitch_users.append(twitch_user)
+            if i % 2 == 0:
+                bot = users.TwitchUser('bot%d' % i, self.provider.IssueToken(self.now))
+                user.AddBot(bot)
+                self.twitch_users.append(bot)
+        self.scheduler = token_refresh.TokenRefreshScheduler(
+            self.provider, max_concurrent=4, clock=lambda: self.now)
+        self.scheduler.ScheduleAll(self.store)
+
+    @gen_test
+    async def testRefreshesDueTokensInBoundedBatches(self) -> None:
+        self.assertEqual(self.scheduler.Stats().scheduled, 30)
+        self.assertEqual(await self.scheduler.RefreshDue(), 0)
+        next_at = self.scheduler.NextRefreshAt()
+        assert next_at is not None
+        self.assertTrue(3600 - 300 - 60 <= next_at <= 3600 - 300)
+
+        self.now = oauth.Timestamp(3600 - 300 + 10)
+        self.assertEqual(await self.scheduler.RefreshDue(), 30)
+        self.assertEqual(self.provider.refresh_calls, 30)
+        self.assertEqual(self.provider.max_active, 4)
+        stats = self.scheduler.Stats()
+        self.assertEqual((stats.scheduled, stats.refreshed, stats.failed), (30, 30, 0))
+        self.assertTrue(10 <= stats.max_lag <= 70)
+        # Every token is good past the original expiry, without a refresh.
+        for twitch_user in self.twitch_users:
+            self.assertIsNotNone(twitch_user.Token().TryGet(oauth.Timestamp(3700)))
+        next_at = self.scheduler.NextRefreshAt()
+        assert next_at is not None
+        self.assertGreaterEqual(next_at, self.now + 3600 - 300 - 60)
+
+    @gen_test
+    async def testRetriesFailedRefreshes(self) -> None:
+        scheduler = token_refresh.TokenRefreshScheduler(
+            oauth_testing.FakeOAuthProvider(HttpClient()), retry_delay=30, clock=lambda: self.now)
+        scheduler.Schedule(self.twitch_users[0])
+        self.now = oauth.Timestamp(3600)
+        self.assertEqual(await scheduler.RefreshDue(), 1)
+        self.assertEqual(scheduler.Stats().failed, 1)
+        self.assertEqual(scheduler.NextRefreshAt(), 3630)
+
+    @gen_test
+    async def testUnschedule(self) -> None:
+        for twitch_user in self.twitch_users[1:]:
+            self.scheduler.Unschedule(twitch_user)
+        self.now = oauth.Timestamp(3600)
+        self.assertEqual(await self.scheduler.RefreshDue(), 1)
+        self.assertEqual(self.provider.refresh_calls, 1)
+
+    @gen_test
+    async def testWatchesStore(self) -> None:
+        scheduler = token_refresh.TokenRefreshScheduler(self.provider, clock=lambda: self.now)
+        scheduler.Watch(self.store)
+        self.assertEqual(scheduler.Stats().scheduled, 30)
+        user = self.store.CreateUser(
+            self.now, users.TwitchUser('new', self.provider.IssueToken(self.now)))
+        self.assertEqual(scheduler.Stats().scheduled, 31)
+        self.store.AddBot(user.user_id, users.TwitchUser('newbot', self.provider.IssueToken(self.now)))
+        self.assertEqual(scheduler.Stats().scheduled, 32)
+        # Replacing the bot unschedules the old one.
+        self.store.AddBot(user.user_id, users.TwitchUser('newbot2', self.provider.IssueToken(self.now)))
+        self.assertEqual(scheduler.Stats().scheduled, 32)
+        self.store.DeleteUser(user.user_id)
+        self.store.DeleteUser(self.store.GetUserByTwitchId('0').user_id)
+        self.assertEqual(scheduler.Stats().scheduled, 28)
+        self.now = oauth.Timestamp(3600)
+        self.assertEqual(await scheduler.RefreshDue(), 28)
+
+    @gen_test
+    async def testDeleteDuringRefresh(self) -> None:
+        scheduler = token_refresh.TokenRefreshScheduler(self.provider, clock=lambda: self.now)
+        scheduler.Watch(self.store)
+        self.now = oauth.Timestamp(3600)
+        refreshing = asyncio.ensure_future(scheduler.RefreshDue())
+        await asyncio.sleep(0)
+        self.store.DeleteUser(self.store.GetUserByTwitchId('0').user_id)
+        self.assertEqual(await refreshing, 30)
+        # The deleted user and their bot aren't scheduled again.
+        self.assertEqual(scheduler.Stats().scheduled, 28)
+        self.now = oauth.Timestamp(2 * 3600)
+        self.assertEqual(await scheduler.RefreshDue(), 28)
+
+    @gen_test
+    async def testRunsInBackground(self) -> None:
+        self.scheduler.Start()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.provider.refresh_calls, 0)
+        # Scheduling an earlier refresh wakes the scheduler up.
+        self.scheduler.Schedule(self.twitch_users[0], self.now)
+        while self.scheduler.Stats().refreshed < 1:
+            await asyncio.sleep(0.01)
+        await self.scheduler.Stop()
+        self.assertEqual(self.provider.refresh_calls, 1)
@@ -0,0 +1,195 @@
+from tornado.testing import AsyncTestCase, gen_test
+import asyncio
+import unittest
+from typing import List, Optional
+
+from minibot_server import oauth, tokens, users
+
+
+class _CountingTokenStore(tokens.TokenStore):
+    lookups: int
+    hashes: int
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.lookups = 0
+        self.hashes = 0
+
+    def IdFor(self, secret: tokens.TokenSecret) -> tokens.TokenId:
+        self.hashes += 1
+        return super().IdFor(secret)
+
+    def FindTokenById(self, token_id: tokens.TokenId,
+                      current_time: oauth.Timestamp) -> Optional[tokens.Token]:
+        self.lookups += 1
+        return super().FindTokenById(token_id, current_time)
+
+    def FindUserTokens(self, user_id: users.UserId) -> List[tokens.Token]:
+        self.lookups += 1
+        return super().FindUserTokens(user_id)
+
+
+class TokenStoreTest(unittest.TestCase):
+    def testKeepsOnlyHashes(self) -> None:
+        store = tokens.TokenStore()
+        (secret, token) = store.CreateToken(users.UserId(1), oauth.Timestamp(0))
+        self.assertNotEqual(token.id, secret)
+        self.assertEqual(token.id, store.IdFor(secret))
+        self.assertEqual(store.FindToken(secret, oauth.Timestamp(0)), token)
+        # Knowing a token's id doesn't give access to it.
+        self.assertIsNone(store.FindToken(tokens.TokenSecret(token.id), oauth.Timestamp(0)))
+        self.assertNotIn(secret, repr(store.__dict__))
+        self.assertEqual(store.RevokeToken(token.id), token)
+        self.assertIsNone(store.FindToken(secret, oauth.Timestamp(0)))
+        self.assertIsNone(store.RevokeToken(token.id))
+
+    def testHashesDependOnKey(self) -> None:
+        secret = tokens.TokenSecret('secret')
+        self.assertEqual(tokens.TokenHasher(b'a').IdFor(secret),
+                         tokens.TokenHasher(b'a').IdFor(secret))
+        self.assertNotEqual(tokens.TokenHasher(b'a').IdFor(secret),
+                            tokens.TokenHasher(b'b').IdFor(secret))
+
+    def testExpiry(self) -> None:
+        store = tokens.TokenStore()
+        (secret, token) = store.CreateToken(users.UserId(1), oauth.Timestamp(100), ttl=60)
+        (forever_secret, forever) = store.CreateToken(users.UserId(1), oauth.Timestamp(100))
+        self.assertEqual(token.expires_at, 160)
+        self.assertEqual(store.FindToken(secret, oauth.Timestamp(159)), token)
+        # Expired tokens aren't found, even before they are swept.
+        self.assertIsNone(store.FindToken(secret, oauth.Timestamp(160)))
+        self.assertEqual(store.FindToken(forever_secret, oauth.Timestamp(10 ** 9)), forever)
+        self.assertEqual(store.NextExpiry(), 160)
+
+    def testSweepsInExpiryOrder(self) -> None:
+        store = tokens.TokenStore()
+        created = [store.CreateToken(users.UserId(i % 3), oauth.Timestamp(0), ttl=ttl)[1]
+                   for (i, ttl) in enumerate([30, 10, 50, 20, 40])]
+        store.RevokeToken(created[1].id)
+        self.assertEqual(store.NextExpiry(), 20)
+        self.assertEqual(store.Sweep(oauth.Timestamp(35), 1), [created[3]])
+        self.assertEqual(store.Sweep(oauth.Timestamp(35), 10), [created[0]])
+        self.assertEqual(store.Sweep(oauth.Timestamp(35), 10), [])
+        self.assertEqual(store.NextExpiry(), 40)
+        self.assertEqual(store.Stats(), tokens.TokenStoreStats(live=2, created=5, revoked=1, expired=2))
+        self.assertEqual(store.FindUserTokens(users.UserId(0)), [])
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [created[4]])
+
+    def testRevokeUserTokens(self) -> None:
+        store = tokens.TokenStore()
+        for _ in range(3):
+            store.CreateToken(users.UserId(1), oauth.Timestamp(0), ttl=10)
+        (secret, other) = store.CreateToken(users.UserId(2), oauth.Timestamp(0), ttl=10)
+        store.RevokeUserTokens(users.UserId(1))
+        store.RevokeUserTokens(users.UserId(1))
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [])
+        self.assertEqual(store.Stats().live, 1)
+        self.assertEqual(store.Stats().revoked, 3)
+        self.assertEqual(store.Sweep(oauth.Timestamp(10), 10), [other])
+        self.assertIsNone(store.NextExpiry())
+
+    def testRevokedEntriesDontAccumulate(self) -> None:
+        store = tokens.TokenStore()
+        for _ in range(1000):
+            (_, token) = store.CreateToken(users.UserId(1), oauth.Timestamp(0), ttl=10)
+            store.RevokeToken(token.id)
+        self.assertLess(len(store._expiries), 100)
+        self.assertIsNone(store.NextExpiry())
+
+
+class CachedTokenStoreTest(unittest.TestCase):
+    def testCachesLookups(self) -> None:
+        backing = _CountingTokenStore()
+        (secret, token) = backing.CreateToken(users.UserId(1), oauth.Timestamp(0))
+        store = tokens.CachedTokenStore(backing)
+        for _ in range(10):
+            self.assertEqual(store.FindToken(secret, oauth.Timestamp(0)), token)
+            self.assertEqual(store.FindUserTokens(users.UserId(1)), [token])
+        self.assertEqual(backing.lookups, 2)
+        # Each secret is hashed once, even when the lookup misses.
+        self.assertEqual(backing.hashes, 10)
+        stats = store.Stats()
+        self.assertEqual((stats.hits, stats.misses), (9, 1))
+        self.assertEqual((stats.user_hits, stats.user_misses), (9, 1))
+
+    def testCachesUnknownTokens(self) -> None:
+        backing = _CountingTokenStore()
+        store = tokens.CachedTokenStore(backing, capacity=10, negative_capacity=5)
+        (secret, token) = store.CreateToken(users.UserId(1), oauth.Timestamp(0))
+        for _ in range(3):
+            for i in range(5):
+                self.assertIsNone(store.FindToken(tokens.TokenSecret(f'guess{i}'), oauth.Timestamp(0)))
+        self.assertEqual(backing.lookups, 5)
+        self.assertEqual(store.Stats().negative_hits, 10)
+        # A flood of guesses evicts other guesses, not real tokens.
+        for i in range(100):
+            store.FindToken(tokens.TokenSecret(f'flood{i}'), oauth.Timestamp(0))
+        self.assertEqual(store.FindToken(secret, oauth.Timestamp(0)), token)
+        self.assertEqual(store.Stats().negative_size, 5)
+        self.assertEqual(store.Stats().evictions, 100)
+
+    def testEvictsLeastRecentlyUsed(self) -> None:
+        backing = _CountingTokenStore()
+        secrets = [backing.CreateToken(users.UserId(1), oauth.Timestamp(0))[0] for _ in range(3)]
+        store = tokens.CachedTokenStore(backing, capacity=2)
+        store.FindToken(secrets[0], oauth.Timestamp(0))
+        store.FindToken(secrets[1], oauth.Timestamp(0))
+        store.FindToken(secrets[0], oauth.Timestamp(0))
+        store.FindToken(secrets[2], oauth.Timestamp(0))
+        backing.lookups = 0
+        store.FindToken(secrets[0], oauth.Timestamp(0))
+        self.assertEqual(backing.lookups, 0)
+        store.FindToken(secrets[1], oauth.Timestamp(0))
+        self.assertEqual(backing.lookups, 1)
+
+    def testRevokingInvalidates(self) -> None:
+        store = tokens.CachedTokenStore(tokens.TokenStore())
+        (first_secret, first) = store.CreateToken(users.UserId(1), oauth.Timestamp(0))
+        (second_secret, second) = store.CreateToken(users.UserId(1), oauth.Timestamp(0))
+        (other_secret, other) = store.CreateToken(users.UserId(2), oauth.Timestamp(0))
+        self.assertEqual(len(store.FindUserTokens(users.UserId(1))), 2)
+        self.assertEqual(store.RevokeToken(first.id), first)
+        self.assertIsNone(store.FindToken(first_secret, oauth.Timestamp(0)))
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [second])
+        store.RevokeUserTokens(users.UserId(1))
+        self.assertIsNone(store.FindToken(second_secret, oauth.Timestamp(0)))
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [])
+        self.assertEqual(store.FindToken(other_secret, oauth.Timestamp(0)), other)
+        (_, third) = store.CreateToken(users.UserId(1), oauth.Timestamp(0))
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [third])
+
+    def testSweepInvalidates(self) -> None:
+        store = tokens.CachedTokenStore(tokens.TokenStore())
+        (secret, token) = store.CreateToken(users.UserId(1), oauth.Timestamp(0), ttl=10)
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [token])
+        self.assertIsNone(store.FindToken(secret, oauth.Timestamp(10)))
+        self.assertEqual(store.Sweep(oauth.Timestamp(10), 10), [token])
+        self.assertEqual(store.FindUserTokens(users.UserId(1)), [])
+        self.assertIsNone(store.FindToken(secret, oauth.Timestamp(0)))
+
+
+class TokenSweeperTest(AsyncTestCase):
+    @gen_test
+    async def testSweepsInSlices(self) -> None:
+        store = tokens.TokenStore()
+        for i in range(250):
+            store.CreateToken(users.UserId(i), oauth.Timestamp(0), ttl=10)
+        store.CreateToken(users.UserId(1), oauth.Timestamp(0), ttl=100)
+        sweeper = tokens.TokenSweeper(store, slice_size=100, clock=lambda: oauth.Timestamp(50))
+        self.assertEqual(await sweeper.SweepExpired(), 250)
+        self.assertEqual(sweeper.Stats(), tokens.SweepStats(sweeps=1, slices=3, swept=250))
+        self.assertEqual(store.Stats().live, 1)
+
+    @gen_test
+    async def testSweepsOnStart(self) -> None:
+        store = tokens.TokenStore()
+        store.CreateToken(users.UserId(1), oauth.Timestamp(0), ttl=10)
+        store.CreateToken(users.UserId(1), oauth.Timestamp(0), ttl=100)
+        sweeper = tokens.TokenSweeper(store, clock=lambda: oauth.Timestamp(50))
+        sweeper.Start()
+        try:
+            await asyncio.sleep(0.01)
+            self.assertEqual(store.Stats().live, 1)
+            self.assertEqual(sweeper.Stats().swept, 1)
+        finally:
+            await sweeper.Stop()
@@ -0,0 +1,141 @@
+import unittest
+from typing import Set
+
+from minibot_server import irc, twitch_events
+from minibot_server.twitch_events import (
+    ChatCleared, ChatCommand, ChatMessage, Cheer, GiftSubscription, MysteryGift, Raid,
+    Resubscription, Subscription, UserJoin, UserLeave, Whisper)
+
+
+def _Decode(line: bytes) -> object:
+    return twitch_events.DecodeEvent(irc.Message.Parse(line))
+
+
+class DecodeEventTest(unittest.TestCase):
+    def testChatLines(self) -> None:
+        lines = [
+            b'@badge-info=;badges=moderator/1;color=;display-name=ModBot;emotes=;id=7b9e;mod=1;'
+            b'room-id=71092938;user-id=237719657;user-type=mod '
+            b':modbot!modbot@modbot.tmi.twitch.tv PRIVMSG #somestreamer :Keep chat friendly; thanks!',
+            b'@badge-info=subscriber/24;display-name=LongTimeFan;login=longtimefan;msg-id=resub;'
+            b'msg-param-cumulative-months=24;msg-param-sub-plan=1000;'
+            b'system-msg=LongTimeFan\\ssubscribed;user-id=49106753 '
+            b':tmi.twitch.tv USERNOTICE #somestreamer :Two years already, wow',
+            b':newviewer!newviewer@newviewer.tmi.twitch.tv JOIN #somestreamer',
+            b':oldviewer!oldviewer@oldviewer.tmi.twitch.tv PART #somestreamer',
+            b'@ban-duration=600;room-id=71092938;target-user-id=98765432 '
+            b':tmi.twitch.tv CLEARCHAT #somestreamer :spammer',
+            b'PING :tmi.twitch.tv',
+        ]
+        self.assertEqual([_Decode(line) for line in lines], [
+            ChatMessage('somestreamer', 'modbot', 'ModBot', '237719657',
+                        'Keep chat friendly; thanks!', '7b9e'),
+            Resubscription('somestreamer', 'longtimefan', 'LongTimeFan', '49106753', '1000', 24,
+                           'Two years already, wow'),
+            UserJoin('somestreamer', 'newviewer'),
+            UserLeave('somestreamer', 'oldviewer'),
+            ChatCleared('somestreamer', 'spammer', 600),
+            None,
+        ])
+
+    def testChatCommandsAndCheers(self) -> None:
+        self.assertEqual(
+            _Decode(b'@display-name=A;user-id=1;id=x :a!a@a PRIVMSG #c :!so  someone else'),
+            ChatCommand('c', 'a', 'A', '1', 'so', ' someone else', 'x'))
+        self.assertEqual(
+            _Decode(b'@bits=100;display-name=A;user-id=1;id=x :a!a@a PRIVMSG #c :cheer100 gg'),
+            Cheer('c', 'a', 'A', '1', 100, 'cheer100 gg', 'x'))
+
+    def testUserNotices(self) -> None:
+        self.assertEqual(
+            _Decode(b'@msg-id=sub;login=a;display-name=A;user-id=1;msg-param-sub-plan=Prime '
+                    b':tmi.twitch.tv USERNOTICE #c'),
+            Subscription('c', 'a', 'A', '1', 'Prime', ''))
+        self.assertEqual(
+            _Decode(b'@msg-id=anonsubgift;login=ananonymousgifter;msg-param-recipient-user-name=b;'
+                    b'msg-param-recipient-id=2;msg-param-sub-plan=1000 :tmi.twitch.tv USERNOTICE #c'),
+            GiftSubscription('c', None, 'b', '2', '1000'))
+        self.assertEqual(
+            _Decode(b'@msg-id=submysterygift;login=a;msg-param-mass-gift-count=5;'
+                    b'msg-param-sub-plan=2000 :tmi.twitch.tv USERNOTICE #c'),
+            MysteryGift('c', 'a', 5, '2000'))
+        self.assertEqual(
+            _Decode(b'@msg-id=raid;msg-param-login=r;msg-param-displayName=R\\sR;'
+                    b'msg-param-viewerCount=42 :tmi.twitch.tv USERNOTICE #c'),
+            Raid('c', 'r', 'R R', 42))
+        self.assertIsNone(_Decode(b'@msg-id=ritual :tmi.twitch.tv USERNOTICE #c'))
+        self.assertIsNone(_Decode(b':tmi.twitch.tv USERNOTICE #c'))
+
+    def testOtherEvents(self) -> None:
+        self.assertEqual(
+            _Decode(b'@display-name=A;user-id=1 :a!a@a WHISPER bot :psst'),
+            Whisper('a', 'A', '1', 'psst'))
+        self.assertEqual(_Decode(b':tmi.twitch.tv CLEARCHAT #c'), ChatCleared('c', None, None))
+        self.assertIsNone(_Decode(b':tmi.twitch.tv PRIVMSG'))
+        self.assertIsNone(_Decode(b':tmi.twitch.tv 001 bot :Welcome, GLHF!'))
+
+    def testEventsAreSlotted(self) -> None:
+        event = UserJoin('c', 'a')
+        self.assertFalse(hasattr(event, '__dict__'))
+        self.assertEqual(event.EVENT_TYPE, 'user_chat_join')
+
+
+class SubscriptionRegistryTest(unittest.TestCase):
+    LINES = {
+        'chat': b'@id=1 :a!a@a PRIVMSG #c :hi',
+        'join': b':a!a@a JOIN #c',
+        'sub': b'@login=a;msg-id=sub :tmi.twitch.tv USERNOTICE #c',
+        'raid': b'@msg-id=raid;login=r :tmi.twitch.tv USERNOTICE #c',
+        'mystery_gift': b'@msg-id=submysterygift;login=a :tmi.twitch.tv USERNOTICE #c',
+        'ritual': b'@msg-id=ritual :tmi.twitch.tv USERNOTICE #c',
+        'other_channel': b'@id=1 :a!a@a PRIVMSG #d :hi',
+        'whisper': b':a!a@a WHISPER bot :psst',
+        'ping': b'PING :tmi.twitch.tv',
+        'welcome': b':tmi.twitch.tv 001 bot :Welcome, GLHF!',
+    }
+
+    def _Accepted(self, registry: twitch_events.SubscriptionRegistry) -> Set[str]:
+        return {name for (name, line) in self.LINES.items() if registry.AcceptLine(line)}
+
+    def testFiltersUnwantedEventLines(self) -> None:
+        registry = twitch_events.SubscriptionRegistry()
+        self.assertEqual(self._Accepted(registry), {'ping', 'welcome'})
+        self.assertEqual(registry.lines_filtered, 8)
+
+        self.assertEqual(
+            registry.Listen(1, 'c', ['user_subscribe', 'user_chat_command', 'no_such_event']),
+            ['user_chat_command', 'user_subscribe'])
+        self.assertEqual(self._Accepted(registry), {'chat', 'sub', 'ping', 'welcome'})
+
+        registry.Listen(2, 'd', ['user_raid', 'bot_whisper'])
+        self.assertEqual(self._Accepted(registry), {'chat', 'sub', 'whisper', 'ping', 'welcome'})
+        registry.Listen(3, 'c', ['user_raid', 'user_chat_join'])
+        self.assertEqual(self._Accepted(registry),
+                         {'chat', 'join', 'sub', 'raid', 'whisper', 'ping', 'welcome'})
+
+        registry.Unlisten(1)
+        registry.Unlisten(2)
+        self.assertEqual(self._Accepted(registry), {'join', 'raid', 'ping', 'welcome'})
+
+        # Single gifted subs and mystery gifts are told apart.
+        registry.Listen(4, 'c', ['gift_subscribe'])
+        self.assertEqual(self._Accepted(registry), {'join', 'raid', 'ping', 'welcome'})
+        registry.Listen(5, 'c', ['mystery_gift'])
+        self.assertEqual(self._Accepted(registry),
+                         {'join', 'raid', 'mystery_gift', 'ping', 'welcome'})
+
+    def testCountsEventLines(self) -> None:
+        registry = twitch_events.SubscriptionRegistry()
+        registry.Listen(1, 'c', ['user_chat_join'])
+        for line in self.LINES.values():
+            registry.AcceptLine(line)
+        self.assertEqual((registry.lines_accepted, registry.lines_filtered), (1, 7))
+
+    def testListeners(self) -> None:
+        registry = twitch_events.SubscriptionRegistry()
+        registry.Listen(1, 'c', ['user_chat_join', 'bot_whisper'])
+        registry.Listen(2, 'd', ['user_chat_join'])
+        self.assertEqual(registry.Listeners('c', UserJoin('c', 'a')), [1])
+        self.assertEqual(registry.Listeners('d', UserJoin('d', 'a')), [2])
+        self.assertEqual(registry.Listeners('c', Whisper('a', 'A', '1', 'psst')), [1])
+        self.assertEqual(registry.Listeners('c', UserLeave('c', 'a')), [])